@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+""" 'buildGraph.py': keep track of what each LAT output was made from, s/t only stale outputs are rebuilt.
+    Each product (a split, lat, cut, burst cut or final file, or the efficiency npz) declares its inputs:
+        inputs : upstream files (checked by size and modification time)
+        dbKeys : calDB-v2.json records (checked by their values)
+        code   : source files or functions (checked by their text)
+        params : anything else that goes into it, e.g. the TCut or the job's arguments
+    When a product is written, its declaration is recorded next to it, in
+    [dir]/.build/[file].json.  A product is stale if the output is missing or was changed
+    after the record was written, if any of its inputs changed since, or if any of its
+    input files is a product that's stale itself (so a change propagates downstream).
+
+    Used by lat-jobs.py (batchSplit, runLAT), lat.py, lat2.py (applyCuts), lat3.py (makeCutFiles)
+    and lat-expo.py (makeFinalFiles, getEfficiency).
+
+    Report the stale products among the ones recorded in some directories
+    (their inputs, calDB records and code are checked again, params are as recorded):
+        ./buildGraph.py [-v] dir1 [dir2 file.root ...]
+"""
+import sys, os, glob, json, hashlib, inspect, ast
+
+codeDir = os.path.dirname(os.path.abspath(__file__))
+defaultDB = "%s/calDB-v2.json" % codeDir
+
+_dbCache = {}   # dbFile : (mtime, {key:hash})
+_codeCache = {} # name : hash
+_upCache = {}   # (output, record stamp) : stale reasons
+
+
+def recordName(output):
+    """ [dir]/.build/[file].json """
+    pathName, fileName = os.path.split(os.path.abspath(output))
+    return "%s/.build/%s.json" % (pathName, fileName)
+
+
+def fileStat(path):
+    """ [size, mtime (ns)] or None if the file doesn't exist. """
+    if not os.path.exists(path): return None
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def textHash(text):
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def codeHash(obj):
+    """ (name, hash) of a source file (relative to the LAT directory), or a function or class.
+    Functions are named 'file.py:func', and only the text of the function is hashed.
+    Returns a hash of None if the file or function doesn't exist (anymore).
+    """
+    if callable(obj):
+        obj = "%s:%s" % (os.path.relpath(inspect.getsourcefile(obj), codeDir), obj.__name__)
+    if obj not in _codeCache:
+        fileName, _, funcName = obj.partition(":")
+        path = fileName if os.path.isabs(fileName) else "%s/%s" % (codeDir, fileName)
+        text = None
+        if os.path.isfile(path):
+            with open(path) as f: text = f.read()
+        if text is not None and funcName:
+            text = funcSource(text, funcName)
+        _codeCache[obj] = textHash(text) if text is not None else None
+    return obj, _codeCache[obj]
+
+
+def funcSource(text, funcName):
+    """ The source of a top-level function or class in a file's text, or None. """
+    for node in ast.parse(text).body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name == funcName:
+            return ast.get_source_segment(text, node)
+    return None
+
+
+def dbHashes(dbFile=None):
+    """ {key:hash of vals} for every record in the calDB.  Reloaded if the file changes. """
+    dbFile = dbFile if dbFile is not None else defaultDB
+    mtime = os.stat(dbFile).st_mtime_ns if os.path.isfile(dbFile) else None
+    if dbFile in _dbCache and _dbCache[dbFile][0] == mtime:
+        return _dbCache[dbFile][1]
+    hashes = {}
+    if mtime is not None and os.path.getsize(dbFile) > 0:
+        with open(dbFile) as f:
+            docs = json.load(f)["_default"] # TinyDB format
+        for rec in docs.values():
+            hashes[rec["key"]] = textHash(json.dumps(rec["vals"], sort_keys=True))
+    _dbCache[dbFile] = (mtime, hashes)
+    return hashes
+
+
+def declare(inputs=(), dbKeys=(), code=(), params=None, dbFile=None):
+    """ The current state of a product's inputs, in the form saved in its record. """
+    decl = {"inputs":{os.path.abspath(f):fileStat(f) for f in inputs}, "params":params}
+    decl["code"] = dict(codeHash(c) for c in code)
+    decl["db"] = {"file":dbFile, "records":{}}
+    if len(dbKeys) > 0:
+        recs = dbHashes(dbFile)
+        decl["db"]["records"] = {key:recs.get(key) for key in dbKeys}
+    return decl
+
+
+def readRecord(output):
+    if not os.path.isfile(recordName(output)): return None
+    with open(recordName(output)) as f:
+        return json.load(f)
+
+
+def staleReasons(output, inputs=(), dbKeys=(), code=(), params=None, dbFile=None, force=False):
+    """ Why a product needs to be (re)built.  An empty list means it's up to date.
+    The arguments are its declaration (see the module docstring).
+    """
+    if force: return ["forced"]
+    if not os.path.exists(output): return ["no output"]
+    rec = readRecord(output)
+    if rec is None: return ["no build record"]
+    if rec["output"] != fileStat(output): return ["output changed since it was built"]
+    return compare(rec, declare(inputs, dbKeys, code, params, dbFile))
+
+
+def upstream(inputs):
+    """ The input files that are products w/ records, and stale themselves. """
+    reasons = []
+    for inp in sorted(inputs):
+        if not os.path.isfile(recordName(inp)): continue
+        stamp = (inp, os.stat(recordName(inp)).st_mtime_ns, tuple((f, c[0]) for f, c in sorted(_dbCache.items())))
+        if stamp not in _upCache: _upCache[stamp] = recheck(inp)
+        if len(_upCache[stamp]) > 0: reasons.append("input %s is stale" % inp)
+    return reasons
+
+
+def compare(rec, decl):
+    """ The differences between a product's record and its current declaration. """
+    reasons = upstream(decl["inputs"])
+    for kind, old, new in [("input", rec["inputs"], decl["inputs"]), ("code", rec["code"], decl["code"]),
+                           ("calDB record", rec["db"]["records"], decl["db"]["records"])]:
+        for key in sorted(set(old) | set(new)):
+            if key not in old: reasons.append("new %s %s" % (kind, key))
+            elif key not in new: reasons.append("%s %s not used anymore" % (kind, key))
+            elif old[key] != new[key]: reasons.append("%s %s changed" % (kind, key))
+    if rec["params"] != decl["params"]: reasons.append("params changed")
+    return reasons
+
+
+def isStale(output, *args, **kwargs):
+    return len(staleReasons(output, *args, **kwargs)) > 0
+
+
+def record(output, inputs=(), dbKeys=(), code=(), params=None, dbFile=None):
+    """ Save the declaration of a product that was just written (call after the file is closed). """
+    writeRecord(output, declare(inputs, dbKeys, code, params, dbFile))
+
+
+def writeRecord(output, rec):
+    """ Stamp a record w/ the output's size and time, and write it (atomically). """
+    rec["output"] = fileStat(output)
+    recName = recordName(output)
+    os.makedirs(os.path.dirname(recName), exist_ok=True)
+    tmp = "%s.%d.tmp" % (recName, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(rec, f, indent=1)
+    os.replace(tmp, recName)
+
+
+def outputUnchanged(output):
+    """ Whether a product has a record, and the output wasn't changed after it was written. """
+    rec = readRecord(output)
+    return rec is not None and rec["output"] == fileStat(output)
+
+
+def restamp(output):
+    """ Stamp a product's record w/ the output's current size and time, after an in-place change
+    that doesn't make it stale (e.g. lat-jobs.py writeCut adding the cut to a split file).
+    """
+    rec = readRecord(output)
+    if rec is not None: writeRecord(output, rec)
+
+
+def forget(output):
+    """ Remove a product's record, s/t a rebuild that's killed partway leaves it stale. """
+    if os.path.isfile(recordName(output)): os.remove(recordName(output))
+
+
+def recheck(output, params=None):
+    """ Stale reasons for a product, w/ its inputs, calDB records and code as recorded.
+    params are compared to the recorded ones if they're given.
+    """
+    if not os.path.exists(output): return ["no output"]
+    rec = readRecord(output)
+    if rec is None: return ["no build record"]
+    if rec["output"] != fileStat(output): return ["output changed since it was built"]
+    params = params if params is not None else rec["params"]
+    decl = declare(rec["inputs"], rec["db"]["records"], rec["code"], params, rec["db"]["file"])
+    return compare(rec, decl)
+
+
+def main(argv):
+    if len(argv)==0:
+        print(__doc__)
+        return
+    verbose = "-v" in argv
+    outputs = []
+    for opt in argv:
+        if opt == "-v": continue
+        if os.path.isdir(opt):
+            outputs.extend(sorted(f[:-5].replace("/.build/","/") for f in glob.glob("%s/.build/*.json" % os.path.abspath(opt))))
+        else:
+            outputs.append(opt)
+    nStale = 0
+    for output in outputs:
+        reasons = recheck(output)
+        if len(reasons) > 0:
+            nStale += 1
+            print("stale: %s\n   %s" % (output, "\n   ".join(reasons)))
+        elif verbose:
+            print("ok:    %s" % output)
+    print("%d of %d products are stale." % (nStale, len(outputs)))
+
+
+if __name__=="__main__":
+    main(sys.argv[1:])
@@ -2,9 +2,8 @@
 """ 'dsi.py': DataSetInfo for LAT.
     C. Wiseman, 18 March 2018
 """
-import os, json, glob, re
+import os, json, glob, re, fnmatch, time, contextlib, hashlib, pickle
 import numpy as np
-import tinydb as db
 
 latSWDir    = os.environ['LATDIR']
 dataDir     = os.environ['LATDATADIR']
@@ -23,11 +22,30 @@ calLatDir   = calDir+"/lat"
 effDir      = calDir+"/eff"
 pandaDir    = dataDir+"/pandas"
 threshDir   = bkgDir+"/thresh"
+indexDir    = dataDir+"/.index"     # FileIndex and MetaIndex files (outside the data directories, see FileIndex)
+
+class Lazy:
+    """ Makes an object (e.g. Lazy(DetInfo)) the first time one of its attributes is used,
+    s/t scripts that create them at module level don't pay for reading the
+    run lists and npz files unless the code path they run uses them.
+    """
+    def __init__(self, cls, *args):
+        self.__dict__["_make"] = lambda: cls(*args)
+        self.__dict__["_obj"] = None
+
+    def __getattr__(self, name):
+        if self._obj is None: self.__dict__["_obj"] = self._make()
+        return getattr(self._obj, name)
+
+    def __setattr__(self, name, val):
+        if self._obj is None: self.__dict__["_obj"] = self._make()
+        setattr(self._obj, name, val)
+
 
 class BkgInfo:
     def __init__(self):
-        with open("%s/data/runsBkg.json" % latSWDir) as f:
-            self.master = scrubDict(json.load(f))
+        self.meta = getMetaIndex()
+        self.master = self.meta.bkgMaster
 
     def dsMap(self):
         """returns {ds:numSubDS}"""
@@ -53,32 +71,20 @@ class BkgInfo:
 
     def getRanges(self, ds):
         """ {sub:[runLo1,runHi1, runLo2,runHi2 ...]}"""
-        if ds=="5A":
-            return {i:self.master[5][i] for i in range(0,79+1)}
-        elif ds=="5B":
-            return {i:self.master[5][i] for i in range(80,112+1)}
-        elif ds=="5C":
-            return {i:self.master[5][i] for i in range(113,121+1)}
+        if ds in ["5A","5B","5C"]:
+            return self.meta.bkgRanges[ds]
         else:
             return self.master[int(ds)]
 
     def getRunList(self, ds, sub=None):
-        bkgRanges = self.getRanges(ds)
-        runList = []
+        return self.getRunArray(ds, sub).tolist()
+
+    def getRunArray(self, ds, sub=None):
+        """ Same as getRunList, as a (read-only) numpy array. """
         if sub is None:
-            for ds in sorted(bkgRanges.keys()):
-                subRange = bkgRanges[ds]
-                for i in range(0,len(subRange),2):
-                    runLo, runHi = subRange[i], subRange[i+1]
-                    for r in range(runLo, runHi+1):
-                        runList.append(r)
-        else:
-            subRange = bkgRanges[sub]
-            for i in range(0,len(subRange),2):
-                runLo, runHi = subRange[i], subRange[i+1]
-                for r in range(runLo, runHi+1):
-                    runList.append(r)
-        return runList
+            return self.meta.bkgRuns[(ds if ds in ["5A","5B","5C"] else int(ds), None)]
+        self.getRanges(ds)[sub] # KeyError if the sub-range isn't in this ds
+        return self.meta.bkgRuns[(5 if ds in ["5A","5B","5C"] else int(ds), sub)]
 
     def GetDSNum(self,run):
         ranges = self.dsRanges()
@@ -89,60 +95,39 @@ class BkgInfo:
 
     def GetBkgIdx(self, dsNum, runNum):
         """ Finds the bkgIdx of a given run.  Must be IN the dataset! """
-        bkgRuns = self.master[dsNum]
-
-        for bkgIdx in bkgRuns:
-            runCov = bkgRuns[bkgIdx]
-            runList = []
-            for idx in range(0,len(runCov),2):
-                runList.extend(list(range(runCov[idx],runCov[idx+1]+1)))
-            if runNum in runList:
-                return bkgIdx
+        runs, idxs = self.meta.bkgIdx[dsNum]
+        i = np.searchsorted(runs, runNum)
+        if i < len(runs) and runs[i] == runNum:
+            return int(idxs[i])
         return -1
 
+    def GetBkgIdxs(self, dsNum, runs):
+        """ GetBkgIdx of an array of runs (-1 for the ones not in the dataset). """
+        bkgRuns, idxs = self.meta.bkgIdx[dsNum]
+        runs = np.asarray(runs)
+        i = np.minimum(np.searchsorted(bkgRuns, runs), len(bkgRuns)-1)
+        return np.where(bkgRuns[i] == runs, idxs[i], -1)
+
     def GetSubRanges(self, ds=None, sub=None, opt="thr"):
         """ Return the sub-sub ranges defined by running the threshold finder,
         or changing detector HV. Generated by LAT/lat-settings.py::getSubRanges.
         """
-        f = np.load("%s/data/thrHV_subRanges.npz" % os.environ['LATDIR'])
-        thRanges = f['arr_0']
-        hvRanges = f['arr_1']
-        tmpRanges = []
-        if opt == "thr": tmpRanges = thRanges
-        elif opt == "hv":  tmpRanges = hvRanges
-        else:
+        if opt not in ["thr","hv"]:
             print("IDK what this option is.")
             return None
-        if ds is None: return tmpRanges
-
-        subRanges = []
-        for val in tmpRanges:  # val:(ds, sub, runLo, runHi, nRuns)
-
-            if sub is None and ds==val[0]:
-                subRanges.append(val)
-
-            # specific lookup
-            if sub is not None and ds is not None:
-                if ds==val[0] and sub==val[1]:
-                    subRanges.append((val[2], val[3]))
-
-        return subRanges
+        if ds is None: return self.meta.subRanges[opt]
+        if sub is None: return list(self.meta.subRows.get((opt, ds), []))
+        return list(self.meta.subPairs.get((opt, ds, sub), []))
 
 
 class CalInfo:
     def __init__(self):
-        with open("%s/data/runsCal.json" % latSWDir) as f:
-            self.master = scrubDict(json.load(f),'cal')
-        with open("%s/data/runsSpecial.json" % latSWDir) as f:
-            self.special = scrubDict(json.load(f),'cal')
+        self.meta = getMetaIndex()
+        self.master = self.meta.calMaster
+        self.special = self.meta.calSpecial
 
         # Track all the 'hi' run coverage numbers for fast run range lookups
-        self.covIdx = {}
-        for key in self.master:
-            tmp = []
-            for idx in self.master[key]:
-                tmp.append(self.master[key][idx][2])
-            self.covIdx[key] = np.asarray(tmp)
+        self.covIdx = self.meta.calHi
 
     def GetMasterList(self):
         return self.master
@@ -181,6 +166,10 @@ class CalInfo:
             print("Run %d not found with key %s, lo=%d hi=%d" % (run,key,lo,hi))
             return None
 
+    def GetCalIdxs(self,key,runs):
+        """ GetCalIdx of an array of runs (-1 for the ones no calIdx covers). """
+        return self.meta.calIdxs(key, runs)
+
     def GetNCalIdxs(self,dsNum,module):
         """ Get the number of calIdx's in a given dataset. """
         calKeys = self.GetKeys(dsNum)
@@ -197,16 +186,9 @@ class CalInfo:
             print("Key %s not found in master list!" % key)
             return None
 
-        runList = []
         if idx not in self.master[key].keys():
             return None
-        lst = self.master[key][idx][0]
-        for i in range(0,len(lst),2):
-            lo, hi = lst[i], lst[i+1]
-            runList += range(lo, hi+1)
-        if runLimit is not None:
-            del runList[runLimit:]
-        return runList
+        return self.meta.calRuns[(key,idx)][:runLimit].tolist()
 
     def GetCalRunCoverage(self,key,idx):
         """ Return the (runLo, runHi) coverage of a particular calIdx"""
@@ -374,11 +356,13 @@ class DetInfo:
         # Generated with LAT/lat-settings.py::fillDetInfo
         # Used BKG ranges, DS0-6 in LAT/data/runsBkg.json
         # (verified to 100% match DataSetInfo.cc, (14 Apr 2018 CGW))
-        f = np.load("%s/data/runSettings-v2.npz" % os.environ['LATDIR'])
-        self.detHV = f['arr_0'].item()
-        self.detTH = f['arr_1'].item()
-        self.detCH = f['arr_2'].item()
-        self.pMons = f['arr_3'].item()
+        # (compiled into the MetaIndex, w/ the lookup tables for the methods below)
+        self.meta = getMetaIndex()
+        self.detHV = self.meta.detHV
+        self.detTH = self.meta.detTH
+        self.detCH = self.meta.detCH
+        self.pMons = self.meta.pMons
+        self.detIDCPD = {id:cpd for cpd, id in self.allDetIDs.items()}
 
     def isEnr(self, cpd):
         return True if self.allDetIDs[str(cpd)] > 100000 else False
@@ -411,34 +395,7 @@ class DetInfo:
         TODO: this needs to use the result from chan-sel::checkAllRunsHV
 
         """
-        hv = self.detHV[ds] # {cpd : [(run1,hv1),(run2,hv2),...] }
-        # for h in sorted(hv): print(h, hv[h])
-        # return
-
-        out = {}
-        for cpd in sorted(hv):
-
-            if len(hv[cpd]) == 0:
-                chanHV = 0
-            else:
-                hvInit = hv[cpd][0][1]
-                runInit = hv[cpd][0][0]
-                if run < runInit:
-                    # print("Run not covered in this DS! run:%d, runInit %d" % (run, runInit))
-                    chanHV = 0
-
-                # find the HV setting for this run
-                for r,h in hv[cpd]:
-                    if run < r: continue
-                    if run >= r: chanHV = h
-                    if r > run: break
-                # print("run:",run,"cpd:",cpd,"chanHV:",chanHV)
-
-                if opt == "cpd":
-                    out[str(cpd)] = chanHV
-                if opt == "chan":
-                    out[self.getCPDChan(ds,str(cpd))] = chanHV
-        return out
+        return self.settingOut(ds, self.meta.settingAtRun(self.meta.hvSteps, ds, run), opt)
 
     def getTH(self,ds=None,cpd=None):
         """ {ds : {'det' : [(run1,val1),(run2,val2)...]} }
@@ -455,34 +412,13 @@ class DetInfo:
         """ {cpd : trap thresh} or {chan : trap thresh} depending on option.
         Sets detectors w/ no thresh value (not active in this DS) to -1.
         """
-        th = self.detTH[ds] # {cpd : [(run1,trap1),(run2,trap2),...]}
-        # for t in sorted(th): print(t, th[t])
-        # return
+        return self.settingOut(ds, self.meta.settingAtRun(self.meta.thSteps, ds, run), opt)
 
-        out = {}
-        for cpd in sorted(th):
-
-            if len(th[cpd]) == 0:
-                chanTH = -1
-            else:
-                thInit = th[cpd][0][1]
-                runInit = th[cpd][0][0]
-                if run < runInit:
-                    # print("Run not covered in this DS! run:%d, runInit %d" % (run, runInit))
-                    chanTH = -1
-
-                # find the trap threshold setting for this run
-                for r,t in th[cpd]:
-                    if run < r: continue
-                    if run >= r: chanTH = t
-                    if r > run: break
-                # print("run:",run,"cpd:",cpd,"chanTH:",chanTH)
-
-                if opt == "cpd":
-                    out[str(cpd)] = chanTH
-                if opt == "chan":
-                    out[self.getCPDChan(ds,str(cpd))] = chanTH
-        return out
+    def settingOut(self, ds, vals, opt):
+        """ A copy of a {cpd : val} table from the MetaIndex, keyed on cpd or chan. """
+        if opt == "cpd": return dict(vals)
+        if opt == "chan": return {self.getCPDChan(ds,cpd):val for cpd, val in vals.items()}
+        return {}
 
     def getCH(self,ds=None,cpd=None):
         """ {ds : {'det' : [(run1,val1),(run2,val2)...]} }
@@ -498,35 +434,21 @@ class DetInfo:
 
     def getChanList(self,ds):
         """In DS0-6, the channel number does NOT change in the DS."""
-        return sorted([ch[0][1] for ch in self.detCH[ds].values() if len(ch)>0])
+        return list(self.meta.chanList[ds])
 
     def getChanCPD(self,ds,chan):
         """ Get the CPD of a channel """
-        cpd = {val[0][1]:cpd for cpd, val in self.detCH[ds].items() if len(val)>0}
-        if chan in cpd.keys():
-            return cpd[chan]
-        else:
-            return None
+        return self.meta.chanCPD[ds].get(chan)
 
     def getCPDChan(self,ds,cpd):
         """ Get the channel of a cpd """
-        chan = {cpd:val[0][1] for cpd, val in self.detCH[ds].items() if len(val)>0}
-        if cpd in chan.keys():
-            return chan[cpd]
-        else:
-            return None
+        return self.meta.cpdChan[ds].get(cpd)
 
     def getChanDetID(self,ds,detID):
         """ Given a detID (ex. 1426641), get its channel.
         Returns nothing if the detector isn't enabled in this DS.
         """
-        cpdToChan = {cpd:chan[0][1] for cpd, chan in self.detCH[ds].items() if len(chan)>0}
-        detIDtoCPD = {id:cpd for cpd, id in self.allDetIDs.items()}
-
-        if detIDtoCPD[detID] in cpdToChan.keys(): # i.e. it's active at some point in the DS
-            return cpdToChan[detIDtoCPD[detID]]
-        else:
-            return None
+        return self.meta.cpdChan[ds].get(self.detIDCPD[detID]) # i.e. it's active at some point in the DS
 
     def getDetIDChan(self,ds,chan):
         """ Given a channel, return a detID. """
@@ -670,14 +592,14 @@ def getSplitList(filePathRegexString, subNum, uniqueKey=False, dsNum=None):
     """ Creates a dict of files w/ the format {'DSX_X_X':filePath.}
         Used to combine and split apart files during the LAT processing.
         Used in place of sorted(glob.glob(myPath)).
+        The directory listing comes from its FileIndex, so it isn't read again unless it's changed.
     """
     files = {}
-    for fl in glob.glob(filePathRegexString):
-        int(re.search(r'\d+',fl).group())
-        pathList = os.path.split(fl)
-        for path in pathList:
-            if '.root' in path:
-                ints = list(map(int, re.findall(r'\d+', path)))
+    pathName, pattern = os.path.split(filePathRegexString)
+    for name in getFileIndex(pathName).match(pattern):
+        if not name.endswith(".root"): continue # the ds/sub/idx numbers are only parsed from .root names, as in the old glob loop
+        fl = os.path.join(pathName, name)
+        ints = list(map(int, re.findall(r'\d+', name)))
         if (ints[1]==subNum):
             if (len(ints)==2):
                 ints.append(0)
@@ -688,6 +610,312 @@ def getSplitList(filePathRegexString, subNum, uniqueKey=False, dsNum=None):
     return files
 
 
+class FileIndex:
+    """ The files in a LAT data directory (e.g. bkg/lat), w/ the ds, sub-range or run,
+    split index, size, modification time and (once asked for) entry count of each one.
+    The index is saved in indexDir, and the directory is only listed again when its own
+    modification time changes (a file was added, removed or renamed), so most lookups
+    cost one stat of the directory instead of a listing.  NOTE: a file rewritten in place
+    doesn't change the directory, so size/mtime can be old.  entries() checks them.
+    """
+    nameRegex = re.compile(r"DS(\d+)_(run)?(\d+)(?:_(\d+))?", re.I)
+
+    def __init__(self, dirName):
+        self.dirName = os.path.abspath(dirName)
+        self.indexFile = "%s/%s.json" % (indexDir, self.dirName.strip("/").replace("/","_"))
+        self.dirTime, self.files = None, {}
+        if os.path.isfile(self.indexFile):
+            try:
+                with open(self.indexFile) as f:
+                    idx = json.load(f)
+                self.dirTime, self.files = idx["dirTime"], idx["files"]
+            except (ValueError, KeyError):
+                pass
+        self.refresh()
+
+    def refresh(self):
+        """ List the directory again if it's changed.  Keeps the entry counts of unchanged files. """
+        dirTime = os.stat(self.dirName).st_mtime_ns if os.path.isdir(self.dirName) else None
+        if dirTime == self.dirTime: return
+        files = {}
+        if dirTime is not None:
+            for ent in os.scandir(self.dirName):
+                if ent.name.startswith(".") or not ent.is_file(): continue
+                st = ent.stat()
+                old = self.files.get(ent.name)
+                if old is not None and old["size"]==st.st_size and old["mtime"]==st.st_mtime_ns:
+                    files[ent.name] = old
+                    continue
+                files[ent.name] = dict(self.parseName(ent.name), size=st.st_size, mtime=st.st_mtime_ns, nEnt=None)
+        # w/ coarse (1 sec) mtimes, a file added right after this listing wouldn't change
+        # the directory time, so list a directory that just changed again next time.
+        if dirTime is not None and time.time() - dirTime/1e9 < 2: dirTime = None
+        self.dirTime, self.files = dirTime, files
+        self.save()
+
+    def parseName(self, name):
+        """ ds, sub (or run) and split index from e.g. latSkimDS1_5_3.root, latSkimDS1_run9422_2.root """
+        m = self.nameRegex.search(name)
+        if m is None: return {"ds":None, "sub":None, "run":None, "idx":None}
+        ds, isRun, num, idx = m.groups()
+        return {"ds":int(ds), "sub":None if isRun else int(num), "run":int(num) if isRun else None,
+                "idx":int(idx) if idx is not None else 0}
+
+    def save(self):
+        """ Write the index (atomically).  If indexDir isn't writable, it's only kept in memory. """
+        try:
+            os.makedirs(indexDir, exist_ok=True)
+            tmp = "%s.%d.tmp" % (self.indexFile, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump({"dir":self.dirName, "dirTime":self.dirTime, "files":self.files}, f)
+            os.replace(tmp, self.indexFile)
+        except OSError:
+            pass
+
+    def match(self, pattern):
+        """ Names of the files matching a glob pattern, like glob.glob(dirName/pattern). """
+        self.refresh()
+        return [name for name in sorted(self.files) if fnmatch.fnmatchcase(name, pattern)]
+
+    def query(self, prefix="", ds=None, sub=None, run=None, idx=None):
+        """ {name:info} of the files whose name starts w/ prefix, w/ the given ds, sub or run, and split index. """
+        self.refresh()
+        res = {}
+        for name, info in self.files.items():
+            if not name.startswith(prefix): continue
+            if any(val is not None and info[key] != val for key, val in [("ds",ds),("sub",sub),("run",run),("idx",idx)]):
+                continue
+            res[name] = info
+        return res
+
+    def entries(self, name, treeName="skimTree"):
+        """ Number of entries in a file's tree, read once and kept in the index. """
+        info = self.files[name]
+        st = os.stat("%s/%s" % (self.dirName, name))
+        if info["nEnt"] is None or info["size"]!=st.st_size or info["mtime"]!=st.st_mtime_ns:
+            from ROOT import TFile
+            f = TFile("%s/%s" % (self.dirName, name))
+            t = f.Get(treeName) if not f.IsZombie() else None
+            info.update(size=st.st_size, mtime=st.st_mtime_ns, nEnt=t.GetEntries() if t else None)
+            f.Close()
+            self.save()
+        return info["nEnt"]
+
+
+_fileIndexes = {}
+
+def getFileIndex(dirName):
+    """ The FileIndex of a directory, shared by all the lookups in this process. """
+    dirName = os.path.abspath(dirName)
+    if dirName not in _fileIndexes: _fileIndexes[dirName] = FileIndex(dirName)
+    return _fileIndexes[dirName]
+
+
+class MetaIndex:
+    """ The run lists and detector settings that BkgInfo, CalInfo and DetInfo use, compiled
+    into sorted arrays and lookup tables, s/t a run or channel lookup is a searchsorted or a
+    dict lookup instead of a loop over run ranges or detectors:
+        bkgRuns[(ds,sub)]         : runs of a sub-range, as getRunList lists them (sub=None: the whole ds, incl. 5A/5B/5C)
+        bkgIdx[ds]                : (sorted runs, bkgIdx of each run)
+        subPairs[(opt,ds,sub)]    : the thr/hv sub-ranges of a bkgIdx, as GetSubRanges returns them
+        calLo[key], calHi[key]    : run coverage of each calIdx, calRuns[(key,idx)] : its runs
+        hvSteps[ds], thSteps[ds]  : (runs where any setting changes, {cpd:val} from each of them on)
+        chanCPD[ds], cpdChan[ds]  : channel <-> CPD
+    It's built from the files in 'sources' and saved in indexDir, and rebuilt when one of them
+    changes (or 'version' does, when the tables change).  The dicts are shared by all the info
+    objects in a process, so treat them as read-only.
+    """
+    version = 1
+    sources = ["data/runsBkg.json", "data/runsCal.json", "data/runsSpecial.json",
+               "data/thrHV_subRanges.npz", "data/runSettings-v2.npz"]
+
+    def __init__(self):
+        self.stamps = self.sourceStamps()
+        self.indexFile = "%s/meta_%s.pkl" % (indexDir, latSWDir.strip("/").replace("/","_"))
+        if not self.load():
+            self.build()
+            self.save()
+        arrays = list(self.bkgRuns.values()) + list(self.calRuns.values()) + list(self.calLo.values())
+        arrays += list(self.calHi.values()) + [a for tbl in self.bkgIdx.values() for a in tbl]
+        for a in arrays: a.flags.writeable = False # they're handed out w/o copies
+
+    @classmethod
+    def sourceStamps(cls):
+        stamps = [cls.version]
+        for src in cls.sources:
+            st = os.stat("%s/%s" % (latSWDir, src))
+            stamps.append((src, st.st_size, st.st_mtime_ns))
+        return stamps
+
+    def isCurrent(self):
+        return self.stamps == self.sourceStamps()
+
+    def load(self):
+        """ Read the saved tables, if they were built from the current sources. """
+        if not os.path.isfile(self.indexFile): return False
+        try:
+            with open(self.indexFile, "rb") as f:
+                tables = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+            return False
+        if tables.get("stamps") != self.stamps: return False
+        self.__dict__.update(tables)
+        return True
+
+    def save(self):
+        """ Write the tables (atomically).  If indexDir isn't writable, they're only kept in memory. """
+        tables = {key:val for key, val in self.__dict__.items() if key != "indexFile"}
+        try:
+            os.makedirs(indexDir, exist_ok=True)
+            tmp = "%s.%d.tmp" % (self.indexFile, os.getpid())
+            with open(tmp, "wb") as f:
+                pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.indexFile)
+        except OSError:
+            pass
+
+    def build(self):
+        # -- bkg runs --
+        with open("%s/data/runsBkg.json" % latSWDir) as f:
+            self.bkgMaster = scrubDict(json.load(f))
+        self.bkgRanges = {"5A":{i:self.bkgMaster[5][i] for i in range(0,79+1)},
+                          "5B":{i:self.bkgMaster[5][i] for i in range(80,112+1)},
+                          "5C":{i:self.bkgMaster[5][i] for i in range(113,121+1)}}
+        self.bkgRuns, self.bkgIdx = {}, {}
+        for ds in self.bkgMaster:
+            self.bkgRanges[ds] = self.bkgMaster[ds]
+            runIdx = {} # run:bkgIdx. the first bkgIdx a run is in wins, as in GetBkgIdx
+            for sub in reversed(list(self.bkgMaster[ds])):
+                runs = rangeRuns(self.bkgMaster[ds][sub])
+                self.bkgRuns[(ds,sub)] = runs
+                runIdx.update(dict.fromkeys(runs.tolist(), sub))
+            runs = np.array(sorted(runIdx), dtype=np.int64)
+            self.bkgIdx[ds] = (runs, np.array([runIdx[r] for r in runs.tolist()], dtype=np.int64))
+        for ds in self.bkgRanges:
+            ranges = self.bkgRanges[ds]
+            self.bkgRuns[(ds,None)] = np.concatenate([rangeRuns(ranges[sub]) for sub in sorted(ranges)])
+
+        # -- thr/hv sub-ranges of each bkgIdx (from LAT/lat-settings.py::getSubRanges) --
+        f = np.load("%s/data/thrHV_subRanges.npz" % latSWDir, allow_pickle=True)
+        self.subRanges = {"thr":f['arr_0'], "hv":f['arr_1']}
+        self.subRows, self.subPairs = {}, {}
+        for opt, tmpRanges in self.subRanges.items():
+            for val in tmpRanges:  # val:(ds, sub, runLo, runHi, nRuns)
+                self.subRows.setdefault((opt, val[0]), []).append(val)
+                self.subPairs.setdefault((opt, val[0], val[1]), []).append((val[2], val[3]))
+
+        # -- cal runs --
+        with open("%s/data/runsCal.json" % latSWDir) as f:
+            self.calMaster = scrubDict(json.load(f),'cal')
+        with open("%s/data/runsSpecial.json" % latSWDir) as f:
+            self.calSpecial = scrubDict(json.load(f),'cal')
+        self.calLo, self.calHi, self.calSearch, self.calRuns = {}, {}, {}, {}
+        for key in self.calMaster:
+            cal = self.calMaster[key]
+            self.calHi[key] = hi = np.asarray([cal[idx][2] for idx in cal])
+            self.calLo[key] = np.asarray([cal[idx][1] for idx in cal])
+            # some 'hi' lists aren't sorted (e.g. ds5c, ds6_m1), and searchsorted of an array of runs
+            # doesn't give what GetCalIdx gets one run at a time.  that changes only at the 'hi' values,
+            # so keep it for each of them: searchsorted(hi, run) = res[searchsorted(vals, run)]
+            vals = np.unique(hi)
+            res = [np.searchsorted(hi, v) for v in vals] + [np.searchsorted(hi, vals[-1]+1)]
+            self.calSearch[key] = (vals, np.array(res))
+            for idx in cal:
+                self.calRuns[(key,idx)] = rangeRuns(cal[idx][0])
+
+        # -- detector settings (from LAT/lat-settings.py::fillDetInfo) --
+        f = np.load("%s/data/runSettings-v2.npz" % latSWDir, allow_pickle=True)
+        self.detHV = f['arr_0'].item()
+        self.detTH = f['arr_1'].item()
+        self.detCH = f['arr_2'].item()
+        self.pMons = f['arr_3'].item()
+        self.hvSteps = {ds:settingSteps(self.detHV[ds], 0) for ds in self.detHV}
+        self.thSteps = {ds:settingSteps(self.detTH[ds], -1) for ds in self.detTH}
+        self.chanCPD, self.cpdChan, self.chanList = {}, {}, {}
+        for ds in self.detCH:
+            self.chanCPD[ds] = {val[0][1]:cpd for cpd, val in self.detCH[ds].items() if len(val)>0}
+            self.cpdChan[ds] = {cpd:val[0][1] for cpd, val in self.detCH[ds].items() if len(val)>0}
+            self.chanList[ds] = sorted([ch[0][1] for ch in self.detCH[ds].values() if len(ch)>0])
+
+    def settingAtRun(self, steps, ds, run):
+        """ {cpd:val} of the HV (steps=self.hvSteps) or TRAP threshold (self.thSteps) at a run. """
+        runs, vals = steps[ds]
+        return vals[np.searchsorted(runs, run, side="right")]
+
+    def calIdxs(self, key, runs):
+        """ calIdx of each run for a cal key, -1 where no calIdx covers it. """
+        runs = np.asarray(runs)
+        lo, hi = self.calLo[key], self.calHi[key]
+        vals, res = self.calSearch[key]
+        idx = res[np.searchsorted(vals, runs)]
+        inRange = idx < len(hi)
+        i = idx[inRange]
+        inRange[inRange] = (lo[i] <= runs[inRange]) & (runs[inRange] <= hi[i])
+        return np.where(inRange, idx, -1)
+
+    def runIndex(self, run, mod=1):
+        """ (ds, bkgIdx, subIdx, calIdx) of a bkg run, for the cal key of a module.
+        subIdx is the run's thr sub-range in the bkgIdx (0 if the bkgIdx has none).
+        Returns None if it's not a bkg run, and -1 for a subIdx or calIdx that doesn't cover it.
+        """
+        for ds in sorted(self.bkgIdx):
+            runs, idxs = self.bkgIdx[ds]
+            i = np.searchsorted(runs, run)
+            if i < len(runs) and runs[i] == run: break
+        else:
+            return None
+        bIdx = int(idxs[i])
+        dsSub = ds
+        if ds == 5: dsSub = "5A" if bIdx <= 79 else "5B" if bIdx <= 112 else "5C"
+        subIdx = 0
+        pairs = self.subPairs.get(("thr", dsSub, bIdx), [])
+        if len(pairs) > 0:
+            subIdx = next((j for j, (lo, hi) in enumerate(pairs) if lo <= run <= hi), -1)
+        calKey = "ds5c" if dsSub == "5C" else "ds%d_m%d" % (ds, mod)
+        calIdx = int(self.calIdxs(calKey, [run])[0]) if calKey in self.calHi else -1
+        return ds, bIdx, subIdx, calIdx
+
+
+def rangeRuns(ranges):
+    """ Array of the runs in a list of ranges [runLo1,runHi1, runLo2,runHi2 ...], in list order. """
+    runs = [np.arange(ranges[i], ranges[i+1]+1, dtype=np.int64) for i in range(0,len(ranges),2)]
+    return np.concatenate(runs) if len(runs) > 0 else np.zeros(0, dtype=np.int64)
+
+
+def settingAtRun(settings, run, default):
+    """ {cpd : val} at a run, from {cpd : [(run1,val1),(run2,val2)...]}.  (The loop DetInfo used to do.)
+    A detector's value is the one w/ the last run <= 'run' in its list, or 'default' if there's none.
+    Detectors w/ an empty list are left out.
+    """
+    out = {}
+    for cpd in sorted(settings):
+        if len(settings[cpd]) == 0: continue
+        val = default
+        for r, v in settings[cpd]:
+            if run >= r: val = v
+        out[str(cpd)] = val
+    return out
+
+
+def settingSteps(settings, default):
+    """ (sorted runs where any detector's setting changes, [{cpd:val} before the first one, from each one on]).
+    The settings only change at those runs, so settingAtRun there gives every value.
+    """
+    runs = sorted(set(r for cpd in settings for r, v in settings[cpd]))
+    vals = [settingAtRun(settings, runs[0]-1 if len(runs) > 0 else 0, default)]
+    vals += [settingAtRun(settings, r, default) for r in runs]
+    return np.array(runs, dtype=np.int64), vals
+
+
+_metaIndex = None
+
+def getMetaIndex():
+    """ The MetaIndex, shared by all the info objects in this process.  Rebuilt if a source file changed. """
+    global _metaIndex
+    if _metaIndex is None or not _metaIndex.isCurrent(): _metaIndex = MetaIndex()
+    return _metaIndex
+
+
 def GetExposureDict(dsNum, modNum, dPath="%s/data" % latSWDir, verbose=False):
     """ Parse granular exposure output from ds_livetime.cc (-idx option).
     Deprecated in favor of ds_livetime ROOT output.
@@ -768,32 +996,34 @@ def GetExposureDict(dsNum, modNum, dPath="%s/data" % latSWDir, verbose=False):
 
 
 def getDBRecord(key, verbose=False, calDB=None, pars=None):
-    """ View a particular database record. """
-    import tinydb as db
-
-    if calDB is None: calDB = db.TinyDB('calDB.json')
-    if pars is None: pars = db.Query()
+    """ View a particular database record.
+    calDB is a CalDB (see getCalDB), or a TinyDB handle (w/ its Query in pars).
+    """
+    if calDB is None: calDB = getCalDB('calDB.json')
 
-    recList = calDB.search(pars.key == key)
+    if isinstance(calDB, CalDB):
+        recList = calDB.records(key)
+    else:
+        import tinydb as db
+        if pars is None: pars = db.Query()
+        recList = [rec['vals'] for rec in calDB.search(pars.key == key)]
     nRec = len(recList)
     if nRec == 0:
         if verbose: print("Record %s doesn't exist" % key)
         return 0
     elif nRec == 1:
         if verbose: print("Found record:\n%s" % key)
-        rec = recList[0]['vals']  # whole record
 
-        # sort the TinyDB string keys numerically (obvs only works for integer keys)
-        result = {}
-        for key in sorted([int(k) for k in rec]):
-            if verbose: print(key, rec[u'%d' % key])
-            result[key] = rec[u'%d' % key]
+        # the TinyDB string keys sorted numerically (obvs only works for integer keys)
+        result = calDB.get(key) if isinstance(calDB, CalDB) else intKeys(recList[0])
+        if verbose:
+            for ch in result: print(ch, result[ch])
         return result
     else:
         print("WARNING: Found multiple records for key: %s.  Need to do some cleanup!" % key)
         for rec in recList:
-            for key in sorted([int(k) for k in rec]):
-                print(key, rec[u'%d' % key])
+            for ch in sorted([int(k) for k in rec]):
+                print(ch, rec[u'%d' % ch])
             print(" ")
 
 
@@ -801,12 +1031,15 @@ def setDBRecord(entry, forceUpdate=False, dbFile="calDB.json", calDB=None, pars=
     """ Adds entries to the DB. Checks for duplicate records.
     The format of 'entry' should be a nested dict:
     myEntry = {"key":key, "vals":vals}
+    calDB is a CalDB (see getCalDB), or a TinyDB handle (w/ its Query in pars).
     """
-    import tinydb as db
-    if calDB is None:
-        calDB = db.TinyDB(dbFile)
-        pars = db.Query()
+    if calDB is None: calDB = getCalDB(dbFile)
+    if isinstance(calDB, CalDB):
+        calDB.setMany([entry], forceUpdate, verbose)
+        return
 
+    import tinydb as db
+    if pars is None: pars = db.Query()
     key, vals = entry["key"], entry["vals"]
     recList = calDB.search(pars.key==key)
     nRec = len(recList)
@@ -823,142 +1056,555 @@ def setDBRecord(entry, forceUpdate=False, dbFile="calDB.json", calDB=None, pars=
                     print("Updating record: ",key)
                 calDB.update(entry, pars.key==key)
     else:
-        print("WARNING: Multiple records found for key '%s'.  Need to do some cleanup!!")
+        print("WARNING: Multiple records found for key '%s'.  Need to do some cleanup!!" % key)
 
 
-def GetDBCuts(ds, bIdx, mod, cutType, calDB, pars, pctTot, verbose=True):
-    """ Load cut data from the calDB and translate to TCut format. """
-    dsNum = int(ds[0]) if isinstance(ds, str) else int(ds)
+def intKeys(vals):
+    """ {int(key):val} of a record's vals, sorted by key. """
+    return {k:vals[u'%d' % k] for k in sorted([int(k) for k in vals])}
 
-    # load metadata and print a status message.
-    det = DetInfo()
-    chList = det.getGoodChanList(dsNum, mod)
 
-    bkg = BkgInfo()
-    bkgRanges = bkg.getRanges(ds)
-    rFirst, rLast = bkgRanges[bIdx][0], bkgRanges[bIdx][-1]
-    dsSub = ds if ds in ["5A","5B","5C"] else int(ds)
-    subRanges = bkg.GetSubRanges(dsSub, bIdx) # this is finicky about int/str
-    if len(subRanges) == 0: subRanges.append((rFirst, rLast))
-
-    cal = CalInfo()
-    calKey = "ds%d_m%d" % (dsNum, mod)
-    if ds == "5C": calKey = "ds5c"
-    if calKey not in cal.GetKeys(dsNum):
-        print("Error: Unknown cal key:",calKey)
-        return
-    cIdxLo = cal.GetCalIdx(calKey, rFirst)
-    cIdxHi = cal.GetCalIdx(calKey, rLast)
-    nCal = cIdxHi+1 - cIdxLo
-
-    if cutType == '-b': cutType = "th"
-    if verbose: print("DS%d-M%d (%s) eff%s  %s bIdx %d  %d--%d  nBkg %d  nCal %d" % (dsNum,mod,ds,pctTot,cutType,bIdx,rFirst,rLast,len(subRanges),nCal))
+def copyVal(val):
+    """ Copy of a record value (nested lists), s/t callers can't change the cached one. """
+    return [copyVal(v) for v in val] if isinstance(val, list) else val
 
-    # -- 1. get data for cuts tuned by bkgIdx (thresholds) --
-    # bkgDict = {ch:None for ch in chList}
-    bkgDict = {}
-    bkgCov = {ch:[] for ch in chList}
-    for sIdx, (runLo, runHi) in enumerate(subRanges):
 
-        bRunCut = "run>=%d && run<=%d" % (runLo, runHi)
-        if verbose: print("  bIdx %-3d %d %d--%d" % (bIdx, sIdx, runLo, runHi))
+class CalDB:
+    """ A calDB file (TinyDB format, e.g. calDB-v2.json) loaded into a dict keyed by the record key,
+    s/t a lookup doesn't scan (and re-parse) the whole file like a TinyDB search does.
+    The file is reloaded when its size or modification time changes.
+    Records come back as getDBRecord returns them ({int key:val}, sorted), and are only
+    converted once.  getArray gives the values as numpy arrays.
 
-        thD = getDBRecord("thresh_ds%d_bkg%d_sub%d" % (dsNum, bIdx, sIdx), False, calDB, pars)
+    Writes are safe w/ other jobs writing the same file.  Each change is appended to a
+    journal (see writeJournal), and merged into the file under a lock (see mergeJournals),
+    w/ a check that nobody else changed the record since we read it.
+    Inside 'with calDB.batch():' the changes are saved once, at the end.
+    If 'journal' (a job name) is given, or LATDBJOURNAL is set, the changes are only
+    journaled, and merged later w/ 'lat-jobs.py -dbMerge'.  That's for parallel tuning
+    jobs: they don't rewrite the whole file for each record, or wait for each other.
+    """
+    def __init__(self, dbFile, journal=None):
+        self.dbFile = os.path.abspath(dbFile)
+        self.journal = journal if journal is not None else os.environ.get("LATDBJOURNAL")
+        self.stamp = None
+        self.docs = {}    # TinyDB doc id : {"vals":vals, "key":key}, as in the file
+        self.index = {}   # key : [doc ids]
+        self.recs = {}    # key : {int key:val}
+        self.arrays = {}  # key : (keys, vals)
+        self.pending = [] # changes not saved yet
+        self.mine = []    # changes only in our journal (journal mode), kept on reload
+        self.nBatch = 0
+
+    def refresh(self):
+        """ Load the file again if it's changed (unless we have unsaved changes in a batch). """
+        if len(self.pending) > 0: return
+        st = os.stat(self.dbFile) if os.path.isfile(self.dbFile) else None
+        stamp = (st.st_size, st.st_mtime_ns) if st is not None else None
+        if stamp == self.stamp: return
+        self.docs = readDocs(self.dbFile)
+        self.index, self.recs, self.arrays = docIndex(self.docs), {}, {}
+        # our journaled changes that were merged are in the file now, only replay the rest
+        self.mine = [op for op in self.mine if not self.inFile(op)]
+        for op in self.mine: self.apply(op)
+        self.stamp = stamp
+
+    def inFile(self, op):
+        """ Whether the loaded file already has a change. """
+        docIds = self.index.get(op["key"], [])
+        return len(docIds) == 1 and self.docs[docIds[0]]["vals"] == op["vals"]
+
+    def apply(self, op):
+        """ Put a change in the loaded records (not the file). """
+        key, docIds = op["key"], self.index.get(op["key"], [])
+        if len(docIds) == 0:
+            docId = newDocId(self.docs)
+            self.docs[docId] = {"key":key, "vals":op["vals"]}
+            self.index[key] = [docId]
+        else:
+            self.docs[docIds[0]]["vals"] = op["vals"]
+        self.recs.pop(key, None)
+        self.arrays.pop(key, None)
+
+    def keys(self):
+        self.refresh()
+        return sorted(self.index)
+
+    def records(self, key):
+        """ The vals of every record w/ this key, as they are in the file (normally one). """
+        self.refresh()
+        return [self.docs[docId]["vals"] for docId in self.index.get(key, [])]
+
+    def get(self, key):
+        """ A record as {int key:val}, or None if there isn't exactly one w/ this key. """
+        self.refresh()
+        if len(self.index.get(key, [])) != 1: return None
+        if key not in self.recs:
+            self.recs[key] = intKeys(self.docs[self.index[key][0]]["vals"])
+        return {k:copyVal(v) for k, v in self.recs[key].items()}
+
+    def getMany(self, keys):
+        """ {key:record} for a list of keys (see get). """
+        return {key:self.get(key) for key in keys}
+
+    def getArray(self, key):
+        """ A record as numpy arrays: the int keys (sorted), and a float array of their values,
+        one row per key (None values are rows of NaN).  The arrays are cached, and read-only.
+        Raises ValueError if the values aren't numbers or lists of numbers of the same length.
+        """
+        self.refresh()
+        if key not in self.arrays:
+            rec = self.get(key)
+            if rec is None: return None
+            chans = np.array(list(rec.keys()), dtype=int)
+            rows = [v for v in rec.values() if v is not None]
+            nVal = len(rows[0]) if len(rows) > 0 and isinstance(rows[0], list) else 0
+            vals = np.full((len(chans), nVal) if nVal else len(chans), np.nan)
+            for i, v in enumerate(rec.values()):
+                if v is not None: vals[i] = np.array(v, dtype=float)
+            chans.setflags(write=False)
+            vals.setflags(write=False)
+            self.arrays[key] = (chans, vals)
+        return self.arrays[key]
+
+    def setMany(self, entries, forceUpdate=False, verbose=False):
+        """ Add or update several records, and save them together.  'entries' are
+        {"key":key, "vals":vals} dicts, as for setDBRecord, which this does the checks of:
+        an existing record is only replaced if forceUpdate is set.
+        """
+        self.refresh()
+        for entry in entries:
+            key = entry["key"]
+            vals = json.loads(json.dumps(entry["vals"])) # the form it has in the file (str keys, lists)
+            docIds = self.index.get(key, [])
+            base = None
+            if len(docIds) == 0:
+                if verbose: print("Record '%s' doesn't exist in the DB  Adding it ..." % key)
+            elif len(docIds) == 1:
+                base = self.docs[docIds[0]]["vals"]
+                if base == vals: continue
+                if verbose:
+                    print("An old version of record '%s' exists.  It DOES NOT match the new version.  forceUpdate? %r" % (key, forceUpdate))
+                if not forceUpdate: continue
+                if verbose:
+                    print("Updating record: ",key)
+            else:
+                print("WARNING: Multiple records found for key '%s'.  Need to do some cleanup!!" % key)
+                continue
+            op = {"key":key, "vals":vals, "base":valHash(base)}
+            self.apply(op)
+            self.pending.append(op)
+        if self.nBatch == 0: self.save()
+
+    def save(self):
+        """ Journal the pending changes, and merge them into the file (unless in journal mode). """
+        if len(self.pending) == 0: return
+        name = self.journal if self.journal is not None else "direct-%s-%d" % (os.uname()[1], os.getpid())
+        jFile = writeJournal(self.dbFile, name, self.pending)
+        ops, self.pending = self.pending, []
+        if self.journal is not None:
+            self.mine.extend(ops)
+            return
+        mergeJournals(self.dbFile, [jFile], verbose=False)
+        self.stamp = None # reload, w/ whatever else was merged
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ with calDB.batch(): ... -- the records set inside are saved once, at the end. """
+        self.nBatch += 1
+        try:
+            yield self
+        finally:
+            self.nBatch -= 1
+            if self.nBatch == 0: self.save()
+
+
+def readDocs(dbFile):
+    """ The documents in a TinyDB file: {doc id : {"vals":vals, "key":key}}. """
+    if not os.path.isfile(dbFile) or os.path.getsize(dbFile) == 0: return {}
+    with open(dbFile) as f:
+        return json.load(f).get("_default", {})
+
+
+def writeDocs(dbFile, docs):
+    """ Write a TinyDB file (temp file + rename, s/t readers never see half of it). """
+    tmp = "%s.%d.tmp" % (dbFile, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump({"_default":docs}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, dbFile)
+
+
+def docIndex(docs):
+    """ {key : [doc ids]} """
+    index = {}
+    for docId, doc in docs.items():
+        index.setdefault(doc["key"], []).append(docId)
+    return index
+
+
+def newDocId(docs):
+    """ Next TinyDB document id (one more than the largest). """
+    return str(max([int(i) for i in docs] + [0]) + 1)
+
+
+def valHash(vals):
+    """ Short hash of a record's vals (None for no record), to tell if it changed. """
+    if vals is None: return None
+    return hashlib.sha1(json.dumps(vals, sort_keys=True).encode()).hexdigest()[:16]
+
+
+@contextlib.contextmanager
+def dbLock(dbFile):
+    """ Exclusive lock on a calDB file ([dbFile].lock), held while it's read, merged and written. """
+    import fcntl
+    with open(dbFile + ".lock", "a") as f:
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+
+
+def journalDir(dbFile):
+    return "%s.journal" % os.path.abspath(dbFile)
+
+
+def writeJournal(dbFile, name, ops):
+    """ Append changes to a job's journal, [dbFile].journal/[name].jsonl.  One line per change:
+        {"key":key, "vals":vals, "base":hash of the vals it replaces (None if it's new)}
+    They're written w/ one write and synced to disk before we go on (a write-ahead log),
+    s/t a job that's killed afterward doesn't lose them.  Returns the journal file.
+    The DB lock is held while appending: mergeJournals reads a journal and then removes
+    or rewrites it, so a line appended in between would be lost.
+    """
+    jDir = journalDir(dbFile)
+    if not os.path.isdir(jDir): os.makedirs(jDir, exist_ok=True)
+    jFile = "%s/%s.jsonl" % (jDir, name)
+    text = "".join(json.dumps(dict(op, time=time.time())) + "\n" for op in ops)
+    with dbLock(dbFile):
+        fd = os.open(jFile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, text.encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    return jFile
+
+
+def mergeJournals(dbFile=None, jFiles=None, force=False, verbose=True):
+    """ Apply journaled changes to a calDB file (default: all the journals of calDB-v2.json),
+    w/ the file locked, and write it once.  A key's change is a conflict, and isn't applied, if:
+        - the DB has more than one record w/ the key,
+        - journals set the key to different values, or
+        - the record in the DB isn't the one the job replaced (someone else changed it since).
+    A change that's already in the DB isn't a conflict (merging twice is fine).
+    w/ force, conflicting changes are applied anyway, the last journal (by time) wins.
+    Applied changes are removed from the journals, conflicting ones are left there.
+    Returns (number of changes applied, [(journal, key, reason)] for the conflicts).
+    """
+    dbFile = os.path.abspath(dbFile if dbFile is not None else "%s/calDB-v2.json" % latSWDir)
+    if jFiles is None:
+        jFiles = sorted(glob.glob("%s/*.jsonl" % journalDir(dbFile)), key=os.path.getmtime)
+    if len(jFiles) == 0: return 0, []
+
+    with dbLock(dbFile):
+        docs = readDocs(dbFile)
+        index = docIndex(docs)
+
+        # the changes to each key, in journal order
+        byKey = {}
+        for jFile in jFiles:
+            if not os.path.isfile(jFile): continue
+            with open(jFile) as f:
+                for iLine, line in enumerate(f):
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        print("Skipping bad line %d in %s" % (iLine+1, jFile))
+                        continue
+                    byKey.setdefault(op["key"], []).append((jFile, op))
+
+        nApplied, conflicts, keep = 0, [], {jFile:[] for jFile in jFiles}
+        for key, ops in byKey.items():
+            docIds = index.get(key, [])
+            cur = docs[docIds[0]]["vals"] if len(docIds) == 1 else None
+
+            # each journal's final value for the key, and the base of its first change
+            jobs = {}
+            for jFile, op in ops:
+                if jFile not in jobs: jobs[jFile] = [op["base"], op]
+                jobs[jFile][1] = op
+            finals = set(json.dumps(op["vals"], sort_keys=True) for base, op in jobs.values())
+
+            reason = None
+            if len(docIds) > 1:
+                reason = "%d records w/ this key in the DB" % len(docIds)
+            elif len(finals) > 1:
+                reason = "set to different values"
+            else:
+                for jFile, (base, op) in jobs.items():
+                    if op["vals"] != cur and base != valHash(cur):
+                        reason = "changed in the DB after %s read it" % os.path.basename(jFile)
+            if reason is not None:
+                conflicts.append((", ".join(os.path.basename(j) for j in jobs), key, reason))
+                if not force or len(docIds) > 1:
+                    for jFile, op in ops: keep[jFile].append(op)
+                    continue
+
+            vals = ops[-1][1]["vals"]
+            if vals != cur:
+                if len(docIds) == 0:
+                    docId = newDocId(docs)
+                    docs[docId] = {"key":key, "vals":vals}
+                    index[key] = [docId]
+                else:
+                    docs[docIds[0]]["vals"] = vals
+                nApplied += 1
 
-        for ch in chList:
+        if nApplied > 0: writeDocs(dbFile, docs)
 
-            if ch not in thD.keys():
-                bkgCov[ch].append(0)
+        # clear the journals, except for the conflicts
+        for jFile in jFiles:
+            if not os.path.isfile(jFile): continue
+            if len(keep[jFile]) == 0:
+                os.remove(jFile)
                 continue
+            tmp = jFile + ".tmp"
+            with open(tmp, "w") as f:
+                for op in keep[jFile]: f.write(json.dumps(op) + "\n")
+            os.replace(tmp, jFile)
 
-            # get threshold data for this bkg/sub/chan
-            thrMu = thD[ch][0]
-            thrSig = thD[ch][1]
-            isBad = thD[ch][2]
-            thrCut, chanCut = None, None
-            if not isBad:
-                thrCut = "trapENFCal>=%.2f " % (thrMu + 3*thrSig) # ***** 3 sigma threshold cut *****
-                bkgCov[ch].append(1)
-            else:
-                bkgCov[ch].append(0)
-
-            # create dict entry for this channel or append to existing, taking care of parentheses and OR's.
-            chanCut = "(%s && %s)" % (bRunCut, thrCut) if len(subRanges) > 1 else thrCut
-
-            if ch in bkgDict.keys() and thrCut!=None:
-                bkgDict[ch] += " || %s" % chanCut
-            elif ch not in bkgDict.keys() and thrCut!=None and len(subRanges) > 1:
-                bkgDict[ch] = "(%s" % chanCut
-            elif len(subRanges)==1 and thrCut != None:
-                bkgDict[ch] = thrCut
-
-    # close the parens for each channel entry
-    for ch in bkgDict:
-        if bkgDict[ch] is not None and len(subRanges) > 1:
-            bkgDict[ch] += ")"
-
-    # -- 2. get data for cuts tuned by calIdx (fitSlo, riseNoise)--
-    calDict = {}
-    calCov = {ch:[['fs'],['rn']] for ch in chList}
-    for cIdx in range(cIdxLo, cIdxHi+1):
-        runCovMin = cal.master[calKey][cIdx][1]
-        runCovMax = cal.master[calKey][cIdx][2]
-        runLo = rFirst if runCovMin < rFirst else runCovMin
-        runHi = rLast if rLast < runCovMax else runCovMax
-        cRunCut = "run>=%d && run<=%d" % (runLo, runHi)
-        if verbose: print("  cIdx %-3d   %d--%d" % (cIdx, runLo, runHi))
-
-        fsD = getDBRecord("fitSlo_%s_idx%d_m2s238_eff%s" % (calKey, cIdx, pctTot), False, calDB, pars)
-        rnD = getDBRecord("riseNoise_%s_ci%d_pol" % (calKey, cIdx), False, calDB, pars)
-
-        for ch in chList:
-
-            # "fitSlo_[calKey]_idx[ci]_m2s238_eff[pctTot]" : {ch : [fsCut, fs200] for ch in chList}}
-            fsCut = None
-            if fsD[ch] is not None and fsD[ch][0] > 0:
-                fsCut = "fitSlo<%.2f" % fsD[ch][0]
-                calCov[ch][0].append(1)
-            else:
-                calCov[ch][0].append(0)
-
-            # "riseNoise_%s_ci%d_pol", "vals": {ch : [a,b,c99,c,fitPass] for ch in chList} }
-            rnCut = None
-            if rnD[ch] is not None and rnD[ch][4] != False:
-                a, b, c99, c, fitPass = rnD[ch]
-                rnCut = "riseNoise < (%.2e*pow(trapENFCal,2) + %.2e*trapENFCal + %.3f)" % (a, b, c99)
-                calCov[ch][1].append(1)
-            else:
-                calCov[ch][1].append(0)
+    if verbose or len(conflicts) > 0:
+        print("Merged %d journal(s) into %s: %d records changed, %d conflicts." % (len(jFiles), dbFile, nApplied, len(conflicts)))
+        for jobs, key, reason in conflicts:
+            print("   CONFLICT %s: %s (%s)%s" % (key, reason, jobs, ", applied anyway" if force else ""))
+    return nApplied, conflicts
 
-            # set the combination channel cut
-            chanCut = None
-            if cutType == "fs" and fsCut!=None:
-                chanCut = fsCut if nCal==1 else "(%s && %s)" % (cRunCut, fsCut)
 
-            if cutType == "rn" and rnCut!=None:
-                chanCut = rnCut if nCal==1 else "(%s && %s)" % (cRunCut, rnCut)
+_calDBs = {}
 
-            if cutType == "fr" and fsCut!=None and rnCut!=None:
-                chanCut = "%s && %s" % (fsCut, rnCut) if nCal==1 else "(%s && %s && %s)" % (cRunCut, fsCut, rnCut)
+def getCalDB(dbFile=None):
+    """ The CalDB of a file (default: calDB-v2.json), shared by all the lookups in this process. """
+    dbFile = os.path.abspath(dbFile if dbFile is not None else "%s/calDB-v2.json" % latSWDir)
+    if dbFile not in _calDBs: _calDBs[dbFile] = CalDB(dbFile)
+    return _calDBs[dbFile]
 
-            # create dict entry for this channel or append to existing, taking care of parentheses and OR's.
-            if ch in calDict.keys() and chanCut!=None:
-                calDict[ch] += " || %s" % chanCut
-            elif ch not in calDict.keys() and chanCut!=None:
-                calDict[ch] = "(%s" % chanCut
 
-    # close the parens for each channel entry
-    for key in calDict:
-        calDict[key] += ")"
+def GetDBCuts(ds, bIdx, mod, cutType, calDB, pars, pctTot, verbose=True, dbKeys=None):
+    """ Load cut data from the calDB and translate to TCut format.
+    If 'dbKeys' (a list) is given, the keys of the records the cuts come from are added to it.
+    Returns bkgDict, calDict (TCut strings for each channel), bkgCov, calCov.  See CutSet.
+    """
+    cuts = CutSet(ds, bIdx, mod, cutType, calDB, pars, pctTot, verbose, dbKeys)
+    if cuts.calKey is None: return
+    return cuts.bkgDict(), cuts.calDict(), cuts.bkgCov, cuts.calCov
+
+
+class CutSet:
+    """ The PSA cuts for one bkgIdx, module, and cut type, as tables for each channel:
+        thr[ch] : rows of [runLo, runHi, threshold]          (one per good bkg sub-range)
+        cal[ch] : rows of [runLo, runHi, fitSlo, a, b, c99]  (one per good cal range)
+    A hit passes the threshold cut if it's in any row w/ trapENFCal >= threshold, and
+    the fitSlo / riseNoise cuts if it's in any row w/ fitSlo < fitSlo cut and/or
+    riseNoise < a*trapENFCal^2 + b*trapENFCal + c99 (which of them depends on the cut type).
+    If there's only one sub-range (or cal range), the run isn't checked, as in the TCuts.
+    The values are rounded the way they are in the TCut strings, s/t 'passes' and a
+    TCut from 'chanCut' select the same hits.
+    bkgCov, calCov: the coverage lists GetDBCuts always returned (1 for each good range).
+    """
+    def __init__(self, ds, bIdx, mod, cutType, calDB, pars, pctTot, verbose=True, dbKeys=None):
+        dsNum = int(ds[0]) if isinstance(ds, str) else int(ds)
+        self.cutType = "th" if cutType == '-b' else cutType
+        self.thr, self.cal = {}, {}
+        self.bkgCov, self.calCov = {}, {}
+
+        # load metadata and print a status message.
+        det = DetInfo()
+        chList = det.getGoodChanList(dsNum, mod)
+
+        bkg = BkgInfo()
+        bkgRanges = bkg.getRanges(ds)
+        rFirst, rLast = bkgRanges[bIdx][0], bkgRanges[bIdx][-1]
+        dsSub = ds if ds in ["5A","5B","5C"] else int(ds)
+        subRanges = bkg.GetSubRanges(dsSub, bIdx) # this is finicky about int/str
+        if len(subRanges) == 0: subRanges.append((rFirst, rLast))
+
+        cal = CalInfo()
+        self.calKey = "ds%d_m%d" % (dsNum, mod)
+        if ds == "5C": self.calKey = "ds5c"
+        if self.calKey not in cal.GetKeys(dsNum):
+            print("Error: Unknown cal key:",self.calKey)
+            self.calKey = None
+            return
+        calKey = self.calKey
+        cIdxLo = cal.GetCalIdx(calKey, rFirst)
+        cIdxHi = cal.GetCalIdx(calKey, rLast)
+        nCal = cIdxHi+1 - cIdxLo
+        self.thrRuns, self.calRuns = len(subRanges) > 1, nCal > 1
+
+        if verbose: print("DS%d-M%d (%s) eff%s  %s bIdx %d  %d--%d  nBkg %d  nCal %d" % (dsNum,mod,ds,pctTot,self.cutType,bIdx,rFirst,rLast,len(subRanges),nCal))
+
+        # -- 1. get data for cuts tuned by bkgIdx (thresholds) --
+        self.bkgCov = {ch:[] for ch in chList}
+        for sIdx, (runLo, runHi) in enumerate(subRanges):
+            if verbose: print("  bIdx %-3d %d %d--%d" % (bIdx, sIdx, runLo, runHi))
+
+            thKey = "thresh_ds%d_bkg%d_sub%d" % (dsNum, bIdx, sIdx)
+            thD = getDBRecord(thKey, False, calDB, pars)
+            if dbKeys is not None: dbKeys.append(thKey)
 
-    # final check
-    # for ch in sorted(bkgDict):
-        # print(ch, bkgDict[ch])
+            for ch in chList:
+                # threshold data for this bkg/sub/chan: [mu, sigma, isBad]
+                if ch not in thD.keys() or thD[ch][2]:
+                    self.bkgCov[ch].append(0)
+                    continue
+                thrMu, thrSig = thD[ch][0], thD[ch][1]
+                thr = float("%.2f" % (thrMu + 3*thrSig)) # ***** 3 sigma threshold cut *****
+                self.thr.setdefault(ch, []).append([runLo, runHi, thr])
+                self.bkgCov[ch].append(1)
+
+        # -- 2. get data for cuts tuned by calIdx (fitSlo, riseNoise)--
+        self.calCov = {ch:[['fs'],['rn']] for ch in chList}
+        for cIdx in range(cIdxLo, cIdxHi+1):
+            runCovMin = cal.master[calKey][cIdx][1]
+            runCovMax = cal.master[calKey][cIdx][2]
+            runLo = rFirst if runCovMin < rFirst else runCovMin
+            runHi = rLast if rLast < runCovMax else runCovMax
+            if verbose: print("  cIdx %-3d   %d--%d" % (cIdx, runLo, runHi))
+
+            fsKey = "fitSlo_%s_idx%d_m2s238_eff%s" % (calKey, cIdx, pctTot)
+            rnKey = "riseNoise_%s_ci%d_pol" % (calKey, cIdx)
+            fsD = getDBRecord(fsKey, False, calDB, pars)
+            rnD = getDBRecord(rnKey, False, calDB, pars)
+            if dbKeys is not None:
+                if self.cutType in ["fs","fr"]: dbKeys.append(fsKey)
+                if self.cutType in ["rn","fr"]: dbKeys.append(rnKey)
 
-    # for ch in calDict:
-        # print(ch, calDict[ch])
+            for ch in chList:
 
-    return bkgDict, calDict, bkgCov, calCov
+                # "fitSlo_[calKey]_idx[ci]_m2s238_eff[pctTot]" : {ch : [fsCut, fs200] for ch in chList}}
+                fs = np.nan
+                if fsD[ch] is not None and fsD[ch][0] > 0:
+                    fs = float("%.2f" % fsD[ch][0])
+                self.calCov[ch][0].append(int(not np.isnan(fs)))
+
+                # "riseNoise_%s_ci%d_pol", "vals": {ch : [a,b,c99,c,fitPass] for ch in chList} }
+                rn = [np.nan, np.nan, np.nan]
+                if rnD[ch] is not None and rnD[ch][4] != False:
+                    a, b, c99, c, fitPass = rnD[ch]
+                    rn = [float("%.2e" % a), float("%.2e" % b), float("%.3f" % c99)]
+                self.calCov[ch][1].append(int(not np.isnan(rn[0])))
+
+                # the combination channel cut
+                useFS = self.cutType in ["fs","fr"]
+                useRN = self.cutType in ["rn","fr"]
+                if (useFS and np.isnan(fs)) or (useRN and np.isnan(rn[0])) or not (useFS or useRN):
+                    continue
+                self.cal.setdefault(ch, []).append([runLo, runHi, fs if useFS else np.nan] + (rn if useRN else [np.nan]*3))
+
+        self.thr = {ch:np.array(rows) for ch, rows in self.thr.items()}
+        self.cal = {ch:np.array(rows) for ch, rows in self.cal.items()}
+
+    def bkgCut(self, ch):
+        """ TCut string for the threshold of a channel, or None. """
+        if ch not in self.thr: return None
+        cuts = []
+        for runLo, runHi, thr in self.thr[ch]:
+            thrCut = "trapENFCal>=%.2f " % thr
+            cuts.append("(run>=%d && run<=%d && %s)" % (runLo, runHi, thrCut) if self.thrRuns else thrCut)
+        return "(%s)" % " || ".join(cuts) if self.thrRuns else cuts[0]
+
+    def calCut(self, ch):
+        """ TCut string for the fitSlo and/or riseNoise cut of a channel, or None. """
+        if ch not in self.cal: return None
+        cuts = []
+        for runLo, runHi, fs, a, b, c99 in self.cal[ch]:
+            parts = []
+            if not np.isnan(fs): parts.append("fitSlo<%.2f" % fs)
+            if not np.isnan(a): parts.append("riseNoise < (%.2e*pow(trapENFCal,2) + %.2e*trapENFCal + %.3f)" % (a, b, c99))
+            if self.calRuns: parts.insert(0, "run>=%d && run<=%d" % (runLo, runHi))
+            cuts.append("(%s)" % " && ".join(parts) if self.calRuns else " && ".join(parts))
+        return "(%s)" % " || ".join(cuts)
+
+    def bkgDict(self):
+        return {ch:self.bkgCut(ch) for ch in self.thr}
+
+    def calDict(self):
+        return {ch:self.calCut(ch) for ch in self.cal}
+
+    def chanCut(self, ch):
+        """ The full TCut of a channel's cut file (see lat2.applyCuts), or None if the channel
+        doesn't have one for this cut type.  Thresholds are required.
+        """
+        if ch not in self.thr: return None
+        chanCut = "channel==%d && %s" % (ch, self.bkgCut(ch))
+        if self.cutType == "th": return chanCut
+        if ch not in self.cal: return None
+        if self.cutType == "fs": return chanCut + "&& fitSlo>0 && %s" % self.calCut(ch)
+        return chanCut + "&& %s" % self.calCut(ch)
+
+    def channels(self):
+        """ The channels w/ a cut file for this cut type. """
+        return [ch for ch in sorted(self.thr) if self.chanCut(ch) is not None]
+
+    def passes(self, hits, ch=None):
+        """ Which hits pass the chanCut of their channel (or only of channel 'ch').
+        hits: {name:numpy array} w/ one entry per hit, for run, channel, trapENFCal,
+        and fitSlo/riseNoise if the cut type uses them (see readHits).
+        """
+        chan, run, enf = hits["channel"], hits["run"], hits["trapENFCal"]
+        mask = np.zeros(len(chan), dtype=bool)
+        for c in (self.channels() if ch is None else [ch]):
+            if self.chanCut(c) is None: continue
+            idx = np.where(chan == c)[0]
+            if len(idx) == 0: continue
+            r, e = run[idx], enf[idx]
+
+            ok = np.zeros(len(idx), dtype=bool)
+            for runLo, runHi, thr in self.thr[c]:
+                inRange = (r >= runLo) & (r <= runHi) if self.thrRuns else True
+                ok |= inRange & (e >= thr)
+
+            if self.cutType != "th":
+                calOK = np.zeros(len(idx), dtype=bool)
+                for runLo, runHi, fs, a, b, c99 in self.cal[c]:
+                    sel = (r >= runLo) & (r <= runHi) if self.calRuns else np.ones(len(idx), dtype=bool)
+                    if not np.isnan(fs): sel &= hits["fitSlo"][idx] < fs
+                    if not np.isnan(a): sel &= hits["riseNoise"][idx] < (a*np.power(e,2) + b*e + c99)
+                    calOK |= sel
+                ok &= calOK
+                if self.cutType == "fs": ok &= hits["fitSlo"][idx] > 0
+
+            mask[idx] = ok
+        return mask
+
+
+def readHits(tree, names=("channel","run","trapENFCal","fitSlo","riseNoise")):
+    """ Numpy arrays w/ the value of each branch in 'names' for every hit in a tree (or chain),
+    plus the tree entry of each hit ("entry"), e.g. for CutSet.passes.
+    Scalar branches like run are repeated for each hit in the entry.
+    Each TTree::Draw reads the entry number and up to 3 of the branches.
+    """
+    import waveLibs as wl
+    names = list(names)
+    hits = {}
+    for i in range(0, len(names), 3):
+        group = names[i:i+3]
+        expr = ":".join(["Entry$"] + group)
+        n = tree.Draw(expr, "", "goff")
+        if n > tree.GetEstimate():
+            tree.SetEstimate(n + 1)
+            n = tree.Draw(expr, "", "goff")
+        bufs = [tree.GetV1(), tree.GetV2(), tree.GetV3(), tree.GetV4()]
+        ent = wl.bufferView(bufs[0], n).astype(np.int64)
+        if "entry" in hits and not np.array_equal(ent, hits["entry"]):
+            raise ValueError("readHits: %s don't have one value per hit" % ",".join(group))
+        hits["entry"] = ent
+        for j, name in enumerate(group):
+            hits[name] = wl.bufferView(bufs[j+1], n).copy()
+    return hits
 
 
 def test():
@@ -1030,5 +1676,38 @@ def test():
 
 
 
+def testJournals(nRec=1000, nWriters=2):
+    """ Journal-mode jobs append records while mergeJournals runs over and over.
+    Every record has to end up in the DB, and the journals have to end up empty.
+    """
+    import tempfile, shutil, subprocess, sys
+    tmp = tempfile.mkdtemp()
+    dbFile = "%s/calDB-test.json" % tmp
+    writeDocs(dbFile, {"1":{"key":"start", "vals":{"0":[0]}}})
+    code = ("import sys; sys.path.insert(0, %r); import dsi\n"
+            "c = dsi.CalDB(sys.argv[1], journal='job' + sys.argv[2])\n"
+            "for i in range(int(sys.argv[3])):\n"
+            "    dsi.setDBRecord({'key':'job%%s_%%d' %% (sys.argv[2], i), 'vals':{600:[i]}}, calDB=c)\n"
+            ) % os.path.dirname(os.path.abspath(__file__))
+    procs = [subprocess.Popen([sys.executable, "-c", code, dbFile, str(j), str(nRec)]) for j in range(nWriters)]
+    nMerge = 0
+    while any(p.poll() is None for p in procs):
+        mergeJournals(dbFile, verbose=False)
+        nMerge += 1
+    assert all(p.returncode == 0 for p in procs), "a writer failed"
+    n, conflicts = mergeJournals(dbFile, verbose=False)
+    assert len(conflicts) == 0, conflicts
+
+    calDB = CalDB(dbFile)
+    missing = ["job%d_%d" % (j, i) for j in range(nWriters) for i in range(nRec)
+               if calDB.get("job%d_%d" % (j, i)) != {600:[i]}]
+    assert len(missing) == 0, "%d of %d records lost, e.g. %s" % (len(missing), nRec*nWriters, missing[:3])
+    assert len(glob.glob("%s/*.jsonl" % journalDir(dbFile))) == 0, "journals left over"
+    shutil.rmtree(tmp)
+    print("testJournals: %d records from %d jobs, %d merges while they ran, none lost." % (nRec*nWriters, nWriters, nMerge))
+
+
 if __name__=="__main__":
-    test()
+    import sys
+    if "-testJournals" in sys.argv: testJournals()
+    else: test()
@@ -7,6 +7,9 @@
 # NOTE: lines in jobs.list can be ignored with the # character.
 #
 # Clint Wiseman, USC, Jan. 2018.
+#
+# NOTE: superseded by jobPump.py, which starts jobs as soon as a slot is free,
+# orders them by stage (split before lat, etc.), retries failures and keeps a state file.
 
 set -u ;         # exit if you try to use an uninitialized variable
 set -e ;         # exit if any statement returns a non-true return value
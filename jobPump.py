@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+""" 'jobPump.py': run LAT job lists on a local process pool.
+    Replaces job-pump.sh (which polled pgrep/uptime/free every 60 sec), and can run
+    the lat-jobs.py job queue (job.q) directly instead of submitting it from cron.
+
+    Usage:
+        ./jobPump.py [-n nProc] [-r nRetry] [-m minFreeGB] [-f] [-dry] jobs1.ls [jobs2.ls ...]
+            -n   : number of jobs to run at once (default: number of cores)
+            -r   : number of times to retry a failed job (default: 1)
+            -m   : don't start new jobs if the free memory is below this (GB)
+            -f   : rerun jobs that already succeeded
+            -dry : print the jobs, their stages and dependencies, and what would run
+
+    Lines in a job list are bash commands, and '#' lines are skipped.  A trailing '>& logFile'
+    (or '> logFile 2>&1') is the job's log, otherwise it goes in ./logs/pump.
+    Jobs are put in stages by the program they run:
+        skim -> wave -> split -> lat -> lat2 -> lat3 -> expo   (thresh runs after skim)
+    A job starts when the jobs in the stage before it (from any of the lists) have succeeded.
+    If the jobs name their data set and sub-range or run (e.g. '-sub 1 5', '-r 1 5', 'DS1_5',
+    'DS1_run9422'), a job only waits for the jobs w/ the same ones.
+    Failed jobs are retried, and if a job fails for good, the jobs that depend on it are skipped.
+    Each list has a state file (jobs1.ls -> jobs1.state.json) w/ the status, exit code, tries,
+    run time and log of each job.  Jobs that already succeeded are skipped the next time.
+"""
+import sys, os, re, time, json
+import subprocess as sp
+
+# stage: regex on the command
+stageRules = [
+    ("skim",   r"skim_mjd_data"),
+    ("wave",   r"wave-skim"),
+    ("thresh", r"auto-thresh"),
+    ("split",  r"lat-jobs\.py.*-split\b"),
+    ("lat",    r"(^|[\s/])lat\.py"),
+    ("lat2",   r"lat2\.py"),
+    ("lat3",   r"lat3\.py"),
+    ("expo",   r"lat-expo\.py"),
+]
+stageDeps = {"skim":[], "wave":["skim"], "thresh":["skim"], "split":["wave"], "lat":["split"],
+             "lat2":["lat"], "lat3":["lat2"], "expo":["lat3"], None:[]}
+
+# (ds, "sub" or "run", number): regex on the command, in order of priority
+keyRules = [
+    (r"DS(\d+)_run(\d+)", "run"),
+    (r"DS(\d+)_(\d+)", "sub"),
+    (r"-sub (\d+) (\d+)", "sub"),
+    (r"-run (\d+) (\d+)", "run"),
+    (r"-r (\d+) (\d+)", "sub"),
+    (r"-f (\d+) (\d+)", "run"),
+    (r"skim_mjd_data (\d+) (\d+)", "sub"),
+]
+logRules = [r"\s*>\s*(\S+)\s+2>&1\s*$", r"\s*(?<!\d)(?:>&|&>)\s*(\S+)\s*$"]
+
+pollDelay = 0.2 # sec
+
+
+class Job:
+    def __init__(self, cmd, listFile, line):
+        self.listFile, self.line, self.text = listFile, line, cmd
+        self.cmd, self.log = cmd, None
+        for rule in logRules:
+            m = re.search(rule, cmd)
+            if m is not None:
+                self.cmd, self.log = cmd[:m.start()], m.group(1)
+                break
+        if self.log is None:
+            self.log = "./logs/pump/%s-%d.txt" % (os.path.splitext(os.path.basename(listFile))[0], line)
+        self.stage = getStage(self.cmd)
+        self.key = getKey(self.cmd)
+        self.deps = []
+        self.status, self.tries, self.proc = "pending", 0, None
+        self.state = {}
+
+    def __repr__(self): return self.cmd
+
+
+def getStage(cmd):
+    for stage, rule in stageRules:
+        if re.search(rule, cmd): return stage
+    return None
+
+
+def getKey(cmd):
+    for rule, kind in keyRules:
+        m = re.search(rule, cmd)
+        if m is not None: return (int(m.group(1)), kind, int(m.group(2)))
+    return None
+
+
+def stateName(listFile):
+    return os.path.splitext(listFile)[0] + ".state.json"
+
+
+def loadJobs(listFiles):
+    """ Read the job lists and their state files, and find each job's dependencies. """
+    jobs = []
+    for listFile in listFiles:
+        state = {}
+        if os.path.isfile(stateName(listFile)):
+            with open(stateName(listFile)) as f:
+                state = json.load(f)
+        with open(listFile) as f:
+            for i, line in enumerate(f):
+                line = line.strip()
+                if len(line)==0 or line.startswith("#"): continue
+                job = Job(line, listFile, i+1)
+                job.state = state.get(line, {})
+                jobs.append(job)
+
+    byStage = {}
+    for job in jobs: byStage.setdefault(job.stage, []).append(job)
+
+    def upstream(stage):
+        """ The nearest earlier stages that have jobs in this run. """
+        ups = []
+        for dep in stageDeps.get(stage, []):
+            ups.extend([dep] if dep in byStage else upstream(dep))
+        return ups
+
+    for job in jobs:
+        for stage in upstream(job.stage):
+            job.deps.extend(up for up in byStage[stage] if job.key is None or up.key is None or up.key == job.key)
+    return jobs
+
+
+def saveState(jobs, listFile):
+    """ Write the state of all the jobs in a list (atomically). """
+    state = {job.text:job.state for job in jobs if job.listFile == listFile}
+    tmp = stateName(listFile) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, stateName(listFile))
+
+
+def freeMemory():
+    """ Available memory (GB), or None if we can't tell. """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"): return int(line.split()[1]) / 1e6
+    except IOError:
+        pass
+    return None
+
+
+def run(listFiles, nProc=None, nRetry=1, minFree=0., force=False, dryRun=False, verbose=True):
+    """ Run the jobs in listFiles.  Returns the jobs (w/ .status: done, failed, or skipped). """
+    nProc = nProc if nProc is not None else os.cpu_count()
+    jobs = loadJobs(listFiles)
+    for job in jobs:
+        if job.state.get("status")=="done" and not force:
+            job.status = "done"
+
+    if dryRun:
+        for job in jobs:
+            print("%-7s %-6s %-18s deps %-4d %s" % ("skip" if job.status=="done" else "run", job.stage, job.key, len(job.deps), job.cmd))
+        print("%d jobs, %d to run." % (len(jobs), sum(job.status!="done" for job in jobs)))
+        return jobs
+
+    if verbose:
+        print("Job pump: %d jobs in %s.  %d processes, %d retries.  %d already done." % (
+            len(jobs), ",".join(listFiles), nProc, nRetry, sum(job.status=="done" for job in jobs)))
+    running, start = [], time.time()
+    while True:
+        changed = False
+
+        # check the running jobs
+        for job in list(running):
+            rc = job.proc.poll()
+            if rc is None: continue
+            running.remove(job)
+            job.logFile.close()
+            job.state.update({"exit":rc, "wall":time.time()-job.start, "tries":job.tries})
+            if rc == 0:
+                job.status = job.state["status"] = "done"
+            elif job.tries <= nRetry:
+                job.status = "pending"
+                if verbose: print("Failed (exit %d), retrying: %s" % (rc, job.cmd))
+            else:
+                job.status = job.state["status"] = "failed"
+                if verbose: print("Failed (exit %d): %s  log: %s" % (rc, job.cmd, job.log))
+            saveState(jobs, job.listFile)
+            changed = True
+
+        # skip the jobs that depend on failed ones
+        for job in jobs:
+            if job.status=="pending" and any(dep.status in ("failed","skipped") for dep in job.deps):
+                job.status = job.state["status"] = "skipped"
+                if verbose: print("Skipped (a dependency failed):", job.cmd)
+                saveState(jobs, job.listFile)
+                changed = True
+
+        # start new jobs
+        for job in jobs:
+            if len(running) >= nProc: break
+            if job.status != "pending" or any(dep.status != "done" for dep in job.deps): continue
+            mem = freeMemory()
+            if len(running) > 0 and mem is not None and mem < minFree: break
+            launch(job)
+            running.append(job)
+            saveState(jobs, job.listFile)
+            if verbose: print("Started (%d running): %s" % (len(running), job.cmd))
+            changed = True
+
+        if len(running)==0 and not changed: break
+        if not changed: time.sleep(pollDelay)
+
+    nStat = {stat:sum(job.status==stat for job in jobs) for stat in ["done","failed","skipped","pending"]}
+    if verbose:
+        print("Job pump finished in %.0f sec.  done %d  failed %d  skipped %d  not run %d" % (
+            time.time()-start, nStat["done"], nStat["failed"], nStat["skipped"], nStat["pending"]))
+    return jobs
+
+
+def launch(job):
+    logDir = os.path.dirname(job.log)
+    if logDir and not os.path.isdir(logDir): os.makedirs(logDir)
+    job.logFile = open(job.log, "w")
+    job.proc = sp.Popen(["bash", "-c", job.cmd], stdout=job.logFile, stderr=sp.STDOUT)
+    job.tries += 1
+    job.start = time.time()
+    job.status = job.state["status"] = "running"
+    job.state.update({"start":time.strftime('%X %x %Z'), "log":job.log})
+
+
+def test():
+    """ Run a few small job lists in a temp directory and check the order, retries and state. """
+    import tempfile, shutil
+    tmp = tempfile.mkdtemp()
+    split, lat = "%s/split.ls" % tmp, "%s/lat.ls" % tmp
+    with open(split, "w") as f:
+        f.write("sleep 0.5; echo lat-jobs.py -sub 1 5 -split >& %s/s5.txt\n" % tmp)
+        f.write("echo lat-jobs.py -sub 1 6 -split >& %s/s6.txt\n" % tmp)
+        f.write("# a comment\n")
+        f.write("echo lat-jobs.py -sub 1 7 -split; false\n")
+    with open(lat, "w") as f:
+        f.write("echo ./lat.py -b -r 1 5 > %s/l5.txt 2>&1\n" % tmp)
+        f.write("echo ./lat.py -b -r 1 6\n")
+        f.write("echo ./lat.py -b -r 1 7\n")
+        f.write("echo ./lat.py -b -p %s/split.root\n" % tmp) # no key: waits for all the split jobs
+        f.write("test -f %s/flag || (touch %s/flag; exit 3)\n" % (tmp, tmp)) # no stage, fails once
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    try:
+        jobs = run([lat, split], nProc=2, nRetry=1, verbose=False)
+        byCmd = {job.cmd.strip():job for job in jobs}
+        s5 = byCmd["sleep 0.5; echo lat-jobs.py -sub 1 5 -split"]
+        s6, s7 = byCmd["echo lat-jobs.py -sub 1 6 -split"], byCmd["echo lat-jobs.py -sub 1 7 -split; false"]
+        l5, l6, l7 = [byCmd["echo ./lat.py -b -r 1 %d" % n] for n in (5,6,7)]
+        lAll = byCmd["echo ./lat.py -b -p %s/split.root" % tmp]
+        flag = byCmd["test -f %s/flag || (touch %s/flag; exit 3)" % (tmp, tmp)]
+
+        # status, and skipping the jobs that depend on a failed one
+        status = {job.cmd.strip():job.status for job in jobs}
+        assert [job.status for job in (s5, s6, l5, l6, flag)] == ["done"]*5, status
+        assert s7.status == "failed" and s7.tries == 2, (s7.status, s7.tries)
+        assert l7.status == "skipped" and lAll.status == "skipped", status
+
+        # dependencies: keyed jobs wait only for the same sub-range, unkeyed ones for the whole stage
+        assert [d.key for d in l5.deps] == [(1,"sub",5)] and [d.key for d in l6.deps] == [(1,"sub",6)], (l5.deps, l6.deps)
+        assert len(lAll.deps) == 3 and flag.deps == [], (lAll.deps, flag.deps)
+        assert l5.start >= s5.start + s5.state["wall"], "lat 1-5 started before split 1-5 was done"
+
+        # retries, logs and the state file
+        assert flag.tries == 2 and flag.state["exit"] == 0, flag.state
+        assert os.path.isfile(tmp+"/s5.txt") and os.path.isfile(tmp+"/l5.txt"), os.listdir(tmp)
+        assert sorted(os.listdir(tmp+"/logs/pump")) == ["lat-2.txt", "lat-5.txt", "split-4.txt"], os.listdir(tmp+"/logs/pump")
+        state = json.load(open(stateName(lat)))
+        assert state[flag.text.strip()]["tries"] == 2 and state[l7.text.strip()]["status"] == "skipped", state
+
+        # second run: only the failed job runs again
+        jobs2 = run([lat, split], nProc=2, verbose=False)
+        started = [job.cmd for job in jobs2 if job.tries > 0]
+        assert started == [s7.cmd], started
+        print("jobPump test OK")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+def main(argv):
+    if len(argv)==0:
+        print(__doc__)
+        return
+    nProc, nRetry, minFree, force, dryRun, listFiles = None, 1, 0., False, False, []
+    skip = False
+    for i, opt in enumerate(argv):
+        if skip:
+            skip = False
+            continue
+        if opt == "-n": nProc, skip = int(argv[i+1]), True
+        elif opt == "-r": nRetry, skip = int(argv[i+1]), True
+        elif opt == "-m": minFree, skip = float(argv[i+1]), True
+        elif opt == "-f": force = True
+        elif opt == "-dry": dryRun = True
+        elif opt == "-test":
+            test()
+            return
+        else: listFiles.append(opt)
+    jobs = run(listFiles, nProc, nRetry, minFree, force, dryRun)
+    if any(job.status in ("failed","skipped") for job in jobs): sys.exit(1)
+
+
+if __name__=="__main__":
+    main(sys.argv[1:])
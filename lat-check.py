@@ -7,16 +7,16 @@ Make sure no entries are being dropped, all files exist,
 no branches are corrupted, etc.
 =================== C. Wiseman (USC) ===================
 """
-import sys, os
+import sys, os, json
 sys.argv.append("-b")
-import tinydb as db
 import numpy as np
 
 import waveLibs as wl
 import dsi
-bkg = dsi.BkgInfo()
-cal = dsi.CalInfo()
-det = dsi.DetInfo()
+import buildGraph as bg
+bkg = dsi.Lazy(dsi.BkgInfo)
+cal = dsi.Lazy(dsi.CalInfo)
+det = dsi.Lazy(dsi.DetInfo)
 
 from ROOT import TFile, TTree, MGTWaveform
 
@@ -32,14 +32,23 @@ def main(argv):
     Can submit these commands as separate batch jobs:
         ./lat-check.py -all
         ./lat-check.py -c -all
+    Fast check of the whole skim -> wave -> split -> lat chain (file headers only, see checkChain):
+        ./lat-check.py [-c] [-ds dsNum] [-j nProc] [-o summary.txt] -fast
     """
-    global checkCal
-    checkCal = False
+    global checkCal, nProc, dsSel, sumFile
+    checkCal, nProc, dsSel, sumFile = False, None, None, None
     if checkCal: print("Skip DS6 cal?",skipDS6Cal)
     if testMode: print("Test mode active.")
 
+    # read the settings first, s/t they apply wherever they are on the command line
     for i,opt in enumerate(argv):
         if opt == "-c": checkCal = True
+        if opt == "-j": nProc = int(argv[i+1])
+        if opt == "-ds": dsSel = int(argv[i+1])
+        if opt == "-o": sumFile = argv[i+1]
+
+    for i,opt in enumerate(argv):
+        if opt == "-fast": checkChain()
         if opt == "-s": checkSkim()
         if opt == "-w": checkWave()
         if opt == "-p": checkSplit()
@@ -182,6 +191,7 @@ def checkWave():
 
 
     # check first and last few entries of every file
+    blBuf = np.zeros(0) # reused for the baseline-subtracted wf's
     for idx, fname in enumerate(fileList[:fLimit]):
         f = TFile(fname)
         t = f.Get("skimTree")
@@ -232,7 +242,8 @@ def checkWave():
                 # run the LAT routine to convert into numpy arrays
                 truncLo, truncHi = 0, 2
                 if ds==6 or ds==2: truncLo = 4
-                signal = wl.processWaveform(wf, truncLo, truncHi)
+                if len(blBuf) < wf.GetLength(): blBuf = np.zeros(wf.GetLength())
+                signal = wl.processWaveform(wf, truncLo, truncHi, blBuf)
 
         if verbose:
             print("%d/%d  %s  nEnt %d" % (idx, len(fileList[:fLimit]), fname.split("/")[-1], t.GetEntries()))
@@ -355,6 +366,7 @@ def checkLAT():
 
                 sList = dsi.getSplitList("%s/splitSkimDS%d_%d*" % (dsi.splitDir, ds, sub), sub)
                 latList = dsi.getSplitList("%s/latSkimDS%d_%d*" % (dsi.latDir, ds, sub), sub)
+                sList = shardList("%s/latSkimDS%d_%d" % (dsi.latDir, ds, sub), sList)
                 if len(sList) != len(latList):
                     print("Error: ds %d sub %d.  Found %d split files but %d lat files." % (ds,sub,len(sList),len(latList)))
 
@@ -374,6 +386,7 @@ def checkLAT():
 
                     sList = dsi.getSplitList("%s/splitSkimDS%d_run%d*" % (dsi.calSplitDir, ds, run), run)
                     latList = dsi.getSplitList("%s/latSkimDS%d_run%d*" % (dsi.calLatDir, ds, run), run)
+                    sList = shardList("%s/latSkimDS%d_run%d" % (dsi.calLatDir, ds, run), sList)
                     if len(sList) != len(latList):
                         print("Error: ds %d  sub %d  run %d.  Found %d split files but %d lat files." % (ds,sub,run,len(sList),len(latList)))
 
@@ -397,6 +410,7 @@ def checkLAT():
 
 
     # loop over files, repeating the same checks in checkWave
+    blBuf = np.zeros(0) # reused for the baseline-subtracted wf's
     for idx, fname in enumerate(fileList[:fLimit]):
         f = TFile(fname)
         t = f.Get("skimTree")
@@ -406,6 +420,13 @@ def checkLAT():
             print("No entries in file",fname)
             continue
 
+        # files from killed lat.py jobs (rerun lat.py to resume them)
+        prog = f.Get("progress")
+        if prog:
+            prog = json.loads(prog.GetTitle())
+            if prog["nDone"] is None or prog["nDone"] < prog["nList"]:
+                print("Partial file, %s of %d entries done: %s" % (prog["nDone"], prog["nList"], fname))
+
         brSingle, brVector, brNames = [], [], []
         for br in t.GetListOfBranches():
             if "vector" in br.GetClassName():
@@ -451,7 +472,8 @@ def checkLAT():
                 # run the LAT routine to convert into numpy arrays
                 truncLo, truncHi = 0, 2
                 if ds==6 or ds==2: truncLo = 4
-                signal = wl.processWaveform(wf, truncLo, truncHi)
+                if len(blBuf) < wf.GetLength(): blBuf = np.zeros(wf.GetLength())
+                signal = wl.processWaveform(wf, truncLo, truncHi, blBuf)
 
         if verbose:
             print("%d/%d  %s  nEnt %d" % (idx, len(fileList[:fLimit]), fname.split("/")[-1], t.GetEntries()))
@@ -459,6 +481,225 @@ def checkLAT():
         f.Close()
 
 
+# file metadata from previous checks, keyed by path, w/ the size and time of the file when it was read.
+# kept w/ the FileIndex and MetaIndex files (dsi.indexDir), not in the LAT directory.
+cacheFile = "%s/checkCache.json" % dsi.indexDir
+
+def fileInfo(fname):
+    """ Read a file's header, key list, and the entry count of each branch.
+    No baskets are read, so this takes about the same time for any size of file.
+    """
+    from ROOT import gROOT
+    gROOT.ProcessLine("gErrorIgnoreLevel = 3001;")
+    info = {"file":fname, "error":None, "nEnt":0, "cut":None, "progress":None, "branches":[], "badBranches":[]}
+    if not os.path.isfile(fname):
+        info["error"] = "missing"
+        return info
+    f = TFile(fname)
+    if f.IsZombie():
+        info["error"] = "zombie"
+        return info
+    info["recovered"] = f.TestBit(TFile.kRecovered)
+    info["keys"] = [key.GetName() for key in f.GetListOfKeys()]
+    t = f.Get("skimTree")
+    if not t:
+        info["error"] = "no skimTree"
+        f.Close()
+        return info
+    info["nEnt"] = t.GetEntries()
+    brEnt = {br.GetName():br.GetEntries() for br in t.GetListOfBranches()}
+    info["branches"] = sorted(brEnt)
+    info["badBranches"] = sorted(br for br in brEnt if brEnt[br] != info["nEnt"])
+    cut = f.Get("theCut")
+    info["cut"] = cut.GetTitle() if cut else None
+    prog = f.Get("progress")
+    info["progress"] = json.loads(prog.GetTitle()) if prog else None
+    f.Close()
+    return info
+
+
+def scanFiles(fileList, nProc=None):
+    """ fileInfo for each file, from the cache if the file hasn't changed since,
+    otherwise read w/ a pool of nProc processes (default: all cores).
+    """
+    cache = {}
+    if os.path.isfile(cacheFile):
+        with open(cacheFile) as f:
+            cache = json.load(f)
+    infos, toScan = {}, []
+    for fname in fileList:
+        stat = bg.fileStat(fname)
+        if fname in cache and stat is not None and cache[fname]["stat"] == stat:
+            infos[fname] = cache[fname]["info"]
+        else:
+            toScan.append(fname)
+    print("%d files, %d cached, reading %d." % (len(fileList), len(fileList)-len(toScan), len(toScan)))
+
+    if len(toScan) > 0:
+        from multiprocessing import Pool
+        pool = Pool(nProc)
+        for info in pool.imap_unordered(fileInfo, toScan, chunksize=4):
+            infos[info["file"]] = info
+            stat = bg.fileStat(info["file"])
+            if stat is not None: cache[info["file"]] = {"stat":stat, "info":info}
+        pool.close()
+        pool.join()
+        # if indexDir isn't writable, the next check just reads the files again
+        try:
+            os.makedirs(dsi.indexDir, exist_ok=True)
+            tmp = "%s.%d.tmp" % (cacheFile, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp, cacheFile)
+        except OSError:
+            pass
+    return infos
+
+
+def chainGroups():
+    """ The files at each stage for each bkg subDS (or cal run, w/ -c).
+    Returns a list of dicts: {name, skim, wave, split:{idx:file}, lat:{idx:file}, splitMan, latMan}
+    """
+    def group(name, ds, skim, wave, splitPat, latPat, num, sDir, lDir, base):
+        return {"name":name, "ds":ds, "skim":skim, "wave":wave,
+            "split":dsi.getSplitList(splitPat, num), "lat":dsi.getSplitList(latPat, num),
+            "splitMan":"%s/manifest_split%s.json" % (sDir, base), "latMan":"%s/manifest_lat%s.json" % (lDir, base)}
+    groups = []
+    if not checkCal:
+        dsMap = bkg.dsMap()
+        for ds in dsMap:
+            if dsSel is not None and ds != dsSel: continue
+            for sub in range(dsMap[ds]+1):
+                base = "SkimDS%d_%d" % (ds, sub)
+                groups.append(group("DS%d-%d" % (ds, sub), ds,
+                    "%s/skimDS%d_%d_low.root" % (dsi.skimDir, ds, sub), "%s/wave%s.root" % (dsi.waveDir, base),
+                    "%s/split%s*" % (dsi.splitDir, base), "%s/lat%s*" % (dsi.latDir, base), sub, dsi.splitDir, dsi.latDir, base))
+    else:
+        for key in cal.GetKeys():
+            ds = int(key[2])
+            if skipDS6Cal and ds==6: continue
+            if dsSel is not None and ds != dsSel: continue
+            for cIdx in range(cal.GetIdxs(key)):
+                for run in cal.GetCalList(key, cIdx):
+                    base = "SkimDS%d_run%d" % (ds, run)
+                    groups.append(group("DS%d-run%d" % (ds, run), ds,
+                        "%s/skimDS%d_run%d_low.root" % (dsi.calSkimDir, ds, run), "%s/wave%s.root" % (dsi.calWaveDir, base),
+                        "%s/split%s*" % (dsi.calSplitDir, base), "%s/lat%s*" % (dsi.calLatDir, base), run, dsi.calSplitDir, dsi.calLatDir, base))
+    return groups
+
+
+def fileProblems(info, stage):
+    """ Problems w/ a single file, from its fileInfo. """
+    if info["error"] is not None: return [info["error"]]
+    probs = []
+    if info["recovered"]: probs.append("recovered (file wasn't closed)")
+    if info["nEnt"] == 0: probs.append("no entries")
+    if len(info["badBranches"]) > 0: probs.append("entry count differs in branches: %s" % ",".join(info["badBranches"]))
+    if stage in ["split","lat"] and info["cut"] is None: probs.append("no TCut")
+    if stage == "lat":
+        if "fitSlo" not in info["branches"]: probs.append("no fitSlo branch")
+        prog = info["progress"]
+        if prog is not None and (prog["nDone"] is None or prog["nDone"] < prog["nList"]):
+            probs.append("partial, %s of %d entries done" % (prog["nDone"], prog["nList"]))
+    return probs
+
+
+def chainProblems(grp, infos):
+    """ Check that no entries are lost from one stage to the next in a group (see chainGroups).
+    Returns {file:[problems]} for every file in the group, and the rows of the summary table.
+    """
+    probs, rows = {}, []
+    def nEnt(fname): return infos[fname]["nEnt"] if fname in infos else 0
+    def add(fname, prob): probs.setdefault(fname, []).append(prob)
+
+    skim, wave = grp["skim"], grp["wave"]
+    for fname, stage in [(skim,"skim"), (wave,"wave")]:
+        for prob in fileProblems(infos[fname], stage): add(fname, prob)
+    if nEnt(wave) > nEnt(skim): add(wave, "more entries (%d) than the skim file (%d)" % (nEnt(wave), nEnt(skim)))
+    wCut = infos[wave]["cut"]
+
+    # split files (or the ranges of the waveSkim file they were planned as)
+    splitMan, chunks = None, {}
+    if os.path.isfile(grp["splitMan"]):
+        with open(grp["splitMan"]) as f: splitMan = json.load(f)
+        chunks = {ch["idx"]:ch for ch in splitMan["chunks"]}
+    nExp = splitMan["nList"] if splitMan is not None else nEnt(wave)
+    split = grp["split"]
+    for idx, fname in sorted(split.items()):
+        for prob in fileProblems(infos[fname], "split"): add(fname, prob)
+        if wCut is not None and infos[fname]["cut"] not in [None, wCut]: add(fname, "TCut differs from the wave file")
+        if idx in chunks and nEnt(fname) != chunks[idx]["hi"] - chunks[idx]["lo"]:
+            add(fname, "%d entries, manifest says %d" % (nEnt(fname), chunks[idx]["hi"] - chunks[idx]["lo"]))
+    nSplit = sum(nEnt(f) for f in split.values())
+    if len(split) > 0 and nSplit != nExp:
+        add(wave, "split files have %d entries, expected %d" % (nSplit, nExp))
+
+    # lat files: one per split file, or per shard
+    expected = {idx:nEnt(f) for idx, f in split.items()}
+    if len(split)==0 and os.path.isfile(grp["latMan"]):
+        with open(grp["latMan"]) as f:
+            expected = {sh["idx"]:sh["hi"]-sh["lo"] for sh in json.load(f)["shards"]}
+    lat = grp["lat"]
+    for idx in sorted(set(expected) | set(lat)):
+        if idx not in lat:
+            add(split.get(idx, wave), "no lat file for %s %d" % ("split file" if idx in split else "shard", idx))
+            continue
+        fname = lat[idx]
+        for prob in fileProblems(infos[fname], "lat"): add(fname, prob)
+        if idx not in expected: add(fname, "no split file or shard for this lat file")
+        elif nEnt(fname) != expected[idx]: add(fname, "%d entries, input has %d" % (nEnt(fname), expected[idx]))
+        if wCut is not None and infos[fname]["cut"] not in [None, wCut]: add(fname, "TCut differs from the wave file")
+
+    for stage, fList in [("skim",[skim]), ("wave",[wave]), ("split",[f for i,f in sorted(split.items())]), ("lat",[f for i,f in sorted(lat.items())])]:
+        for fname in fList:
+            rows.append((grp["name"], stage, fname, nEnt(fname), probs.get(fname, [])))
+    return probs, rows
+
+
+def checkChain():
+    """ ./lat-check.py [-c] [-ds dsNum] [-j nProc] [-o summary.txt] -fast
+    Check every file in the skim -> wave -> split -> lat chain from its metadata only
+    (header, keys, branch entry counts), reading the files in parallel, and cross-check
+    the entry totals between stages.  Files that haven't changed since the last check
+    aren't read again (see scanFiles).  Prints a summary table w/ the status of each file.
+    """
+    print("Checking the file chain.  Cal?", checkCal)
+    groups = chainGroups()
+    fileList = []
+    for grp in groups:
+        fileList.extend([grp["skim"], grp["wave"]] + list(grp["split"].values()) + list(grp["lat"].values()))
+    infos = scanFiles(fileList, nProc)
+
+    rows = []
+    for grp in groups:
+        rows.extend(chainProblems(grp, infos)[1])
+
+    lines = ["%-14s %-6s %-40s %10s  %s" % ("group","stage","file","nEnt","status")]
+    for name, stage, fname, n, probs in rows:
+        if verbose or len(probs) > 0:
+            lines.append("%-14s %-6s %-40s %10d  %s" % (name, stage, fname.split("/")[-1], n, "; ".join(probs) if probs else "ok"))
+    for stage in ["skim","wave","split","lat"]:
+        sRows = [r for r in rows if r[1]==stage]
+        lines.append("%-5s: %d files, %d entries, %d w/ problems" % (stage, len(sRows), sum(r[3] for r in sRows), sum(len(r[4])>0 for r in sRows)))
+    print("\n".join(lines))
+    if sumFile is not None:
+        with open(sumFile, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        print("Wrote summary:",sumFile)
+    return all(len(r[4])==0 for r in rows)
+
+
+def shardList(latPath, sList):
+    """ If the lat files were made from shards of a waveSkim file (lat-jobs.py -target -shard),
+    there are no split files.  Return the shards in the chain manifest instead.
+    """
+    pathName, fileName = os.path.split(latPath)
+    manFile = "%s/manifest_%s.json" % (pathName, fileName)
+    if len(sList) > 0 or not os.path.isfile(manFile): return sList
+    with open(manFile) as f:
+        return {sh["idx"]:sh["file"] for sh in json.load(f)["shards"]}
+
+
 def unpackFileName(splitList):
     """ Takes output of dsi.getSplitList and returns a list [ds,sub1,sub2]. """
     tmpS = []
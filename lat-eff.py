@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import os
 import numpy as np
-import tinydb as db
 import pandas as pd
 from statsmodels.stats import proportion
 from scipy.optimize import curve_fit
@@ -11,8 +10,7 @@ plt.style.use('pltReports.mplstyle')
 
 import dsi
 import waveLibs as wl
-calDB = db.TinyDB('{}/calDB-v2.json'.format(dsi.latSWDir)) # match LAT's v2 tag
-pars = db.Query()
+calDB, pars = dsi.getCalDB(), None # match LAT's v2 tag
 detInfo = dsi.DetInfo()
 
 # Skip these detectors because of low statistics
@@ -9,22 +9,22 @@ each DS.
 =================== C. Wiseman (USC) ===================
 """
 import sys, os, time
-import tinydb as db
 import numpy as np
-import pandas as pd
 
 # LAT libraries
 import dsi
-bkg = dsi.BkgInfo()
-cal = dsi.CalInfo()
-det = dsi.DetInfo()
+bkg = dsi.Lazy(dsi.BkgInfo)
+cal = dsi.Lazy(dsi.CalInfo)
+det = dsi.Lazy(dsi.DetInfo)
 import waveLibs as wl
+import buildGraph as bg
+forceBuild = False
 
 
 def main(argv):
 
     # a very important parameter, use 90 or 95
-    global pctTot
+    global pctTot, forceBuild
     # pctTot = 90
     pctTot = 95
     print("Using pctTot ==",pctTot)
@@ -33,6 +33,10 @@ def main(argv):
     # NOTE: the options outline a rough 'procedure' to use this code.
     for i, opt in enumerate(argv):
 
+        # remake the final files and efficiency npz even if they're up to date (see buildGraph.py)
+        if opt=="-force":
+            forceBuild = True
+
         # check DB cuts
         if opt=="-cov":
             # manual
@@ -141,8 +145,7 @@ def getPSACutRuns(ds, cutType, verbose=False):
 
     dRanges = {} # this is the list of ch/runs to exclude
 
-    calDB = db.TinyDB('%s/calDB-v2.json' % (dsi.latSWDir))
-    pars = db.Query()
+    calDB, pars = dsi.getCalDB(), None
     dsMap = bkg.dsMap() # number of bIdx's
     bkgRanges = bkg.getRanges(ds)
 
@@ -165,8 +168,9 @@ def getPSACutRuns(ds, cutType, verbose=False):
         # 2. loop over bkgIdx
         for i, bIdx in enumerate(bkgRanges):
 
-            # bkgDict, calDict are only filled when we have good entries, bkgCov, calCov are always filled.
-            bkgDict, calDict, bkgCov, calCov = dsi.GetDBCuts(ds,bIdx,mod,cutType,calDB,pars,pctTot,False)
+            # the cut tables are only filled when we have good entries, bkgCov, calCov are always filled.
+            cuts = dsi.CutSet(ds,bIdx,mod,cutType,calDB,pars,pctTot,False)
+            bkgCov, calCov = cuts.bkgCov, cuts.calCov
 
             rFirst, rLast = bkgRanges[bIdx][0], bkgRanges[bIdx][-1]
             dsSub = ds if ds in ["5A","5B","5C"] else int(ds)
@@ -184,8 +188,9 @@ def getPSACutRuns(ds, cutType, verbose=False):
                     if cIdxLo==cIdxHi:
                         covLo, covHi = runLo, runHi
                     else:
-                        runList = bkg.getRunList(ds, bIdx)
-                        subList = [r for r in runList if runLo <= r <= runHi and cal.GetCalIdx(calKey,r) == cIdx]
+                        runs = bkg.getRunArray(ds, bIdx)
+                        runs = runs[(runs >= runLo) & (runs <= runHi)]
+                        subList = runs[cal.GetCalIdxs(calKey, runs) == cIdx].tolist()
                         if len(subList)==0:
                             if verbose:
                                 print("No good runs in this sub-sub-bkgIdx")
@@ -448,6 +453,8 @@ def makeFinalFiles():
     """ ./lat-expo.py -f
     TChain the 'frb(pctTot)' files for each dataset and make output files for spec-fit and others.
     Save the enriched & natural exposure into the files too
+    Only remakes the files that are stale (see buildGraph.py): missing, or made from different
+    frb files, exposure totals, final cut or code.  -force remakes all of them.
     """
     from ROOT import TChain, TFile, TTree, TNamed, MGTWaveform
 
@@ -473,9 +480,7 @@ def makeFinalFiles():
     for ds in dsList:
 
         outName = "%s/bkg/cut/%s/%s_DS%s.root" % (dsi.dataDir, outType, outType, ds)
-        print("Writing final LAT output:",outName)
-
-        dummyTree = TChain("skimTree")
+        fileList = []
 
         dsNum = int(ds[0]) if isinstance(ds,str) else ds
         nBkg = bkg.dsMap()[dsNum]
@@ -494,15 +499,26 @@ def makeFinalFiles():
                 # cpd = det.getChanCPD(dsNum,ch)
                 # if [ds,cpd] in finalDetCut: continue
 
-                dummyTree.Add(fName)
+                fileList.append(fName)
 
+        expoFile = "./data/expo-totals-e%d.npz" % pctTot
+        prod = {"inputs":fileList+[expoFile], "code":[makeFinalFiles], "params":{"cut":tCut}}
+        reasons = bg.staleReasons(outName, force=forceBuild, **prod)
+        if len(reasons)==0:
+            print("Up to date:",outName)
+            continue
+        print("Writing final LAT output:",outName,"(%s)" % ", ".join(reasons))
+        bg.forget(outName)
+
+        dummyTree = TChain("skimTree")
+        for fName in fileList: dummyTree.Add(fName)
 
         outFile = TFile(outName, "RECREATE")
         outTree = TTree()
         outTree = dummyTree.CopyTree(tCut)
         outTree.Write()
 
-        f = np.load("./data/expo-totals-e%d.npz" % pctTot)
+        f = np.load(expoFile)
         dsExpo = f['arr_0'].item()
         enrExpTot = dsExpo[ds][0]
         natExpTot = dsExpo[ds][1]
@@ -512,6 +528,7 @@ def makeFinalFiles():
         natExp.Write()
 
         outFile.Close()
+        bg.record(outName, **prod)
 
 
 def makeMovies():
@@ -631,7 +648,10 @@ def getEfficiency():
     """ ./lat-expo.py -eff
     Same structure as getPSACutRuns, looping over sub-sub-bkgIdx's.
     Wow, it's a 6-layer loop.  Can I get a degree now?
+    Skipped if the npz is up to date (see buildGraph.py): made w/ the same settings, and none of
+    the input files, calDB records or code it was made from have changed.  -force remakes it.
     """
+    import pandas as pd
     import lat3
     from ROOT import TFile, TTree
     import matplotlib.pyplot as plt
@@ -650,8 +670,7 @@ def getEfficiency():
     pndOut = "./data/lat-runTimes.h5"
     pndDict = {"ds":[], "run":[], "det":[], "start":[], "stop":[], "lt":[], "rt":[], "expo":[]}
 
-    calDB = db.TinyDB('%s/calDB-v2.json' % (dsi.latSWDir))
-    pars = db.Query()
+    calDB, pars = dsi.getCalDB(), None
     enrExc, natExc, _, _ = lat3.getOutliers(verbose=False, usePass2=False)
 
     bExclude253 = True # Flag for excluding C2P5D3 from exposure calculations cuz it sucks
@@ -666,6 +685,20 @@ def getEfficiency():
     # xLo, xHi = 0, 50
     xLo, xHi = 0, 200 # Higher range
     xEff = np.arange(xLo, xHi, 0.01)
+
+    # the inputs and calDB records used are recorded w/ the output, and checked again here
+    effPars = {"mode":mode, "dsList":[str(ds) for ds in dsList], "xRange":[xLo, xHi], "exclude253":bExclude253, "kList":lat3.kList}
+    effCode = [getEfficiency, lat3.getOutliers, lat3.closeFence, lat3.outliersIQR, dsi.CutSet]
+    effInputs = ["./data/lat3-rates-ds%s-e%d.npz" % (ds, pctTot) for ds in [0,1,2,3,4,"5A","5B","5C",6]]
+    effKeys = []
+    if not debugMode:
+        reasons = ["forced"] if forceBuild else bg.recheck(npzOut, params=effPars)
+        if len(reasons)==0:
+            print("Up to date:",npzOut)
+            return
+        print("Making %s (%s)" % (npzOut, ", ".join(reasons)))
+        bg.forget(npzOut)
+
     totEnrEff = {ds:np.zeros(len(xEff)) for ds in dsList}
     totEnrEffLo = {ds:np.zeros(len(xEff)) for ds in dsList}
     totEnrEffHi = {ds:np.zeros(len(xEff)) for ds in dsList}
@@ -699,9 +732,11 @@ def getEfficiency():
         bkgRanges = bkg.getRanges(ds)
 
         # get psa cut runs and detector fitSlo efficiencies
-        f = np.load('./data/lat-psa%dRunCut-ds%s.npz' % (pctTot,ds))
+        effInputs.append('./data/lat-psa%dRunCut-ds%s.npz' % (pctTot,ds))
+        f = np.load(effInputs[-1])
         psaRuns = f['arr_0'].item() # {ch: [runLo1, runHi1, runLo2, runHi2, ...]}
 
+        effKeys.extend(["fitSlo_cpd_eff%d" % pctTot, "fitSlo_cpd_effHi%d" % pctTot, "fitSlo_cpd_effLo%d" % pctTot])
         fsD = dsi.getDBRecord("fitSlo_cpd_eff%d" % pctTot, False, calDB, pars)
         fsU = dsi.getDBRecord("fitSlo_cpd_effHi%d" % pctTot, False, calDB, pars) # upper
         fsL = dsi.getDBRecord("fitSlo_cpd_effLo%d" % pctTot, False, calDB, pars) # lower
@@ -718,7 +753,8 @@ def getEfficiency():
 
         # load ds_livetime output
         # tl = TFile("./data/ds_%s_livetime.root" % str(ds))
-        tl = TFile("./data/ds_%s_output.root" % str(ds)) # these have extra info
+        effInputs.append("./data/ds_%s_output.root" % str(ds))
+        tl = TFile(effInputs[-1]) # these have extra info
         lt = tl.Get("dsTree")
 
         # 2. loop over modules
@@ -748,7 +784,8 @@ def getEfficiency():
             for i, bIdx in enumerate(bkgRanges):
 
                 # load bkg (trigger) and cal (PSA) cut coverage
-                _,_, bkgCov, calCov = dsi.GetDBCuts(ds,bIdx,mod,"fr",calDB,pars,pctTot,False)
+                cuts = dsi.CutSet(ds,bIdx,mod,"fr",calDB,pars,pctTot,False,dbKeys=effKeys)
+                bkgCov, calCov = cuts.bkgCov, cuts.calCov
 
                 rLo, rHi = bkgRanges[bIdx][0], bkgRanges[bIdx][-1]
 
@@ -774,6 +811,7 @@ def getEfficiency():
 
                     # load trigger efficiencies
                     key = "thresh_ds%d_bkg%d_sub%d" % (dsNum, bIdx, sbIdx)
+                    effKeys.append(key)
                     thD = dsi.getDBRecord(key, False, calDB, pars)
 
                     # 5. loop over cIdx's in this sub-bIdx
@@ -784,8 +822,9 @@ def getEfficiency():
                         if cIdxLo==cIdxHi:
                             covLo, covHi = subLo, subHi
                         else:
-                            runList = bkg.getRunList(ds, bIdx)
-                            subList = [r for r in runList if subLo <= r <= subHi and cal.GetCalIdx(calKey,r) == cIdx]
+                            runs = bkg.getRunArray(ds, bIdx)
+                            runs = runs[(runs >= subLo) & (runs <= subHi)]
+                            subList = runs[cal.GetCalIdxs(calKey, runs) == cIdx].tolist()
                             if len(subList)==0: continue
                             covLo, covHi = subList[0], subList[-1]
 
@@ -1031,6 +1070,9 @@ def getEfficiency():
         try: os.remove(pndOut)
         except OSError: pass
         df.to_hdf(pndOut, key='runTimeInfo')
+        prod = {"inputs":effInputs, "dbKeys":sorted(set(effKeys)), "code":effCode, "params":effPars}
+        bg.record(npzOut, **prod)
+        bg.record(pndOut, **prod)
 
 
 def getEfficiencyROOT():
@@ -1041,6 +1083,7 @@ def getEfficiencyROOT():
     Note: because of the amount of data the Toy MC takes up, the binning is in
     0.1 keV bins rather than 0.01 keV bins, must rebin the efficiencies manually
     """
+    import pandas as pd
 
     from ROOT import TFile, TH1D
     import matplotlib.pyplot as plt
@@ -1069,8 +1112,7 @@ def getEfficiencyROOT():
     dsList = [0, 1, 2, 3, 4, '5A', '5B', '5C', 6]
 
     # Grab total fitSlo efficiency from DB
-    calDB = db.TinyDB('%s/calDB-v2.json' % (dsi.latSWDir))
-    pars = db.Query()
+    calDB, pars = dsi.getCalDB(), None
     dbKey = "fitSlo_Combined_m2s238_eff95"
     fsN = dsi.getDBRecord(dbKey, False, calDB, pars)
     enrpars = fsN[0]
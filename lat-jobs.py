@@ -7,11 +7,17 @@ documents the "procedure" necessary to produce LAT data,
 starting from running skim_mjd_data.
 ====================== C. Wiseman, B. Zhu =====================
 """
-import sys, shlex, glob, os, re, time
+import sys, shlex, glob, os, re, time, json
 import subprocess as sp
 import dsi
+import treeOut
+import buildGraph as bg
 jobQueue = dsi.latSWDir+"/job.q"
 
+# lat.py cost model (see planSplit).  Refit w/ -calibCost from lat.py timing files (lat.py -t).
+costFile = dsi.latSWDir+"/data/latCost.json"
+defaultCost = {"cEnt":0.002, "cHit":0.01, "cSamp":2e-5} # sec/entry, sec/hit, sec/hit/sample
+
 # =============================================================
 def main(argv):
 
@@ -22,6 +28,8 @@ def main(argv):
 
     dsNum, subNum, runNum, modNum = None, None, None, None
     argString, calList, useJobQueue = None, [], False
+    global splitTarget, shardMode, dryRun, forceBuild
+    splitTarget, shardMode, dryRun, forceBuild = None, False, False, False
 
     # loop over user args
     for i,opt in enumerate(argv):
@@ -38,6 +46,15 @@ def main(argv):
         if opt == "-mod": modNum = int(argv[i+1])
         if opt == "-cal": calList = getCalRunList(dsNum,subNum,runNum)
 
+        # adaptive splitting: target lat.py wall time (sec) per split file
+        if opt == "-target": splitTarget = float(argv[i+1])
+        # w/ -target: don't copy, plan entry ranges for lat.py to run on the waveSkim file (lat.py -e)
+        if opt == "-shard": shardMode = True
+
+        # only submit split/lat jobs whose output is stale (see buildGraph.py)
+        if opt == "-dry":   dryRun = True     # list what would be submitted, and why
+        if opt == "-force": forceBuild = True # submit all of them
+
         # main skim routines
         if opt == "-skim":       runSkimmer(dsNum, subNum, runNum, calList=calList)
         if opt == "-wave":       runWaveSkim(dsNum, subNum, runNum, calList=calList)
@@ -66,11 +83,16 @@ def main(argv):
         if opt == "-sbuild": specialBuild()
 
         # misc
-        if opt == "-split":     splitTree(dsNum, subNum, runNum)
+        if opt == "-split":     splitTree(dsNum, subNum, runNum, splitTarget)
+        if opt == "-calibCost": calibCost(argv[i+1])
+        if opt == "-checkShards": checkShards(argv[i+1])
         if opt == "-skimLAT":   skimLAT(argv[i+1],argv[i+2],argv[i+3])
         if opt == "-tuneCuts":  tuneCuts(argv[i+1],dsNum)
         if opt == "-lat3":      applyCuts(int(argv[i+1]),argv[i+2])
         if opt == "-cron":      cronJobs()
+        if opt == "-pump":      pumpQueue(int(argv[i+1]) if len(argv)>i+1 and argv[i+1].isdigit() else None)
+        if opt == "-pumpArr":   pumpArray(argv[i+1], argv[i+2], int(argv[i+3]))
+        if opt == "-dbMerge":   dsi.mergeJournals(force=forceBuild)
         if opt == "-shifter":   shifterTest()
         if opt == "-test":      quickTest()
         if opt == "-b":         runBatch()
@@ -241,7 +263,11 @@ def runBatch():
     # EX. 4: Run a job pump
     # sh("%s slurm.slr './job-pump.sh jobs/test.ls skim_mjd_data %d %d'" % getSBatch("cori"))
 
+    # EX. 4b: Run a job pump w/ jobPump.py (stage dependencies, retries, state file)
+    # sh("%s slurm.slr './jobPump.py -n %d jobs/test.ls'" % getSBatch("cori")[:2])
+
     # EX. 5: Run a job array (note: slurm task id matches the integer given by the --array option)
+    # pumpArray("jobs/bkgLAT.ls", "edison-arr", 50)
     # sh("%s slurm.slr 'eval ./job-pump.sh jobs/test/test_${SLURM_ARRAY_TASK_ID}.ls python3 %d %d'" % getSBatch("edison-arr",nArr=2))
     # sh("%s slurm.slr 'eval ./job-pump.sh jobs/test/test_${SLURM_ARRAY_TASK_ID}.ls python3 %d %d'" % getSBatch("pdsf-arr",nArr=2))
 
@@ -469,14 +495,20 @@ def runAutoThresh(ds=None):
                 else: sh("%s '%s'" % (jobStr, job))
 
 
-def splitTree(dsNum, subNum=None, runNum=None):
-    """ ./lat-jobs.py -split (-sub dsNum subNum) (-run dsNum runNum)
+def splitTree(dsNum, subNum=None, runNum=None, target=None):
+    """ ./lat-jobs.py [-target sec [-shard]] -split (-sub dsNum subNum) (-run dsNum runNum)
 
         Split a SINGLE waveSkim file into small (~50MB) files to speed up LAT parallel processing.
         Can call 'batchSplit' instead to submit each run in the list as a job, splitting the files in parallel.
         NOTE: The cut written into the first file is NOT copied into the additional files
               (I couldn't get it to work within this function -- kept getting "file not closed" errors.)
               To clean up, do that with the 'writeCut' function below, potentially AFTER a big parallel job.
+
+        w/ -target: split the file s/t each piece takes about 'target' seconds in lat.py,
+        using the cost model in planSplit, instead of by size.  The cut is written into
+        every file, and the split plan is saved in a manifest that runLAT reads.
+        w/ -shard too: only make the plan.  runLAT then runs lat.py on ranges of the waveSkim
+        file itself (lat.py -e), so there's no copy of the waveforms, and no writeCut pass.
     """
     from ROOT import TFile, TTree, gDirectory, TEntryList, TNamed, TObject, gROOT
 
@@ -491,12 +523,14 @@ def splitTree(dsNum, subNum=None, runNum=None):
         outPath = "%s/splitSkimDS%d_%d.root" % (dsi.splitDir,dsNum,subNum)
         fileList = sorted(glob.glob("%s/splitSkimDS%d_%d*.root" % (dsi.splitDir,dsNum, subNum)))
         for f in fileList: os.remove(f)
+        if os.path.isfile(manifestName(outPath)): os.remove(manifestName(outPath))
     elif subNum==None:
         # cal mode
         inPath = "%s/waveSkimDS%d_run%d.root" % (dsi.calWaveDir,dsNum,runNum)
         outPath = "%s/splitSkimDS%d_run%d.root" % (dsi.calSplitDir,dsNum,runNum)
         fileList = sorted(glob.glob("%s/splitSkimDS%d_run%d*.root" % (dsi.calSplitDir,dsNum,runNum)))
         for f in fileList: os.remove(f)
+        if os.path.isfile(manifestName(outPath)): os.remove(manifestName(outPath))
 
     inFile = TFile(inPath)
     bigTree = inFile.Get("skimTree")
@@ -506,22 +540,226 @@ def splitTree(dsNum, subNum=None, runNum=None):
     bigTree.SetEntryList(elist)
     nList = elist.GetN()
 
-    outFile = TFile(outPath,"RECREATE")
+    if target is not None:
+        chunks = planSplit(bigTree, theCut, loadCost(), target)
+        for chunk in chunks:
+            if shardMode:
+                chunk["file"] = None
+                continue
+            chunk["file"] = outPath if chunk["idx"]==0 else "%s_%d.root" % (outPath[:-5], chunk["idx"])
+            outFile = treeOut.openOut(chunk["file"], "split")
+            thisCut = TNamed("theCut",theCut)
+            thisCut.Write("",TObject.kOverwrite)
+            lilTree = treeOut.copyTree(bigTree, "", "split", "", chunk["hi"]-chunk["lo"], chunk["lo"])
+            lilTree.Write("",TObject.kOverwrite)
+            print("Wrote %s: entries %d-%d, est. %.0f sec" % (chunk["file"], chunk["lo"], chunk["hi"], chunk["cost"]))
+            outFile.Close()
+        if shardMode:
+            print("Planned %d shards of %s" % (len(chunks), inPath))
+        man = {"input":inPath, "cut":theCut, "nList":nList, "target":target, "model":loadCost(), "chunks":chunks}
+        with open(manifestName(outPath), "w") as f:
+            json.dump(man, f, indent=2)
+        print("Wrote manifest:",manifestName(outPath))
+        bg.record(*splitProduct(inPath, outPath))
+        return
+
+    outFile = treeOut.openOut(outPath, "split") # the extra files get the same compression
     lilTree = TTree()
     lilTree.SetMaxTreeSize(50000000) # 50 MB
     thisCut = TNamed("theCut",theCut)
     thisCut.Write("",TObject.kOverwrite)
-    lilTree = bigTree.CopyTree("") # this does NOT write the cut into the extra files
+    lilTree = treeOut.copyTree(bigTree, "", "split") # this does NOT write the cut into the extra files
     lilTree.Write("",TObject.kOverwrite)
+    lilTree.GetCurrentFile().Close() # the last file, if it went over the max size
+    bg.record(*splitProduct(inPath, outPath))
+
+
+def manifestName(outPath):
+    """ Split manifest for a split file set, e.g. splitSkimDS1_5.root -> manifest_splitSkimDS1_5.json
+    (named s/t it doesn't match the splitSkim globs).
+    """
+    pathName, fileName = os.path.split(outPath)
+    return "%s/manifest_%s.json" % (pathName, fileName.replace(".root",""))
+
+
+def loadCost():
+    """ lat.py cost model parameters, from costFile if it's been calibrated. """
+    if os.path.isfile(costFile):
+        with open(costFile) as f:
+            return json.load(f)
+    return dict(defaultCost)
+
+
+def wfLength(tree, nWF=20):
+    """ Typical number of samples in the wf's of a skim tree (median of the first few hits). """
+    import numpy as np
+    lengths = []
+    for i in range(min(tree.GetEntries(), nWF)):
+        tree.GetEntry(i)
+        for j in range(tree.MGTWaveforms.size()):
+            lengths.append(tree.MGTWaveforms.at(j).GetLength())
+        if len(lengths) >= nWF: break
+    return float(np.median(lengths)) if len(lengths) > 0 else 2018.
+
+
+def hitCounts(tree, theCut):
+    """ Number of hits passing theCut in each entry of the tree's entry list (in list order). """
+    import numpy as np
+    import waveLibs as wl
+    nEnt = tree.GetEntryList().GetN() if tree.GetEntryList() else tree.GetEntries()
+    tree.SetEstimate(max(nEnt, tree.GetEstimate()))
+    n = tree.Draw("Entry$","","goff")
+    listEnt = wl.bufferView(tree.GetV1(), n).copy()
+    while True:
+        nHit = tree.Draw("Entry$",theCut,"goff")
+        if nHit <= tree.GetEstimate(): break
+        tree.SetEstimate(nHit + 1)
+    hitEnt = wl.bufferView(tree.GetV1(), nHit)
+    return np.searchsorted(hitEnt, listEnt, side="right") - np.searchsorted(hitEnt, listEnt, side="left")
+
+
+def planSplit(tree, theCut, cost, target):
+    """ Split plan for lat.py: consecutive ranges of the tree's entry list, each estimated
+    to take about 'target' seconds.  The cost of an entry is
+        cEnt + nHits * (cHit + cSamp * nSamples)
+    w/ nHits the number of hits passing theCut (the ones lat.py processes).
+    Returns a list of dicts: idx, lo, hi (entry list positions), nHits, cost (sec).
+    """
+    import numpy as np
+    nSamp = wfLength(tree)
+    nHits = hitCounts(tree, theCut)
+    entCost = cost["cEnt"] + nHits * (cost["cHit"] + cost["cSamp"] * nSamp)
+    cumCost = np.cumsum(entCost)
+    total = cumCost[-1] if len(cumCost) > 0 else 0.
+    nChunk = max(1, int(np.ceil(total / target)))
+    bounds = np.searchsorted(cumCost, total * np.arange(1, nChunk) / nChunk)
+    bounds = np.unique(np.concatenate(([0], bounds, [len(entCost)])))
+    print("Entries %d  hits %d  wf length %d  est. lat.py time %.0f sec.  Splitting into %d files." % (len(entCost), np.sum(nHits), nSamp, total, len(bounds)-1))
+    chunks = []
+    for idx, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:])):
+        chunks.append({"idx":idx, "lo":int(lo), "hi":int(hi), "nHits":int(np.sum(nHits[lo:hi])), "cost":float(np.sum(entCost[lo:hi]))})
+    return chunks
+
+
+def calibCost(timeFiles):
+    """ ./lat-jobs.py -calibCost "path/timing/*.timing.json"
+        Fit the lat.py cost model (see planSplit) to the run times in lat.py timing files (-t),
+        and save it to costFile.  Needs the input files listed in the timing files, to get the wf lengths.
+    """
+    import numpy as np
+    from scipy.optimize import nnls
+    from ROOT import TFile
+    rows, wall = [], []
+    for fName in sorted(glob.glob(timeFiles)):
+        with open(fName) as f:
+            tInfo = json.load(f)
+        tf = TFile(tInfo["inFile"])
+        if tf.IsZombie(): continue
+        nSamp = wfLength(tf.Get("skimTree"))
+        tf.Close()
+        rows.append([tInfo["nEntries"], tInfo["nHits"], tInfo["nHits"]*nSamp])
+        wall.append(tInfo["run"]["wall"])
+        print("%s: entries %d  hits %d  wf length %d  wall %.0f sec" % (fName, tInfo["nEntries"], tInfo["nHits"], nSamp, tInfo["run"]["wall"]))
+    if len(rows)==0:
+        print("No timing files found.")
+        return
+    rows, wall = np.asarray(rows, dtype=float), np.asarray(wall)
+
+    # w/ only a few files, just rescale the current model
+    cost = loadCost()
+    pars = np.asarray([cost["cEnt"], cost["cHit"], cost["cSamp"]])
+    if len(rows) >= 3:
+        pars, _ = nnls(rows, wall)
+    else:
+        pars *= np.sum(wall) / np.sum(np.dot(rows, pars))
+    cost = {"cEnt":pars[0], "cHit":pars[1], "cSamp":pars[2]}
+    resid = wall - np.dot(rows, pars)
+    print("Cost model:",cost,"  rms residual %.0f sec" % np.sqrt(np.mean(resid**2)))
+    with open(costFile, "w") as f:
+        json.dump(cost, f, indent=2)
+    print("Saved",costFile)
+
+
+def splitFiles(splitPath, subNum):
+    """ The lat.py inputs for one waveSkim file: the split files {idx:path}, the estimated lat.py
+    time of each, {idx:sec}, and for shards (-shard), the entry range of each, {idx:(lo,hi)}.
+    The last two are empty if the file wasn't split w/ -target.  Uses the split manifest if there is one.
+    """
+    manFile = manifestName(splitPath + ".root")
+    if not os.path.isfile(manFile):
+        return dsi.getSplitList(splitPath+"*", subNum), {}, {}
+    with open(manFile) as f:
+        man = json.load(f)
+    files, ranges = {}, {}
+    for chunk in man["chunks"]:
+        if chunk["file"] is None:
+            files[chunk["idx"]] = man["input"]
+            ranges[chunk["idx"]] = (chunk["lo"], chunk["hi"])
+        else:
+            files[chunk["idx"]] = chunk["file"]
+    for idx in files:
+        if not os.path.isfile(files[idx]): print("Warning, input file not found:",files[idx])
+    return files, {chunk["idx"]:chunk["cost"] for chunk in man["chunks"]}, ranges
+
+
+def latJob(job, idx, ranges, shards, outFile):
+    """ Add the entry range to a lat.py job if it runs on a shard, and note the output in 'shards'. """
+    if idx not in ranges: return job
+    shards.append({"idx":idx, "lo":ranges[idx][0], "hi":ranges[idx][1], "file":outFile})
+    return job + " -e %d %d" % ranges[idx]
+
+
+def writeShardManifest(latPath, inFile, shards):
+    """ Chain manifest for the latSkim shards of one waveSkim file: the input, and each shard's
+    entry range and output file, in order.  Check them w/ checkShards after the jobs finish.
+    """
+    if len(shards)==0 or dryRun: return
+    manFile = manifestName(latPath + ".root")
+    with open(manFile, "w") as f:
+        json.dump({"input":inFile, "shards":sorted(shards, key=lambda sh: sh["idx"])}, f, indent=2)
+    print("Wrote",manFile)
+
+
+def checkShards(manFile):
+    """ ./lat-jobs.py -checkShards [manifest_latSkim*.json]
+        Make sure the latSkim shards in a chain manifest exist and have the right number of entries.
+        Returns True if they're all good.
+    """
+    from ROOT import TFile
+    with open(manFile) as f:
+        man = json.load(f)
+    good, nTot = True, 0
+    for sh in man["shards"]:
+        nExp = sh["hi"] - sh["lo"]
+        if not os.path.isfile(sh["file"]):
+            print("Missing shard %d: %s" % (sh["idx"], sh["file"]))
+            good = False
+            continue
+        tf = TFile(sh["file"])
+        tt = tf.Get("skimTree")
+        nEnt = tt.GetEntries() if tt else -1
+        prog = tf.Get("progress")
+        done = json.loads(prog.GetTitle())["nDone"] if prog else None
+        tf.Close()
+        if nEnt != nExp or done != nExp:
+            print("Bad shard %d: %s  entries %d (expected %d), %s done" % (sh["idx"], sh["file"], nEnt, nExp, done))
+            good = False
+        nTot += nEnt
+    print("%s: %d shards, %d entries.  %s" % (manFile, len(man["shards"]), nTot, "OK" if good else "INCOMPLETE"))
+    return good
 
 
 def batchSplit(dsNum, subNum=None, runNum=None, calList=[]):
-    """ ./lat-jobs.py [-q] [-cal] -batchSplit (-ds dsNum) (-sub dsNum subNum) (-run dsNum subNum)
+    """ ./lat-jobs.py [-q] [-cal] [-target sec] [-dry] [-force] -batchSplit (-ds dsNum) (-sub dsNum subNum) (-run dsNum subNum)
         Submit jobs that call splitTree for each run, splitting files into small chunks.
+        Only the files whose split output is stale are submitted (see submitSplit).
         NOTE: The data cleaning cut is NOT written into the output files and the
               function 'writeCut' must be called after these jobs are done.
+              (Except w/ -target, which writes it into every file.)
     """
     bkg = dsi.BkgInfo()
+    tgt = "-target %d " % splitTarget if splitTarget is not None else ""
+    if shardMode: tgt += "-shard "
 
     # bg
     if not calList:
@@ -535,9 +773,9 @@ def batchSplit(dsNum, subNum=None, runNum=None, calList=[]):
                     print("File",inPath,"not found. Continuing ...")
                     continue
                 else:
-                    job = "./lat-jobs.py -sub %d %d -split" % (dsNum, i)
-                    if useJobQueue: sh("%s >& ./logs/split-ds%d-%d.txt" % (job, dsNum, i))
-                    else: sh("""%s '%s'""" % (jobStr, job))
+                    job = "./lat-jobs.py %s-sub %d %d -split" % (tgt, dsNum, i)
+                    outPath = "%s/splitSkimDS%d_%d.root" % (dsi.splitDir,dsNum,i)
+                    submitSplit(job, "./logs/split-ds%d-%d.txt" % (dsNum, i), inPath, outPath)
         # -sub
         elif runNum==None:
             inPath = "%s/waveSkimDS%d_%d.root" % (dsi.waveDir,dsNum,subNum)
@@ -545,9 +783,9 @@ def batchSplit(dsNum, subNum=None, runNum=None, calList=[]):
                 print("File",inPath,"not found.")
                 return
             else:
-                job = "./lat-jobs.py -sub %d %d -split" % (dsNum, i)
-                if useJobQueue: sh("%s >& ./logs/split-ds%d-%d.txt" % (job, dsNum, i))
-                else: sh("""%s '%s'""" % (jobStr, job))
+                job = "./lat-jobs.py %s-sub %d %d -split" % (tgt, dsNum, subNum)
+                outPath = "%s/splitSkimDS%d_%d.root" % (dsi.splitDir,dsNum,subNum)
+                submitSplit(job, "./logs/split-ds%d-%d.txt" % (dsNum, subNum), inPath, outPath)
         # -run
         elif subNum==None:
             inPath = "%s/waveSkimDS%d_run%d.root" % (dsi.waveDir,dsNum,runNum)
@@ -555,9 +793,9 @@ def batchSplit(dsNum, subNum=None, runNum=None, calList=[]):
                 print("File",inPath,"not found.")
                 return
             else:
-                job = "./lat-jobs.py -run %d %d -split" % (dsNum, runNum)
-                if useJobQueue: sh("%s >& ./logs/split-ds%d-run%d.txt" % (job, dsNum, runNum))
-                else: sh("""%s '%s'""" % (jobStr, job))
+                job = "./lat-jobs.py %s-run %d %d -split" % (tgt, dsNum, runNum)
+                outPath = "%s/splitSkimDS%d_run%d.root" % (dsi.calSplitDir,dsNum,runNum)
+                submitSplit(job, "./logs/split-ds%d-run%d.txt" % (dsNum, runNum), inPath, outPath)
 
 
     # cal
@@ -572,15 +810,39 @@ def batchSplit(dsNum, subNum=None, runNum=None, calList=[]):
                 print("File",inPath,"not found. Continuing ...")
                 continue
             else:
-                job = "./lat-jobs.py -run %d %d -split" % (dsNum, run)
-                if useJobQueue: sh("%s >& ./logs/split-ds%d-run%d.txt" % (job, dsNum, run))
-                else: sh("""%s '%s'""" % (jobStr, job))
+                job = "./lat-jobs.py %s-run %d %d -split" % (tgt, dsNum, run)
+                outPath = "%s/splitSkimDS%d_run%d.root" % (dsi.calSplitDir,dsNum,run)
+                submitSplit(job, "./logs/split-ds%d-run%d.txt" % (dsNum, run), inPath, outPath)
+
+
+def splitProduct(inPath, outPath):
+    """ splitTree's output (the split manifest w/ -target, else the first split file) and
+    its declaration for buildGraph.
+    """
+    out = manifestName(outPath) if splitTarget is not None else outPath
+    return out, {"inputs":[inPath], "code":[splitTree, planSplit],
+        "params":{"target":splitTarget, "shard":shardMode, "out":treeOut.getSettings("split")}}
+
+
+def submitSplit(job, log, inPath, outPath):
+    """ Submit a splitTree job if its output is stale. """
+    out, prod = splitProduct(inPath, outPath)
+    reasons = bg.staleReasons(out, force=forceBuild, **prod)
+    if len(reasons)==0:
+        print("Up to date:",out)
+    elif dryRun:
+        print("Would split %s: %s" % (inPath, ", ".join(reasons)))
+    elif useJobQueue: sh("%s >& %s" % (job, log))
+    else: sh("""%s '%s'""" % (jobStr, job))
 
 
 def writeCut(dsNum, subNum=None, runNum=None, calList=[]):
     """ ./lat-jobs.py -writeCut (-ds dsNum) (-sub dsNum subNum) (-run dsNum subNum) [-cal]
         Assumes the cut used in the FIRST file (even in the whole DS) should be applied
         to ALL files.  This should be a relatively safe assumption.
+        Files that already have the cut aren't touched, and a split file w/ a build record
+        that was up to date is re-stamped, s/t adding the cut doesn't make it (and the
+        lat files made from it) stale.
     """
     from ROOT import TFile, TNamed, TObject
     fileList = []
@@ -620,18 +882,33 @@ def writeCut(dsNum, subNum=None, runNum=None, calList=[]):
     firstFile = TFile(fileList[0])
     theCut = firstFile.Get("theCut").GetTitle()
     print("Applying this cut:\n",theCut)
+    firstFile.Close()
     for f in fileList:
         print(f)
+        subRangeFile = TFile(f)
+        oldCut = subRangeFile.Get("theCut")
+        hasCut = oldCut and oldCut.GetTitle() == theCut
+        subRangeFile.Close()
+        if hasCut: continue
+        wasCurrent = bg.outputUnchanged(f)
         subRangeFile = TFile(f,"UPDATE")
         thisCut = TNamed("theCut",theCut)
         thisCut.Write("",TObject.kOverwrite)
+        subRangeFile.Close()
+        if wasCurrent: bg.restamp(f)
 
 
 def runLAT(dsNum, subNum=None, runNum=None, calList=[]):
-    """ ./lat-jobs.py [-q] -lat (-ds dsNum) (-sub dsNum subNum) (-run dsNum subNum) [-cal]
+    """ ./lat-jobs.py [-q] [-dry] [-force] -lat (-ds dsNum) (-sub dsNum subNum) (-run dsNum subNum) [-cal]
         Runs LAT on splitSkim output.  Does not combine output files back together.
+        Only submits the jobs whose output is stale (see latStale).  -dry lists them instead.
+        Files split w/ -target are read from their split manifests, and the jobs are
+        submitted longest first (by estimated time), so the short ones fill in at the end.
+        Shards (-target -shard) run lat.py on entry ranges of the waveSkim file, and their
+        outputs are listed in a chain manifest in the lat directory (see checkShards).
     """
     bkg = dsi.BkgInfo()
+    jobs = [] # (est. time, job, log)
 
     # bg
     if not calList:
@@ -639,32 +916,38 @@ def runLAT(dsNum, subNum=None, runNum=None, calList=[]):
         # -ds
         if subNum==None and runNum==None:
             for subNum in range(dsMap[dsNum]+1):
-                files = dsi.getSplitList("%s/splitSkimDS%d_%d*" % (dsi.splitDir,dsNum,subNum),subNum)
+                files, cost, ranges = splitFiles("%s/splitSkimDS%d_%d" % (dsi.splitDir,dsNum,subNum),subNum)
+                shards = []
                 for idx, inFile in sorted(files.items()):
                     outFile = "%s/latSkimDS%d_%d_%d.root" % (dsi.latDir,dsNum,subNum,idx)
                     job = "./lat.py -b -r %d %d -p %s %s" % (dsNum,subNum,inFile,outFile)
+                    job = latJob(job, idx, ranges, shards, outFile)
 
                     # jspl = job.split() # make SUPER sure stuff is matched
                     # print(jspl[3],jspl[4],jspl[6].split("/")[-1],jspl[7].split("/")[-1])
 
-                    if useJobQueue: sh("%s >& ./logs/lat-ds%d-%d-%d.txt" % (job, dsNum, subNum, idx))
-                    else: sh("""%s '%s'""" % (jobStr, job))
+                    jobs.append((cost.get(idx,0), job, "./logs/lat-ds%d-%d-%d.txt" % (dsNum, subNum, idx)))
+                writeShardManifest("%s/latSkimDS%d_%d" % (dsi.latDir,dsNum,subNum), files.get(0), shards)
         # -sub
         elif runNum==None:
-            files = dsi.getSplitList("%s/splitSkimDS%d_%d*" % (dsi.splitDir,dsNum,subNum),subNum)
+            files, cost, ranges = splitFiles("%s/splitSkimDS%d_%d" % (dsi.splitDir,dsNum,subNum),subNum)
+            shards = []
             for idx, inFile in sorted(files.items()):
                 outFile = "%s/latSkimDS%d_%d_%d.root" % (dsi.latDir,dsNum,subNum,idx)
                 job = "./lat.py -b -r %d %d -p %s %s" % (dsNum,subNum,inFile,outFile)
-                if useJobQueue: sh("%s >& ./logs/lat-ds%d-run%d-%d.txt" % (job, dsNum, subNum, idx))
-                else: sh("""%s '%s'""" % (jobStr, job))
+                job = latJob(job, idx, ranges, shards, outFile)
+                jobs.append((cost.get(idx,0), job, "./logs/lat-ds%d-run%d-%d.txt" % (dsNum, subNum, idx)))
+            writeShardManifest("%s/latSkimDS%d_%d" % (dsi.latDir,dsNum,subNum), files.get(0), shards)
         # -run
         elif subNum==None:
-            files = dsi.getSplitList("%s/splitSkimDS%d_run%d*" % (dsi.splitDir,dsNum,runNum),runNum)
+            files, cost, ranges = splitFiles("%s/splitSkimDS%d_run%d" % (dsi.splitDir,dsNum,runNum),runNum)
+            shards = []
             for idx, inFile in sorted(files.items()):
                 outFile = "%s/latSkimDS%d_run%d_%d.root" % (dsi.latDir,dsNum,runNum,idx)
                 job = "./lat.py -b -r %d %d -p %s %s" % (dsNum,runNum,inFile,outFile)
-                if useJobQueue: sh("%s >& ./logs/lat-ds%d-run%d-%d.txt" % (job, dsNum, runNum, idx))
-                else: sh("""%s '%s'""" % (jobStr, job))
+                job = latJob(job, idx, ranges, shards, outFile)
+                jobs.append((cost.get(idx,0), job, "./logs/lat-ds%d-run%d-%d.txt" % (dsNum, runNum, idx)))
+            writeShardManifest("%s/latSkimDS%d_run%d" % (dsi.latDir,dsNum,runNum), files.get(0), shards)
     # cal
     else:
         dsRanges = bkg.dsRanges()
@@ -672,12 +955,35 @@ def runLAT(dsNum, subNum=None, runNum=None, calList=[]):
             for key in dsRanges:
                 if dsRanges[key][0] <= run <= dsRanges[key][1]:
                     dsNum=key
-            files = dsi.getSplitList("%s/splitSkimDS%d_run%d*" % (dsi.calSplitDir,dsNum,run),run)
+            files, cost, ranges = splitFiles("%s/splitSkimDS%d_run%d" % (dsi.calSplitDir,dsNum,run),run)
+            shards = []
             for idx, inFile in sorted(files.items()):
                 outFile = "%s/latSkimDS%d_run%d_%d.root" % (dsi.calLatDir,dsNum,run,idx)
                 job = "./lat.py -b -f %d %d -p %s %s" % (dsNum,run,inFile,outFile)
-                if useJobQueue: sh("%s >& ./logs/lat-ds%d-run%d-%d.txt" % (job, dsNum, run, idx))
-                else: sh("""%s '%s'""" % (jobStr, job))
+                job = latJob(job, idx, ranges, shards, outFile)
+                jobs.append((cost.get(idx,0), job, "./logs/lat-ds%d-run%d-%d.txt" % (dsNum, run, idx)))
+            writeShardManifest("%s/latSkimDS%d_run%d" % (dsi.calLatDir,dsNum,run), files.get(0), shards)
+
+    # longest first.  (stable sort: w/o manifests the order is unchanged)
+    nGood = 0
+    for est, job, log in sorted(jobs, key=lambda j: -j[0]):
+        reasons = latStale(job)
+        if len(reasons)==0:
+            nGood += 1
+            continue
+        if dryRun: print("Would run %s: %s" % (job, ", ".join(reasons)))
+        elif useJobQueue: sh("%s >& %s" % (job, log))
+        else: sh("""%s '%s'""" % (jobStr, job))
+    print("%d lat.py jobs, %d up to date." % (len(jobs), nGood))
+
+
+def latStale(job):
+    """ Reasons to run a lat.py job: its output is missing, or lat.py's build record for it
+    has different options, or its input or the lat.py code changed since (see buildGraph.py).
+    """
+    if forceBuild: return ["forced"]
+    args = job.split()[1:]
+    return bg.recheck(args[args.index("-p")+2], params={"args":args})
 
 
 def mergeLAT():
@@ -762,6 +1068,8 @@ def cronJobs():
     SHELL=/bin/bash
     MAILTO="" # can put in some address here if you LOVE emails
     #*/10 * * * * source ~/env/EnvBatch.sh; ~/lat/lat-jobs.py -cron >> ~/lat/cron.log 2>&1
+
+    On a node you have to yourself, './lat-jobs.py -pump' runs the queue directly instead (see pumpQueue).
     """
     os.chdir(home+"/lat/")
     print("Cron:",time.strftime('%X %x %Z'),"cwd:",os.getcwd())
@@ -793,6 +1101,50 @@ def cronJobs():
                 f.write(job + "\n")
 
 
+def pumpQueue(nProc=None):
+    """ ./lat-jobs.py -pump [nProc]
+    Run the job queue (job.q) on this node w/ jobPump.py, instead of submitting it from cron.
+    Jobs start as soon as the ones they depend on finish (see jobPump.py), and the
+    queue's state is kept in job.state.json, so running it again only runs what's left.
+    """
+    import jobPump
+    os.chdir(dsi.latSWDir)
+    jobPump.run([jobQueue], nProc)
+
+
+def pumpArray(jobFile, opt, nChunks):
+    """ ./lat-jobs.py -pumpArr [jobFile] [sbatch opt, e.g. edison-arr] [nChunks]
+    Split a job list into chunks and submit them as an sbatch array, one jobPump.py per node.
+    Jobs w/ the same subDS or run (e.g. its split and lat jobs) go in the same chunk,
+    since jobPump.py only knows about the jobs in its own chunk.
+    """
+    import jobPump
+    with open(jobFile) as f:
+        jobList = [line.rstrip('\n') for line in f if line.strip()!="" and not line.startswith("#")]
+    name = os.path.splitext(os.path.basename(jobFile))[0]
+    outDir = "%s/jobs/%s" % (dsi.latSWDir, name)
+    if not os.path.isdir(outDir): os.makedirs(outDir)
+
+    groups = {}
+    for i, job in enumerate(jobList):
+        key = jobPump.getKey(job)
+        groups.setdefault(key if key is not None else i, []).append(job)
+    groups = sorted(groups.values(), key=len, reverse=True)
+
+    nChunks = min(nChunks, len(groups))
+    chunks = [[] for iCh in range(nChunks)]
+    for group in groups:
+        min(chunks, key=len).extend(group)
+    for iCh, chunk in enumerate(chunks):
+        with open("%s/%s_%d.ls" % (outDir, name, iCh), "w") as f:
+            for job in chunk:
+                f.write(job + "\n")
+    print("%d jobs in %d chunks: %s/%s_*.ls" % (len(jobList), nChunks, outDir, name))
+
+    sbStr, nCores = getSBatch(opt, nArr=nChunks-1)[:2]
+    sh("%s slurm.slr 'eval ./jobPump.py -n %d %s/%s_${SLURM_ARRAY_TASK_ID}.ls'" % (sbStr, nCores, outDir, name))
+
+
 def shifterTest():
     """ ./lat-jobs.py -shifter """
     print("Shifter:",time.strftime('%X %x %Z'),"cwd:",os.getcwd())
@@ -861,10 +1213,10 @@ def splitFile(inPath,outPath):
     from ROOT import TFile, TTree, TObject
     inFile = TFile(inPath)
     bigTree = inFile.Get("skimTree")
-    outFile = TFile(outPath, "RECREATE")
+    outFile = treeOut.openOut(outPath, "split")
     lilTree = TTree()
     lilTree.SetMaxTreeSize(30000000) # 30MB
-    lilTree = bigTree.CopyTree("")
+    lilTree = treeOut.copyTree(bigTree, "", "split")
     lilTree.Write("",TObject.kOverwrite)
 
 
@@ -1103,7 +1455,13 @@ def quickTest():
 
 
 def scanLAT2(dsIn=None, subIn=None, modIn=None):
-    """ ./lat-jobs.py [-q] -lat2 """
+    """ ./lat-jobs.py [-q] -lat2
+    The per-calIdx tuning jobs.  They use the calDB in journal mode (LATDBJOURNAL, see dsi.CalDB),
+    s/t they can run at the same time.  When they're done, merge what they wrote into calDB-v2.json w/:
+        ./lat-jobs.py [-force] -dbMerge
+    Conflicting records (e.g. two jobs setting the same key differently) are listed, and
+    left in the journals unless -force is given.
+    """
 
     skipDS6Cal = True
     cal = dsi.CalInfo()
@@ -1133,12 +1491,12 @@ def scanLAT2(dsIn=None, subIn=None, modIn=None):
 
                 # this does the fitSlo scan
                 for pctTot in [90, 95]:
-                    job = "./lat2.py -scan %d %s %d %d %d" % (ds, key, mod, cIdx, pctTot)
+                    job = "env LATDBJOURNAL=scan%d-%s-c%d ./lat2.py -scan %d %s %d %d %d" % (pctTot, key, cIdx, ds, key, mod, cIdx, pctTot)
                     if useJobQueue: sh("%s >& ./logs/lat2-scan%d-%s-%d.txt" % (job, pctTot, key, cIdx))
                     else: sh("%s '%s'" % (jobStr, job))
 
                 # this does the riseNoise scan
-                # job = "./lat2.py -rscan %d %s %d %d" % (ds, key, mod, cIdx)
+                # job = "env LATDBJOURNAL=rscan-%s-c%d ./lat2.py -rscan %d %s %d %d" % (key, cIdx, ds, key, mod, cIdx)
                 # if useJobQueue: sh("%s >& ./logs/lat2-rise-%s-%d.txt" % (job, key, cIdx))
                 # else: sh("%s '%s'" % (jobStr, job))
 
@@ -1147,7 +1505,7 @@ def cutLAT2():
     """ ./lat-jobs.py [-q] -cuts """
 
     dsList = [0,1,2,3,4,"5A","5B","5C"]
-    # optList = ["","fs","rn","fr"]
+    # optList = ["th,fs,rn,fr"] # all the cut types, in one pass over the files
     optList = ["fr"]
 
     for ds in dsList:
@@ -16,7 +16,6 @@ bkg = dsi.BkgInfo()
 det = dsi.DetInfo()
 cal = dsi.CalInfo()
 import waveLibs as wl
-import tinydb as db
 
 def main():
 
@@ -369,10 +368,8 @@ def thresh_cut_cal():
     """ Adapted from LAT/sandbox/mult2.py, and dependent on input:
     "./data/mult2-dtVals-ene.npz"
     """
-    import tinydb as db
     dsNum, bkgIdx = 5, 83
-    calDB = db.TinyDB('./calDB.json')
-    pars = db.Query()
+    calDB, pars = dsi.getCalDB('./calDB.json'), None
     thD = dsi.getDBRecord("thresh_ds%d_bkgidx%d" % (dsNum, bkgIdx), False, calDB, pars)
     det = dsi.DetInfo()
 
@@ -466,14 +463,12 @@ def ds3_det_eff():
     Plots the combined trigger efficiency from each detector in DS3 separately.
     Also plots the slowness efficiency separately
     """
-    import tinydb as db
     import lat3
     from ROOT import TFile, TTree
     import matplotlib.pyplot as plt
     plt.style.use('./pltReports.mplstyle')
 
-    calDB = db.TinyDB('%s/calDB-v2.json' % (dsi.latSWDir))
-    pars = db.Query()
+    calDB, pars = dsi.getCalDB(), None
     enrExc, natExc,_,_ = lat3.getOutliers(verbose=False, usePass2=False)
 
     # mode = "trig"  # trigger efficiency only
@@ -588,8 +583,9 @@ def ds3_det_eff():
                         if cIdxLo==cIdxHi:
                             covLo, covHi = subLo, subHi
                         else:
-                            runList = bkg.getRunList(ds, bIdx)
-                            subList = [r for r in runList if subLo <= r <= subHi and cal.GetCalIdx(calKey,r) == cIdx]
+                            runs = bkg.getRunArray(ds, bIdx)
+                            runs = runs[(runs >= subLo) & (runs <= subHi)]
+                            subList = runs[cal.GetCalIdxs(calKey, runs) == cIdx].tolist()
                             if len(subList)==0: continue
                             covLo, covHi = subList[0], subList[-1]
 
@@ -941,14 +937,12 @@ def save_slowness_data():
     Saving s/t I can use the thesis plot format on my mac.
     """
     from ROOT import TChain
-    import tinydb as db
 
     ds, cIdx, calKey = 1, 1, "ds1_m1"
 
     # load the fitSlo values for this cIdx
     shiftVals = {}
-    calDB = db.TinyDB('%s/calDB-v2.json' % (dsi.latSWDir))
-    pars = db.Query()
+    calDB, pars = dsi.getCalDB(), None
     fsD = dsi.getDBRecord("fitSlo_%s_idx%d_m2s238" % (calKey, cIdx), False, calDB, pars)
     chList = det.getGoodChanList(ds)
     for ch in chList:
@@ -2190,8 +2184,7 @@ def fitSlo_efficiency_uncertainty():
     if writeDB:
         dbFile = '%s/calDB-v2.json' % (dsi.latSWDir)
         print("Writing results to DB :",dbFile)
-        calDB = db.TinyDB(dbFile)
-        pars = db.Query()
+        calDB, pars = dsi.getCalDB(dbFile), None
 
         # write the lower value
         dbKey = "fitSlo_cpd_effLo%s" % pctTot
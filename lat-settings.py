@@ -6,7 +6,6 @@ Results are used in dsi.py and saved into the calDB.
 =================== C. Wiseman (USC) ===================
 """
 import sys, os, time
-import tinydb as db
 import numpy as np
 
 # LAT libraries
@@ -264,10 +263,10 @@ def getSettings(ds, key, mod, cIdx, writeDB=False):
 
     # fill the DB
     if writeDB:
-        calDB = db.TinyDB("%s/calDB-v2.json" % dsi.latSWDir)
-        pars = db.Query()
-        dsi.setDBRecord({"key":dbKeyTH, "vals":detTH}, forceUpdate=True, calDB=calDB, pars=pars)
-        dsi.setDBRecord({"key":dbKeyHV, "vals":detHV}, forceUpdate=True, calDB=calDB, pars=pars)
+        calDB, pars = dsi.getCalDB(), None
+        with calDB.batch(): # one write for both
+            dsi.setDBRecord({"key":dbKeyTH, "vals":detTH}, forceUpdate=True, calDB=calDB, pars=pars)
+            dsi.setDBRecord({"key":dbKeyHV, "vals":detHV}, forceUpdate=True, calDB=calDB, pars=pars)
         print("DB filled.")
 
 
@@ -287,8 +286,7 @@ def dumpSettings(ds):
     #     print(key, detCH[key])
 
     # get HV and TF vals from DB with a regex
-    calDB = db.TinyDB("%s/calDB-v2.json" % dsi.latSWDir)
-    pars = db.Query()
+    calDB, pars = dsi.getCalDB(), None
     #
     # print("DB Threshold values:")
     # thrList = calDB.search(pars.key.matches("trapThr_ds%d" % ds))
@@ -341,8 +339,7 @@ def fillDetInfo():
     detHV, detTH = {}, {}
 
     # load all possible values, as in settingsMgr
-    detDB = db.TinyDB("%s/calDB-v2.json" % dsi.latSWDir)
-    detPars = db.Query()
+    detDB, detPars = dsi.getCalDB(), None
     cal = dsi.CalInfo()
     for ds in [0,1,2,3,4,5,6]:
     # for ds in [0]:
@@ -631,8 +628,7 @@ def fillThreshDB():
     # Do we actually want to write new values?  Or just print stuff out?
     fillDB = True
 
-    calDB = db.TinyDB("%s/calDB-v2.json" % dsi.latSWDir)
-    pars = db.Query()
+    calDB, pars = dsi.getCalDB(), None
     bkg = dsi.BkgInfo()
 
     # loop over datasets and bkgIdx
@@ -749,8 +745,7 @@ def getThreshDB():
     """ ./chan-sel.py -getThreshDB
     Just an example of getting all threshold values (accounting for sub-bIdx's) from the DB.
     """
-    calDB = db.TinyDB("%s/calDB-v2.json" % dsi.latSWDir)
-    pars = db.Query()
+    calDB, pars = dsi.getCalDB(), None
     bkg = dsi.BkgInfo()
 
     # loop over datasets
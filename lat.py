@@ -22,34 +22,54 @@ Usage:
          [-i [plotNum] interactive mode]
          [-c "custom cut" -- adds custom cut application]
          [-b batch mode -- creates new file]
+         [-n [nWF] block mode -- w/ -b, process waveforms in vectorized blocks of ~nWF hits]
+         [-j [nProc] multicore mode -- w/ -b, spread the block mode PSA over nProc processes]
+         [-u "br1,br2,..." update mode -- w/ -b, read an existing latSkim file, recompute only these branches]
+         [-t timing -- time each PSA stage, print a summary and save it to timing/[name].timing.json in the output directory]
+         [-tb timing, and also save the PSA time of each hit in a 'psaTime' branch (ms)]
+         [-e/--entries [lo] [hi] shard mode -- only process entries lo to hi-1 of those passing cuts.
+            The output has only these entries.  Used by lat-jobs.py to run LAT on an unsplit waveSkim file.]
+         [--shard [i] [n] same, for the i'th of n equal shards]
+         [-warm warm-start the wf fit from the last good fitSlo on the same channel.  Faster, but fitSlo
+            then depends on the order hits are processed in, so it's ignored w/ -j and shard mode,
+            and a killed -warm job is started over instead of resumed.]
+
+In batch mode, the output is saved every 5 min (or ~5 MB) w/ a record of the entries done.  If the
+job is killed, rerunning it w/ the same input, cut and options resumes from the last save.
+When it finishes, a build record is saved w/ the input, options and code versions, which
+lat-jobs.py uses to skip jobs whose output is up to date (see buildGraph.py).
 
 v1: 27 May 2017
 v2: 04 Aug 2017 - improvements to wf fitting, handle multisampling, etc.
 v3: 18 Jan 2018 - update to python3
 v4: 09 Mar 2018 - wf fitting error handling (scipy v1.0 improves convergence!)
+v5: 18 Oct 2026 - block mode: vectorized PSA on blocks of waveforms (-n)
 
 ================ C. Wiseman (USC), B. Zhu (LANL) ================
 """
-import sys, time, os, pywt
-from ROOT import TFile, TTree, TEntryList, gDirectory, TNamed, std, TObject, gROOT
-from ROOT import GATDataSet, MGTEvent, MGTWaveform, MGWFTimePointCalculator
+import sys, time, os, json, pywt
+from ROOT import TFile, TTree, TEntryList, gDirectory, TNamed, std, gROOT
+from ROOT import MGTEvent, MGTWaveform, MGWFTimePointCalculator
 import numpy as np
 from scipy.signal import butter, lfilter, filtfilt
 import scipy.optimize as op
 from scipy.ndimage.filters import gaussian_filter
-from scipy import interpolate
 import scipy.special as sp
 import waveLibs as wl
+import xgFit
+import treeOut
+import buildGraph as bg
 
 def main(argv):
 
     print("=======================================")
     print("LAT started:",time.strftime('%X %x %Z'))
-    startT = time.clock()
+    startT = time.perf_counter()
     # gROOT.ProcessLine("gErrorIgnoreLevel = 3001;") # suppress ROOT error messages
     global batMode
     intMode, batMode, rangeMode, fileMode, gatMode, singleMode, pathMode, cutMode = False, False, False, False, False, False, False, False
-    dontUseTCuts = False
+    dontUseTCuts, blkMode, nBlock, nProc, updList, timeBranch = False, False, 0, 1, None, False
+    entRange, shard, warmStart = None, None, False
     dsNum, subNum, runNum, plotNum = -1, -1, -1, 1
     pathToInput, pathToOutput, manualInput, manualOutput, customPar = ".", ".", "", "", ""
 
@@ -89,6 +109,39 @@ def main(argv):
                 # print('No display found. Using non-interactive Agg backend')
             matplotlib.use('Agg')
             print("Batch mode selected.  A new file will be created.")
+        if opt == "-n":
+            blkMode, nBlock = True, int(argv[i+1])
+            print("Block mode selected.  Processing waveforms in blocks of %d hits." % nBlock)
+        if opt == "-j":
+            nProc = int(argv[i+1])
+            print("Multicore mode selected.  Using %d processes." % nProc)
+        if opt == "-u":
+            updList = set(argv[i+1].split(","))
+            print("Update mode selected.  Recomputing branches:",",".join(sorted(updList)))
+        if opt == "-e" or opt == "--entries":
+            entRange = [int(argv[i+1]), int(argv[i+2])]
+            print("Shard mode.  Processing entries %d to %d passing cuts." % tuple(entRange))
+        if opt == "--shard":
+            shard = [int(argv[i+1]), int(argv[i+2])]
+            print("Shard mode.  Processing shard %d of %d." % tuple(shard))
+        if opt == "-warm":
+            warmStart = True
+            print("Warm-starting the wf fit from the last fitSlo on each channel.")
+        if opt == "-t" or opt == "-tb":
+            timer.enabled, timeBranch = True, opt == "-tb"
+            print("Timing PSA stages.", "Saving per-hit times in psaTime." if timeBranch else "")
+    if nProc > 1 and not blkMode:
+        blkMode, nBlock = True, 100*nProc
+    if blkMode and (intMode or not batMode):
+        print("Block/multicore mode requires batch mode (-b) and no interactive mode (-i).  Processing hits one at a time ...")
+        blkMode, nProc = False, 1
+    if warmStart and (nProc > 1 or entRange is not None or shard is not None):
+        print("Warm-start fitting needs one process and the full entry list.  Fitting from the default fitSlo ...")
+        warmStart = False
+    xgFitter.warmStart = warmStart
+    if updList is not None and (intMode or not batMode):
+        print("Update mode requires batch mode (-b) and no interactive mode (-i).  Exiting ...")
+        return
     import matplotlib.pyplot as plt
     from matplotlib import gridspec
     import matplotlib.ticker as mtick
@@ -102,21 +155,26 @@ def main(argv):
     theCut, inPath, outPath = "", "", ""
 
     # Set input and output files
+    inSkim = "waveSkim" if updList is None else "latSkim"
     if rangeMode:
-        inPath = "%s/waveSkimDS%d_%d.root" % (pathToInput, dsNum, subNum)
+        inPath = "%s/%sDS%d_%d.root" % (pathToInput, inSkim, dsNum, subNum)
         outPath = "%s/latSkimDS%d_%d.root" % (pathToOutput, dsNum, subNum)
     if fileMode:
-        inPath = "%s/waveSkimDS%d_run%d.root" % (pathToInput, dsNum, runNum)
+        inPath = "%s/%sDS%d_run%d.root" % (pathToInput, inSkim, dsNum, runNum)
         outPath = "%s/latSkimDS%d_run%d.root" % (pathToOutput, dsNum, runNum)
     if pathMode:
         inPath, outPath = manualInput, manualOutput
     if gatMode:
+        from ROOT import GATDataSet # loads the GAT libraries, only needed here
         ds = GATDataSet()
         gatPath = ds.GetPathToRun(runNum,GATDataSet.kGatified)
         bltPath = ds.GetPathToRun(runNum,GATDataSet.kBuilt)
         outPath = "%s/lat_run%d.root" % (pathToOutput, runNum)
     if pathMode and gatMode:
         outPath = manualOutput
+    if updList is not None and (gatMode or singleMode or os.path.abspath(inPath)==os.path.abspath(outPath)):
+        print("Update mode needs a latSkim input file (-r, -f, -p), and a different output file.  Exiting ...")
+        return
 
 
     # Initialize trees
@@ -158,11 +216,58 @@ def main(argv):
     print("Found",gatTree.GetEntries(),"input entries.")
     print("Found",nList,"entries passing cuts.")
 
+    # Shard mode (-e, --shard): keep only part of the entry list
+    if shard is not None:
+        entRange = [nList * shard[0] // shard[1], nList * (shard[0]+1) // shard[1]]
+    if entRange is not None:
+        lo, hi = max(0, entRange[0]), min(nList, entRange[1])
+        subList = TEntryList("slist","slist",gatTree)
+        for iList in range(lo, hi): subList.Enter(elist.GetEntry(iList))
+        gatTree.SetEntryList(subList)
+        elist, nList = subList, subList.GetN()
+        print("Shard: entries %d to %d, %d entries." % (lo, hi, nList))
+
+    # channels of the hits passing cuts in each entry
+    hitSel = HitSelection(gatTree, theCut)
+    print("Found",len(hitSel),"hits passing cuts.")
+
+    # Update mode (-u): recompute the requested branches, and anything else that goes w/ them
+    if updList is not None:
+        unknown = updList - set(latBranches)
+        if len(unknown) > 0:
+            print("Unknown LAT branches:",",".join(sorted(unknown)),"  Exiting ...")
+            return
+        if updList & set(fitBranches): updList |= set(fitBranches + fitDepBranches + ("fails",))
+        if not needFit(updList) and needHitPSA(updList) and not gatTree.GetBranch("fitSlo"):
+            print("No fit parameters in the input file, rerunning the xGauss fit.")
+            updList |= set(fitBranches + fitDepBranches + ("fails",))
+        print("Branches to update:",",".join(sorted(updList)))
+        print("Rerun xGauss fit?",needFit(updList))
+
     # Output: In batch mode (-b) only, create an output file+tree & append new branches.
+    # In update mode (-u) the branches being recomputed are left out of the copy.
+    # If there's a partial output file from a killed job w/ the same input, cut and branches, resume it.
+    brKeys = [key for key in latBranches if updList is None or key in updList]
+    if timeBranch: brKeys.append("psaTime")
+    progInfo = {"input":os.path.abspath(inPath if not gatMode else gatPath), "cut":theCut, "nList":nList, "branches":brKeys, "entries":entRange}
+    iStart = 0
     if batMode and not intMode:
-        outFile = TFile(outPath, "RECREATE")
+        # w/ -warm, the fitter state from the killed job is gone, so don't resume
+        iStart = resumePoint(outPath, progInfo) if not warmStart else 0
+        bg.forget(outPath)
+    if iStart > 0:
+        outFile = TFile(outPath, "UPDATE")
+        out = outFile.Get("skimTree")
+        print("Resuming %s at entry %d of %d.  (Delete it to start over.)" % (outPath, iStart, nList))
+    elif batMode and not intMode:
+        outFile = treeOut.openOut(outPath, "lat")
         print("Attempting tree copy to",outPath)
-        out = gatTree.CopyTree("")
+        newBranches = [key for key in latBranches if updList is not None and key in updList]
+        if timeBranch: newBranches.append("psaTime")
+        newBranches = [key for key in newBranches if gatTree.GetBranch(key)]
+        for key in newBranches: gatTree.SetBranchStatus(key,0)
+        out = treeOut.copyTree(gatTree, "", "lat")
+        for key in newBranches: gatTree.SetBranchStatus(key,1)
         out.Write()
         print("Wrote",out.GetEntries(),"entries.")
         cutUsed = TNamed("theCut",theCut)
@@ -187,46 +292,28 @@ def main(argv):
     wfAvgBL, wfRMSBL = std.vector("double")(), std.vector("double")()
     fitErr = std.vector("int")()
 
-    # It's not possible to put the "out.Branch" call into a class initializer (waveLibs::latBranch). You suck, ROOT.
-    b1, b2 = out.Branch("waveS1",waveS1), out.Branch("waveS2",waveS2)
-    b3, b4, b5 = out.Branch("waveS3",waveS3), out.Branch("waveS4",waveS4), out.Branch("waveS5",waveS5)
-    b7, b8 = out.Branch("bcMax",bcMax), out.Branch("bcMin",bcMin)
-    b9, b10 = out.Branch("bandMax",bandMax), out.Branch("bandTime",bandTime)
-    b11, b12, b13 = out.Branch("den10",den10), out.Branch("den50",den50), out.Branch("den90",den90)
-    b14 = out.Branch("oppie",oppie)
-    b15, b16, b17 = out.Branch("fitMu", fitMu), out.Branch("fitAmp", fitAmp), out.Branch("fitSlo", fitSlo)
-    b18, b19 = out.Branch("fitTau",fitTau), out.Branch("fitBL",fitBL)
-    b20, b21, b22 = out.Branch("matchMax", matchMax), out.Branch("matchWidth", matchWidth), out.Branch("matchTime", matchTime)
-    b23, b24, b25, b26 = out.Branch("pol0", pol0), out.Branch("pol1", pol1), out.Branch("pol2", pol2), out.Branch("pol3", pol3)
-    b27, b28, b29 = out.Branch("fails",fails), out.Branch("fitChi2",fitChi2), out.Branch("fitLL",fitLL)
-    b30 = out.Branch("riseNoise",riseNoise)
-    b31, b32, b33, b34 = out.Branch("t0_SLE",t0_SLE), out.Branch("t0_ALE",t0_ALE), out.Branch("lat",lat), out.Branch("latF",latF)
-    b35, b36, b37 = out.Branch("latAF",latAF), out.Branch("latFC",latFC), out.Branch("latAFC",latAFC)
-    b38 = out.Branch("nMS",nMS)
-    b39, b40, b41 = out.Branch("tE50", tE50), out.Branch("latE50", latE50), out.Branch("wfStd", wfStd)
-    b42, b43 = out.Branch("wfAvgBL", wfAvgBL), out.Branch("wfRMSBL", wfRMSBL)
-    b44 = out.Branch("fitErr",fitErr)
-
     # make a dictionary that can be iterated over (avoids code repetition in the loop)
-    brDict = {
-        "waveS1":[waveS1, b1], "waveS2":[waveS2, b2],
-        "waveS3":[waveS3, b3], "waveS4":[waveS4, b4], "waveS5":[waveS5, b5],
-        "bcMax":[bcMax, b7], "bcMin":[bcMin, b8],
-        "bandMax":[bandMax, b9], "bandTime":[bandTime, b10],
-        "den10":[den10, b11], "den50":[den50, b12], "den90":[den90, b13],
-        "oppie":[oppie, b14],
-        "fitMu":[fitMu, b15], "fitAmp":[fitAmp, b16], "fitSlo":[fitSlo, b17],
-        "fitTau":[fitTau, b18], "fitBL":[fitBL,b19],
-        "matchMax":[matchMax, b20], "matchWidth":[matchWidth, b21], "matchTime":[matchTime, b22],
-        "pol0":[pol0, b23], "pol1":[pol1, b24], "pol2":[pol2, b25], "pol3":[pol3, b26],
-        "fails":[fails,b27], "fitChi2":[fitChi2,b28], "fitLL":[fitLL,b29],
-        "riseNoise":[riseNoise,b30],
-        "t0_SLE":[t0_SLE,b31], "t0_ALE":[t0_ALE,b32], "lat":[lat,b33], "latF":[latF,b34],
-        "latAF":[latAF,b35], "latFC":[latFC,b36], "latAFC":[latAFC,b37],
-        "nMS":[nMS,b38], "tE50":[tE50,b39], "latE50":[latE50,b40], "wfStd":[wfStd,b41],
-        "wfAvgBL":[wfAvgBL,b42], "wfRMSBL":[wfRMSBL,b43],
-        "fitErr":[fitErr,b44]
+    # It's not possible to put the "out.Branch" call into a class initializer (waveLibs::latBranch). You suck, ROOT.
+    # In update mode (-u), only the branches being recomputed are added.
+    brVecs = {
+        "waveS1":waveS1, "waveS2":waveS2, "waveS3":waveS3, "waveS4":waveS4, "waveS5":waveS5,
+        "bcMax":bcMax, "bcMin":bcMin, "bandMax":bandMax, "bandTime":bandTime,
+        "den10":den10, "den50":den50, "den90":den90, "oppie":oppie,
+        "fitMu":fitMu, "fitAmp":fitAmp, "fitSlo":fitSlo, "fitTau":fitTau, "fitBL":fitBL,
+        "matchMax":matchMax, "matchWidth":matchWidth, "matchTime":matchTime,
+        "pol0":pol0, "pol1":pol1, "pol2":pol2, "pol3":pol3,
+        "fails":fails, "fitChi2":fitChi2, "fitLL":fitLL, "riseNoise":riseNoise,
+        "t0_SLE":t0_SLE, "t0_ALE":t0_ALE, "lat":lat, "latF":latF,
+        "latAF":latAF, "latFC":latFC, "latAFC":latAFC,
+        "nMS":nMS, "tE50":tE50, "latE50":latE50, "wfStd":wfStd,
+        "wfAvgBL":wfAvgBL, "wfRMSBL":wfRMSBL, "fitErr":fitErr
     }
+    if timeBranch: brVecs["psaTime"] = std.vector("double")()
+    brDict = {key:[brVecs[key], addBranch(out, key, brVecs[key], iStart > 0)] for key in brKeys}
+
+    # save the output tree every 5 min (or ~5 MB of new branch data), w/ a record of how far we got
+    if batMode and not intMode:
+        ckpt = treeOut.Checkpoint(out, "lat", info=progInfo)
 
     # Make a figure (-i option: select different plots)
     # fig = plt.figure()
@@ -283,13 +370,27 @@ def main(argv):
 
     # Load stuff from DS1 forced acq. runs
     npzfile = np.load("%s/data/fft_forcedAcqDS1.npz" % os.environ['LATDIR'])
-    noise_asd, noise_xFreq, avgPwrSpec, xPwrSpec, data_forceAcq, data_fft = npzfile['arr_0'],npzfile['arr_1'],npzfile['arr_2'],npzfile['arr_3'],npzfile['arr_4'],npzfile['arr_5']
+    noise_asd, noise_xFreq, avgPwrSpec, xPwrSpec, data_forceAcq = npzfile['arr_0'],npzfile['arr_1'],npzfile['arr_2'],npzfile['arr_3'],npzfile['arr_4']
+
+    # Remove first 4 samples when we have multisampling
+    # Remove last 2 samples to get rid of the ADC spike at the end of all wf's.
+    truncLo, truncHi = 0, 2
+    if dsNum==6 or dsNum==2: truncLo = 4
+
+    # filter coefficients, noise PSD, and template spectra, computed once per wf length
+    psaCache = PSACache(dsNum, truncLo, truncHi, tOrig, tOrigTS, noise_xFreq, noise_asd)
+
+    # Block mode (-n, -j): vectorized loop over blocks of hits
+    if blkMode:
+        print("Starting block loop ...")
+        if not blockLoop(gatTree, bltTree, gatMode, hitSel, nList, nBlock, brDict, ckpt, psaCache, nProc, updList, iStart): return
 
 
     # Loop over events
-    print("Starting event loop ...")
-    iList = -1
-    while True:
+    if not blkMode: print("Starting event loop ...")
+    iList = iStart - 1
+    blBuf = np.zeros(0) # reused for each hit's baseline-subtracted wf
+    while not blkMode:
         iList += 1
         if intMode==True and iList != 0:
             value = input()
@@ -318,14 +419,12 @@ def main(argv):
         # If you see this value in a plot, then you must be including hits that
         # passed the cut in wave-skim but did not pass the (different?) cut in LAT.
         for key in brDict: brDict[key][0].assign(nChans,-88888)
-        brDict["fails"][0].assign(nChans,0) # set error code to 'true' by default
+        if "fails" in brDict: brDict["fails"][0].assign(nChans,0) # set error code to 'true' by default
         errorCode = [0,0,0,0]
 
 
         # Loop over hits passing cuts
-        numPass = gatTree.Draw("channel",theCut,"GOFF",1,iList)
-        chans = gatTree.GetV1()
-        chanList = list(set(int(chans[n]) for n in range(numPass)))
+        chanList = hitSel.channels(entry)
         hitList = (iH for iH in range(nChans) if gatTree.channel.at(iH) in chanList)  # a 'generator expression'
         for iH in hitList:
 
@@ -355,352 +454,42 @@ def main(argv):
                 return
 
             # Let's start the show - grab a waveform.
-            # Remove first 4 samples when we have multisampling
-            # Remove last 2 samples to get rid of the ADC spike at the end of all wf's.
-            truncLo, truncHi = 0, 2
-            if dsNum==6 or dsNum==2: truncLo = 4
-            signal = wl.processWaveform(wf,truncLo,truncHi)
+            # data and data_blSub are views (of wf and blBuf), only good for this hit.
+            timer.start()
+            hitStart = timer.wallSum
+            if len(blBuf) < wf.GetLength(): blBuf = np.zeros(wf.GetLength())
+            signal = wl.processWaveform(wf,truncLo,truncHi,blBuf)
             data = signal.GetWaveRaw()
             data_blSub = signal.GetWaveBLSub()
             dataTS = signal.GetTS()
             dataBL,dataNoise = signal.GetBaseNoise()
+            timer.lap("wfLoad")
 
-            # wavelet packet transform
-            wp = pywt.WaveletPacket(data_blSub, 'db2', 'symmetric', maxlevel=4)
-            nodes = wp.get_level(4, order='freq')
-            wpCoeff = np.array([n.data for n in nodes],'d')
-            wpCoeff = abs(wpCoeff)
-
-            # wavelet parameters
-            # First get length of wavelet on the time axis, the scale axis will always be the same
-            # due to the number of levels in the wavelet
-            wpLength = len(wpCoeff[1,:])
-            waveS1[iH] = np.sum(wpCoeff[0:1,1:wpLength//4+1]) # python3 : floor division (//) returns an int
-            waveS2[iH] = np.sum(wpCoeff[0:1,wpLength//4+1:wpLength//2+1])
-            waveS3[iH] = np.sum(wpCoeff[0:1,wpLength//2+1:3*wpLength//4+1])
-            waveS4[iH] = np.sum(wpCoeff[0:1,3*wpLength//4+1:-1])
-            waveS5[iH] = np.sum(wpCoeff[2:-1,1:-1])
-            S6 = np.sum(wpCoeff[2:9,1:wpLength//4+1])
-            S7 = np.sum(wpCoeff[2:9,wpLength//4+1:wpLength//2+1])
-            S8 = np.sum(wpCoeff[2:9,wpLength//2+1:3*wpLength//4+1])
-            S9 = np.sum(wpCoeff[2:9,3*wpLength//4+1:-1])
-            S10 = np.sum(wpCoeff[9:,1:wpLength//4+1])
-            S11 = np.sum(wpCoeff[9:,wpLength//4+1:wpLength//2+1])
-            S12 = np.sum(wpCoeff[9:,wpLength//2+1:3*wpLength//4+1])
-            S13 = np.sum(wpCoeff[9:,3*wpLength//4+1:-1])
-            sumList = [S6, S7, S8, S9, S10, S11, S12, S13]
-            bcMax[iH] = np.max(sumList)
-            bcMin[iH] = 1. if np.min(sumList) < 1 else np.min(sumList)
-
-            # reconstruct waveform w/ only lowest frequency.
-            new_wp = pywt.WaveletPacket(data=None, wavelet='db2', mode='symmetric')
-            new_wp['aaa'] = wp['aaa'].data
-            data_wlDenoised = new_wp.reconstruct(update=False)
-            # resize in a smart way
-            diff = len(data_wlDenoised) - len(data_blSub)
-            if diff > 0: data_wlDenoised = data_wlDenoised[diff:]
-
-            # waveform high/lowpass filters - parameters are a little arbitrary
-
-            B1,A1 = butter(2, [1e5/(1e8/2),1e6/(1e8/2)], btype='bandpass')
-            data_bPass = lfilter(B1, A1, data_blSub)
-
-            # used in the multisite tagger
-            B2, A2 = butter(1, 0.08)
-            data_filt = filtfilt(B2, A2, data_blSub)
-            data_filtDeriv = wl.wfDerivative(data_filt)
-            filtAmp = np.amax(data_filtDeriv) # scale the max to match the amplitude
-            data_filtDeriv = data_filtDeriv * (dataENM / filtAmp)
-
-            B3, A3 = butter(2,1e6/(1e8/2), btype='lowpass')
-            data_lPass = lfilter(B3, A3, data_blSub)
-
-            idx = np.where((dataTS > dataTS[0]+100) & (dataTS < dataTS[-1]-100))
-            windowingOffset = dataTS[idx][0] - dataTS[0]
-
-            bandMax[iH] = np.amax(data_bPass[idx])
-            bandTime[iH] = dataTS[ np.argmax(data_bPass[idx])] - windowingOffset
-
-
-            # timepoints of low-pass waveforms
-            tpc = MGWFTimePointCalculator();
-            tpc.AddPoint(.2)
-            tpc.AddPoint(.5)
-            tpc.AddPoint(.9)
-            mgtLowPass = wl.MGTWFFromNpArray(data_lPass)
-            tpc.FindTimePoints(mgtLowPass)
-            den10[iH] = tpc.GetFromStartRiseTime(0)*10
-            den50[iH] = tpc.GetFromStartRiseTime(1)*10
-            den90[iH] = tpc.GetFromStartRiseTime(2)*10
-
-
-            # ================ xgauss waveform fitting ================
-
-            amp, mu, sig, tau, bl = dataENM, dataTSMax, 600., -72000., dataBL
-            floats = np.asarray([amp, mu, sig, tau, bl])
-            temp = xgModelWF(dataTS, floats)
-            if not batMode: MakeTracesGlobal()
-
-            # get the noise of the denoised wf
-            denoisedNoise,_,_ = wl.baselineParameters(data_wlDenoised)
-
-            # NOTE: fit is to wavelet-denoised data, BECAUSE there are no HF components in the model,
-            # AND we'll still calculate fitChi2 w/r/t the data, not the denoised data.
-            # datas = [dataTS, data, dataNoise] # fit data
-            datas = [dataTS, data_wlDenoised + dataBL, denoisedNoise] # fit wavelet-denoised data w/ Bl added back in
-
-            # Set bounds - A,mu,sig,tau,bl.
-            # bnd = ((None,None),(None,None),(None,None),(None,None),(None,None))   # often gets caught at sig=0
-            bnd = ((None,None),(None,None),(2.,None),(-72001.,-71999.),(None,None)) # gets caught much less often.
-
-            # L-BGFS-B with numerical gradient.
-            start = time.clock()
-            result = op.minimize(lnLike, floats, args=datas, method="L-BFGS-B", options=None, bounds=bnd)
-            fitSpeed = time.clock() - start
-
-            fitErr[iH] = 0
-            if not result["success"]:
-                # print("fit fail: ", result["message"])
-                fitErr[iH] = 1
-                errorCode[0] = 1
-
-            amp, mu, sig, tau, bl = result["x"]
-
-            # save parameters
-
-            fitMu[iH], fitAmp[iH], fitSlo[iH], fitTau[iH], fitBL[iH] = mu, amp, sig, tau, bl
-            floats = np.asarray([amp, mu, sig, tau, bl])
-            fit = xgModelWF(dataTS, floats)
-
-            # print("%d/%d iH %d  e %-10.2f  fs %-8.2f  f %d" % (iList, nList, iH, dataENFCal, fitSlo[iH], fitErr[iH]))
-
-            # log-likelihood of this fit
-            fitLL[iH] = result["fun"]
-
-            # chi-square of this fit
-            # Textbook is (observed - expected)^2 / expected,
-            # but we'll follow MGWFCalculateChiSquare.cc and do (observed - expected)^2 / NDF.
-            # NOTE: we're doing the chi2 against the DATA, though the FIT is to the DENOISED DATA.
-            fitChi2[iH] = np.sum(np.square(data-fit)) / (len(data)-1)/dataNoise
-
-
-            # get wavelet coeff's for rising edge only.  normalize to bcMin
-            # view this w/ plot 1
-
-            # find the window of rising edge
-            fit_blSub = fit - bl
-            fitMaxTime = dataTS[np.argmax(fit_blSub)]
-            fitStartTime = dataTS[0]
-            idx = np.where(fit_blSub < 0.1)
-            if len(dataTS[idx] > 0): fitStartTime = dataTS[idx][-1]
-            fitRiseTime50 = (fitMaxTime + fitStartTime)/2.
-
-            # bcMin is 32 samples long in the x-direction.
-            # if we make the window half as wide, it'll have the same # of coeff's as bcMin.
-            # this is still 'cheating' since we're not summing over the same rows.
-            numXRows = wpCoeff.shape[1]
-            wpCtrRise = int((fitRiseTime50 - dataTS[0]) / (dataTS[-1] - dataTS[0]) * numXRows)
-            wpLoRise = wpCtrRise - 8
-            if wpLoRise < 0: wpLoRise = 0
-            wpHiRise = wpCtrRise + 8
-            if wpHiRise > numXRows: wpHiRise = numXRows
-
-            # sum all HF wavelet components for this edge.
-            riseNoise[iH] = np.sum(wpCoeff[2:-1,wpLoRise:wpHiRise]) / bcMin[iH]
-
-            # print("%d %d %d %d e %-5.2f  bmax %-6.2f  bmin %-6.2f  mu %-5.2f  a %-5.2f  s %-5.2f  bl %-5.2f  rn %.2f" % (run,iList,iH,chan,dataENFCal,bcMax[iH],bcMin[iH],fitMu[iH],fitAmp[iH],fitSlo[iH],fitBL[iH],riseNoise[iH]))
-
-            # =========================================================
-
-            # optimal matched filter (freq. domain)
-            # we use the pysiggen fast template (not the fit result) to keep this independent of the wf fitter.
-
-            # pull in the template, shift it, and make sure it's the same length as the data
-            guessTS = tOrigTS - 15000.
-            idx = np.where((guessTS > -5) & (guessTS < dataTS[-1]))
-            guessTS, guess = guessTS[idx], tOrig[idx]
-            if len(guess)!=len(data):
-                if len(guess)>len(data):
-                    guess, guessTS = guess[0:len(data)], guessTS[0:len(data)]
-                else:
-                    guess = np.pad(guess, (0,len(data)-len(guess)), 'edge')
-                    guessTS = np.pad(guessTS, (0,len(data)-len(guessTS)), 'edge')
-
-            data_fft = np.fft.fft(data_blSub) # can also try taking fft of the low-pass data
-            temp_fft = np.fft.fft(guess)
-
-            datafreq = np.fft.fftfreq(data.size) * 1e8
-            power_vec = np.interp(datafreq, noise_xFreq, noise_asd) # load power spectra from file
-
-            # Apply the filter
-            optimal = data_fft * temp_fft.conjugate() / power_vec
-            optimal_time = 2 * np.fft.ifft(optimal)
-
-            # Normalize the output
-            df = np.abs(datafreq[1] - datafreq[0]) # freq. bin size
-            sigmasq = 2 * (temp_fft * temp_fft.conjugate() / power_vec).sum() * df
-            sigma = np.sqrt(np.abs(sigmasq))
-            SNR = abs(optimal_time) / (sigma)
-            oppie[iH] = np.amax(SNR)
-
-
-            # time-domain matched filter.  use the baseline-subtracted wf as data, and fit_blSub too.
-
-            # make a longer best-fit waveform s/t it can be shifted L/R.
-            matchTS = np.append(dataTS, np.arange(dataTS[-1], dataTS[-1] + 20000, 10)) # add 2000 samples
-            match = xgModelWF(matchTS, [amp, mu+10000., sig, tau, bl]) # shift mu accordingly
-            match = match[::-1] - bl # time flip and subtract off bl
-
-            # line up the max of the 'match' (flipped wf) with the max of the best-fit wf
-            # this kills the 1-1 matching between matchTS and dataTS (each TS has some offset)
-            matchMaxTime = matchTS[np.argmax(match)]
-            matchTS = matchTS + (fitMaxTime - matchMaxTime)
-
-            # resize match, matchTS to have same # samples as data, dataTS.
-            # this is the only case we really care about
-            # ("too early" and "too late" also happen, but the shift is larger than the trigger walk, making it unphysical)
-            if matchTS[0] <= dataTS[0] and matchTS[-1] >= dataTS[-1]:
-                idx = np.where((matchTS >= dataTS[0]) & (matchTS <= dataTS[-1]))
-                match, matchTS = match[idx], matchTS[idx]
-                sizeDiff = len(dataTS)-len(matchTS)
-                if sizeDiff < 0:
-                    match, matchTS = match[:sizeDiff], matchTS[:sizeDiff]
-                elif sizeDiff > 0:
-                    match = np.hstack((match, np.zeros(sizeDiff)))
-                    matchTS = np.hstack((matchTS, dataTS[-1*sizeDiff:]))
-                if len(match) != len(data):
-                    print("FIXME: match filter array manip is still broken.")
-
-            # compute match filter parameters
-            matchMax[iH], matchWidth[iH], matchTime[iH] = -888, -888, -888
-            if len(match)==len(data):
-                smoothMF = gaussian_filter(match * data_blSub, sigma=5.)
-                matchMax[iH] = np.amax(smoothMF)
-                matchTime[iH] = matchTS[ np.argmax(smoothMF) ]
-                idx = np.where(smoothMF > matchMax[iH]/2.)
-                if len(matchTS[idx]>1):
-                    matchWidth[iH] = matchTS[idx][-1] - matchTS[idx][0]
-
-
-            # Fit tail slope to polynomial.  Guard against fit fails
-
-            idx = np.where(dataTS >= fitMaxTime)
-            tail, tailTS = data[idx], dataTS[idx]
-            popt1,popt2 = 0,0
-            try:
-                popt1,_ = op.curve_fit(wl.tailModelPol, tailTS, tail)
-                pol0[iH], pol1[iH], pol2[iH], pol3[iH] = popt1[0], popt1[1], popt1[2], popt1[3]
-            except:
-                # print("curve_fit tailModelPol failed, run %i  event %i  channel %i" % (run, iList, chan))
-                errorCode[2] = 1
-                pass
-
-            # =========================================================
-
-            # new trap filters.
-            # params: t0_SLE, t0_ALE, lat, latF, latAF, latFC, latAFC
-
-            # calculate trapezoids
-
-            # standard trapezoid - prone to walking, less sensitive to noise.  use to find energy
-            eTrap = wl.trapFilter(data_blSub, 400, 250, 7200.)
-            eTrapTS = np.arange(0, len(eTrap)*10., 10)
-            eTrapInterp = interpolate.interp1d(eTrapTS, eTrap)
-
-            # short trapezoid - triggers more quickly, sensitive to noise.  use to find t0
-            sTrap = wl.trapFilter(data_blSub, 100, 150, 7200.)
-            sTrapTS = np.arange(0, len(sTrap)*10., 10)
-
-            # asymmetric trapezoid - used to find the t0 only
-            aTrap = wl.asymTrapFilter(data_blSub, 4, 10, 200, True) # (0.04us, 0.1us, 2.0us)
-            aTrapTS = np.arange(0, len(aTrap)*10., 10)
-
-            # find leading edges (t0 times)
-
-            # limit the range from 0 to 10us, and use an ADC threshold of 1.0 as suggested by DCR
-            t0_SLE[iH],_ = wl.walkBackT0(sTrap, eTrapTS[-1]+7000-4000-2000, 1., 0, 1000) # (in ns) finds leading edge from short trap
-            t0_ALE[iH],_ = wl.walkBackT0(aTrap, eTrapTS[-1]+7000-4000-2000, 1., 0, 1000) # (in ns) finds leading edge from asymmetric trap
-
-            # standard energy trapezoid w/ a baseline padded waveform
-            data_pad = np.pad(data_blSub,(200,0),'symmetric')
-            pTrap = wl.trapFilter(data_pad, 400, 250, 7200.)
-            pTrapTS = np.linspace(0, len(pTrap)*10, len(pTrap))
-            pTrapInterp = interpolate.interp1d(pTrapTS, pTrap)
-
-            # calculate energy parameters
-            # standard amplitude.  basically trapEM, but w/o NL correction if the input WF doesn't have it.
-            lat[iH] = np.amax(eTrap)
-
-            # Calculate DCR suggested amplitude, using the 50% to the left and right of the maximum point
-            t0_F50,t0fail1 = wl.walkBackT0(pTrap, thresh=lat[iH]*0.5, rmin=0, rmax=len(pTrap)-1)
-            t0_B50,t0fail2 = wl.walkBackT0(pTrap, thresh=lat[iH]*0.5, rmin=0, rmax=len(pTrap)-1, forward=True)
-            t0_E50 = (t0_F50 + t0_B50)/2.0
-
-            #TODO -- if it's necessary due to the trigger walk, we could potentially add a way to recursively increase the threshold until a timepoint is found, however it will still always fail for most noise events
-            if not t0fail1 or not t0fail2:
-                latE50[iH] = 0 # Set amplitude to 0 if one of the evaluations failed
-            else:
-                latE50[iH] = pTrapInterp(t0_E50) # Maybe I should call this latDCR50 to confuse people
-            tE50[iH] = t0_B50 - t0_F50 # Save the difference between the middle points, can be used as a cut later
-
-            # standard amplitude with t0 from the shorter traps
-            # If either fixed pickoff time (t0) is < 0, use the first sample as the amplitude (energy).
-            latF[iH] = eTrapInterp( np.amax([t0_SLE[iH]-7000+4000+2000, 0.]) ) # This should be ~trapEF
-            latAF[iH] = eTrapInterp( np.amax([t0_ALE[iH]-7000+4000+2000, 0.]) )
-
-            # amplitude from padded trapezoid, with t0 from short traps and a correction function
-            # function is under development.  currently: f() = exp(p0 + p1*E), p0 ~ 7.8, p1 ~ -0.45 and -0.66
-            # functional walk back distance is *either* the minimum of the function value, or 5500 (standard value)
-
-            # t0_corr = -7000+6000+2000 # no correction
-            t0_corr = -7000+6000+2000 - np.amin([np.exp(7.8 - 0.45*lat[iH]),1000.])
-            t0A_corr = -7000+6000+2000 - np.amin([np.exp(7.8 - 0.66*lat[iH]),1000.])
-
-            latFC[iH] = pTrapInterp( np.amax([t0_SLE[iH] + t0_corr, 0.]) )
-            latAFC[iH] = pTrapInterp( np.amax([t0_ALE[iH] + t0A_corr, 0.]) )
-
-
-            # =========================================================
-
-            # the genius multisite event tagger - plot 8
-
-            # decide a threshold
-            dIdx = np.argmax(data_filtDeriv)
-            dMax = data_filtDeriv[dIdx]
-            dRMS,_,_ = wl.baselineParameters(data_filtDeriv)
-            # msThresh = np.amax([dMax * .2, dRMS * 5.])
-            # msThresh = dMax * .15
-            msThresh = 50.  # I don't know.  this seems like a good value
-
-            # run peak detect algorithm
-            maxtab,_ = wl.peakdet(data_filtDeriv, msThresh)
-
-            # profit
-            msList = []
-            for iMax in range(len(maxtab)):
-                idx = int(maxtab[iMax][0])
-                val = maxtab[iMax][1]
-                msList.append(dataTS[idx])
-                # print("%d  idx %d  TS %d  val %.2f  thresh %.2f" % (iList, idx, dataTS[idx], val, msThresh))
-            nMS[iH] = len(maxtab)
-
-            # =========================================================
-            # wfStd analysis
-            wfAvgBL[iH] = dataBL
-            wfRMSBL[iH] = dataNoise
-            wfStd[iH] = np.std(data[5:-5])
+            # calculate waveform parameters (same functions as block mode)
+            vp = vectorPSA(dataTS, data, data_blSub, dataENM, psaCache)
+            hp = {"fitErr":0, "tailErr":0}
+            if needHitPSA(updList):
+                hp = hitPSA(chan, dataTS, data, data_blSub, dataBL, dataNoise, dataENM, dataTSMax, vp, storedFit(gatTree, iH, updList))
+            if hp["fitErr"]==1: errorCode[0] = 1
+            if hp["tailErr"]==1: errorCode[2] = 1
+            fillHit(brDict, iH, errorCode, vp, hp, {"wfAvgBL":dataBL, "wfRMSBL":dataNoise, "psaTime":(timer.wallSum-hitStart)*1000})
 
             # ------------------------------------------------------------------------
             # End waveform processing.
 
-            # Calculate error code
-            fails[iH] = 0
-            for i,j in enumerate(errorCode):
-                if j==1: fails[iH] += int(j)<<i
-            # print("fails:",fails[iH])
-
             # Make plots!
             if batMode: continue
+            wpCoeff, data_wlDenoised, SNR = vp["wpCoeff"], vp["data_wlDenoised"], vp["SNR"]
+            wpLength = wpCoeff.shape[1]
+            data_bPass, data_filt, data_filtDeriv, data_lPass = vp["data_bPass"], vp["data_filt"], vp["data_filtDeriv"], vp["data_lPass"]
+            eTrap, eTrapTS, sTrap, sTrapTS = vp["eTrap"], vp["eTrapTS"], vp["sTrap"], vp["sTrapTS"]
+            aTrap, aTrapTS, pTrap, pTrapTS = vp["aTrap"], vp["aTrapTS"], vp["pTrap"], vp["pTrapTS"]
+            amp, mu, sig, tau, bl = hp["fitAmp"], hp["fitMu"], hp["fitSlo"], hp["fitTau"], hp["fitBL"]
+            temp, fit, fit_blSub, fitSpeed = hp["temp"], hp["fit"], hp["fit_blSub"], hp["fitSpeed"]
+            fitStartTime, fitMaxTime, fitRiseTime50 = hp["fitStartTime"], hp["fitMaxTime"], hp["fitRiseTime50"]
+            wpLoRise, wpHiRise = hp["wpLoRise"], hp["wpHiRise"]
+            match, matchTS, smoothMF = hp["match"], hp["matchTS"], hp.get("smoothMF")
+            tailTS, popt1, msList, msThresh = hp["tailTS"], hp["popt1"], vp["msList"], vp["msThresh"]
             if plotNum==0: # raw data
                 p0.cla()
                 p0.plot(dataTS,data,'b')
@@ -955,19 +744,758 @@ def main(argv):
         if batMode:
             for key in brDict:
                 brDict[key][1].Fill()
-            if iList%5000 == 0 and iList!=0:
-                out.Write("",TObject.kOverwrite)
+            if ckpt.check(iList+1):
                 print("%d / %d entries saved (%.2f %% done), time: %s" % (iList,nList,100*(float(iList)/nList),time.strftime('%X %x %Z')))
 
     # End loop over events
     if batMode and not intMode:
-        out.Write("",TObject.kOverwrite)
+        ckpt.save(nList)
         print("Wrote",out.GetBranch("channel").GetEntries(),"entries in the copied tree,")
-        print("and wrote",b1.GetEntries(),"entries in the new branches.")
+        print("and wrote",list(brDict.values())[0][1].GetEntries(),"entries in the new branches.")
+        outFile.Close()
+        bg.record(outPath, inputs=[] if gatMode else [inPath], code=latCode, params={"args":argv})
 
-    stopT = time.clock()
-    print("Stopped:",time.strftime('%X %x %Z'),"\nProcess time (min):",(stopT - startT)/60)
+    stopT = time.perf_counter()
+    print("Stopped:",time.strftime('%X %x %Z'),"\nRun time (min):",(stopT - startT)/60)
     print(float(nList)/((stopT-startT)/60.),"entries per minute.")
+    print(xgFitter.stats())
+    print(psaCache.stats())
+    if timer.enabled:
+        print(timer.summary())
+        if batMode and not intMode:
+            # in a subdirectory, s/t globs for the output files (e.g. getSplitList) don't pick it up
+            timeDir = os.path.join(os.path.dirname(os.path.abspath(outPath)), "timing")
+            os.makedirs(timeDir, exist_ok=True)
+            timeFile = "%s/%s.timing.json" % (timeDir, os.path.splitext(os.path.basename(outPath))[0])
+            timer.save(timeFile, {"inFile":inPath if not gatMode else gatPath, "outFile":outPath, "nEntries":nList,
+                "nBlock":nBlock if blkMode else 0, "nProc":nProc,
+                "xgFit":{"nFit":xgFitter.nFit, "nFail":xgFitter.nFail, "nFev":xgFitter.nFev, "nIt":xgFitter.nIt}})
+            print("Saved timing summary:",timeFile)
+
+
+# the PSA code path: changes to these functions make a latSkim file stale (see buildGraph.py).
+# the rest of lat.py (option parsing, interactive plots) and the other waveLibs helpers don't.
+latCode = ["lat.py:%s" % f for f in ("HitSelection", "readBlock", "blockPSA", "vectorPSA", "vpRow", "PSACache",
+                                     "fastTemplate", "hitPSA", "evalGaus", "evalXGaus", "xgModelWF",
+                                     "storedFit", "needFit", "needHitPSA", "fillBlock", "fillHit")]
+latCode += ["waveLibs.py:%s" % f for f in ("processWaveform", "wfView", "bufferView", "MGTWFFromNpArray",
+                                           "wpDecompose", "wpDenoise", "wfDerivative", "trapFilter", "asymTrapFilter",
+                                           "walkBackT0", "interpLinear", "baselineParameters", "peakdet", "tailModelPol")]
+latCode += ["xgFit.py:%s" % f for f in ("XGFitter", "lnLike", "nll", "xgModel", "xgShape")]
+
+# LAT branches (in the order they're added to the output tree)
+latBranches = ("waveS1", "waveS2", "waveS3", "waveS4", "waveS5", "bcMax", "bcMin", "bandMax", "bandTime",
+    "den10", "den50", "den90", "oppie", "fitMu", "fitAmp", "fitSlo", "fitTau", "fitBL",
+    "matchMax", "matchWidth", "matchTime", "pol0", "pol1", "pol2", "pol3", "fails", "fitChi2", "fitLL",
+    "riseNoise", "t0_SLE", "t0_ALE", "lat", "latF", "latAF", "latFC", "latAFC",
+    "nMS", "tE50", "latE50", "wfStd", "wfAvgBL", "wfRMSBL", "fitErr")
+
+# branches from the xGauss fit, the ones calculated from the best-fit wf, and the rest of hitPSA's
+fitBranches = ("fitMu", "fitAmp", "fitSlo", "fitTau", "fitBL", "fitChi2", "fitLL", "fitErr")
+fitDepBranches = ("riseNoise", "matchMax", "matchWidth", "matchTime", "pol0", "pol1", "pol2", "pol3")
+hitBranches = fitBranches + fitDepBranches + ("den10", "den50", "den90", "fails")
+
+def needHitPSA(updList):
+    """ Update mode (-u): do any of the branches being recomputed come from hitPSA?
+    updList is None when we're computing all the branches.
+    """
+    return updList is None or len(updList & set(hitBranches)) > 0
+
+def needFit(updList):
+    """ Update mode (-u): are we rerunning the xGauss fit? """
+    return updList is None or len(updList & set(fitBranches)) > 0
+
+def storedFit(gatTree, iH, updList):
+    """ Update mode (-u): if we're not rerunning the xGauss fit, get the best-fit parameters
+    for hit iH from the input latSkim tree.  Returns None if the fit is being rerun.
+    """
+    if needFit(updList): return None
+    return {key:getattr(gatTree,key).at(iH) for key in ("fitAmp","fitMu","fitSlo","fitTau","fitBL","fitErr")}
+
+
+class HitSelection:
+    """ The channels of the hits passing theCut in each entry.  Found w/ one TTree::Draw
+    over the whole tree (w/ its entry list) at the start, instead of one Draw per entry.
+    As before, any hit on a passing channel is processed (see the 'straggler' NOTE in main).
+    """
+    def __init__(self, tree, theCut):
+        nPass = tree.Draw("Entry$:channel", theCut, "GOFF")
+        if nPass > tree.GetEstimate():
+            tree.SetEstimate(nPass + 1)
+            nPass = tree.Draw("Entry$:channel", theCut, "GOFF")
+        ent = wl.bufferView(tree.GetV1(), nPass).astype(np.int64)
+        chan = wl.bufferView(tree.GetV2(), nPass).astype(int)
+        idx = np.argsort(ent, kind="stable")
+        self.ent, self.chan = ent[idx], chan[idx]
+
+    def __len__(self): return len(self.ent)
+
+    def channels(self, entry):
+        """ Set of passing channels in a tree entry. """
+        lo, hi = np.searchsorted(self.ent, [entry, entry+1])
+        return set(self.chan[lo:hi].tolist())
+
+
+def resumePoint(outPath, info):
+    """ Number of entries done in a partial output file from a killed job (see treeOut.Checkpoint),
+    if it was made from the same input, cut and branches, and all the new branches have that
+    many entries.  Otherwise 0, and the output is remade.
+    """
+    prog = treeOut.readProgress(outPath)
+    if prog is None: return 0
+    if any(prog.get(key) != info[key] for key in info):
+        print("Found",outPath,"from a different input, cut, or branch list.  Starting over.")
+        return 0
+    nDone = prog["nDone"]
+    if nDone is None or nDone >= info["nList"]: return 0
+    if any(prog["nFilled"][key] != nDone for key in info["branches"]):
+        print("Branch lengths in",outPath,"don't match the saved progress:",prog["nFilled"],"  Starting over.")
+        return 0
+    return nDone
+
+
+def addBranch(out, key, vec, resume=False):
+    """ Add an output branch for vec, or set the address of the existing branch when resuming. """
+    if not resume: return out.Branch(key, vec)
+    out.SetBranchAddress(key, vec)
+    return out.GetBranch(key)
+
+
+def blockLoop(gatTree, bltTree, gatMode, hitSel, nList, nBlock, brDict, ckpt, cache, nProc=1, updList=None, iStart=0):
+    """ Block mode (-n): read in the hits from consecutive entries until we have at least
+    nBlock waveforms, run vectorPSA on each group of equal-length waveforms at once,
+    then the per-hit stages, and fill the branches in entry order.
+    The output is the same as the one-hit-at-a-time loop in main.
+    Multicore mode (-j): each block is split across a pool of nProc workers, and the main
+    process reads in the next block while the workers are busy.
+    Each worker keeps its own copy of the PSACache.
+    updList is the set of branches being recomputed in update mode (-u), otherwise None.
+    iStart is the first entry to process (> 0 when resuming a killed job).
+    """
+    pool = None
+    if nProc > 1:
+        from multiprocessing import Pool
+        pool = Pool(nProc, psaInit, (cache, updList))
+
+    iList, pending = iStart, None
+    while True:
+        block = None
+        if iList < nList:
+            entList, hits, iList = readBlock(gatTree, bltTree, gatMode, hitSel, nList, iList, nBlock, cache.truncLo, cache.truncHi, updList)
+            if entList is None:
+                if pool is not None: pool.terminate()
+                return False
+            if pool is None:
+                block = (entList, blockPSA(hits, cache, updList))
+            else:
+                nChunk = -(-len(hits) // nProc)
+                chunks = [hits[i:i+nChunk] for i in range(0, len(hits), nChunk)]
+                block = (entList, pool.map_async(psaWorker, chunks))
+
+        # fill the previous block while this one is being processed
+        if pending is not None:
+            entList, results = pending
+            if pool is not None:
+                chunks = results.get()
+                for chunk, times in chunks: timer.add(times)
+                results = [res for chunk, times in chunks for res in chunk]
+            fillBlock(brDict, ckpt, nList, entList, results)
+        if block is None: break
+        pending = block
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return True
+
+
+def readBlock(gatTree, bltTree, gatMode, hitSel, nList, iList, nBlock, truncLo, truncHi, updList=None):
+    """ Read hits passing cuts from consecutive entries, starting at iList, until we have at least nBlock.
+    Returns a list of (iList, nChans, hit indexes) for each entry, the list of hits, and the next iList.
+    The entry list is None if a waveform doesn't match its hit.
+    """
+    entList, hits = [], []
+    while iList < nList and len(hits) < nBlock:
+        entry = gatTree.GetEntryNumber(iList);
+        gatTree.LoadTree(entry)
+        gatTree.GetEntry(entry)
+        nChans = gatTree.channel.size()
+        if gatMode: event = bltTree.event
+
+        chanList = hitSel.channels(entry)
+        hitIdx = []
+        for iH in range(nChans):
+            chan = gatTree.channel.at(iH)
+            if chan not in chanList: continue
+            if gatMode:
+                wf, iEvent = event.GetWaveform(iH), entry
+            else:
+                wf, iEvent = gatTree.MGTWaveforms.at(iH), gatTree.iEvent
+            if wf.GetID() != chan:
+                print("ERROR -- Vector matching failed.  iList %d  run %d  iEvent %d" % (iList,gatTree.run,iEvent))
+                return None, hits, iList
+            timer.start()
+            signal = wl.processWaveform(wf,truncLo,truncHi)
+            dataBL,dataNoise = signal.GetBaseNoise()
+            loadTime = timer.lap("wfLoad")
+            hitIdx.append(len(hits))
+            hits.append({"iH":iH, "chan":chan, "dataTS":signal.GetTS(), "data":signal.GetWaveRaw(), "data_blSub":signal.GetWaveBLSub(),
+                "dataBL":dataBL, "dataNoise":dataNoise, "dataENM":gatTree.trapENM.at(iH),
+                "dataTSMax":gatTree.trapENMSample.at(iH)*10. - 4000, "fitPars":storedFit(gatTree, iH, updList), "psaTime":loadTime})
+        entList.append((iList, nChans, hitIdx))
+        iList += 1
+    return entList, hits, iList
+
+
+def blockPSA(hits, cache, updList=None):
+    """ Run vectorPSA on each group of equal-length waveforms in a list of hits,
+    then hitPSA on each hit.  Returns a list of dicts (same order as hits) w/ the
+    scalar results, i.e. the branch values and error flags.
+    """
+    vpList = [None] * len(hits)
+    groups = {}
+    for i, h in enumerate(hits):
+        groups.setdefault((len(h["dataTS"]), len(h["data"])), []).append(i)
+    psaTime = [h["psaTime"] for h in hits] # w/ timing (-t): the wf load time so far, then each hit's share of vectorPSA
+    for idx in groups.values():
+        start = timer.wallSum
+        vp = vectorPSA(np.stack([hits[i]["dataTS"] for i in idx]), np.stack([hits[i]["data"] for i in idx]),
+            np.stack([hits[i]["data_blSub"] for i in idx]), np.array([hits[i]["dataENM"] for i in idx]), cache)
+        for j, i in enumerate(idx):
+            vpList[i] = vpRow(vp, j)
+            psaTime[i] += (timer.wallSum - start) / len(idx)
+
+    results = []
+    for h, vp, hitTime in zip(hits, vpList, psaTime):
+        start = timer.wallSum
+        hp = {"fitErr":0, "tailErr":0}
+        if needHitPSA(updList):
+            hp = hitPSA(h["chan"], h["dataTS"], h["data"], h["data_blSub"], h["dataBL"], h["dataNoise"], h["dataENM"], h["dataTSMax"], vp, h["fitPars"])
+        res = {key:val for key,val in vp.items() if np.ndim(val)==0}
+        res.update({key:val for key,val in hp.items() if np.ndim(val)==0})
+        res["iH"], res["wfAvgBL"], res["wfRMSBL"] = h["iH"], h["dataBL"], h["dataNoise"]
+        res["psaTime"] = (hitTime + timer.wallSum - start)*1000
+        results.append(res)
+    return results
+
+
+def psaInit(cache, updList=None):
+    """ Process pool initializer for multicore mode (-j). """
+    global batMode, psaCache, psaUpdList
+    batMode, psaCache, psaUpdList = True, cache, updList
+    timer.take()
+
+
+def psaWorker(hits):
+    """ Process pool task for multicore mode (-j): run blockPSA on a chunk of hits.
+    Returns the results, and this chunk's stage times (if timing, -t).
+    """
+    results = blockPSA(hits, psaCache, psaUpdList)
+    return results, timer.take()
+
+
+def fillBlock(brDict, ckpt, nList, entList, results):
+    """ Fill the branches for a block of entries, in entry order.  ckpt is the output's treeOut.Checkpoint. """
+    for iEnt, nChans, hitIdx in entList:
+        for key in brDict: brDict[key][0].assign(nChans,-88888)
+        if "fails" in brDict: brDict["fails"][0].assign(nChans,0)
+        errorCode = [0,0,0,0]
+        for i in hitIdx:
+            res = results[i]
+            if res["fitErr"]==1: errorCode[0] = 1
+            if res["tailErr"]==1: errorCode[2] = 1
+            fillHit(brDict, res["iH"], errorCode, res)
+        for key in brDict:
+            brDict[key][1].Fill()
+        if ckpt.check(iEnt+1):
+            print("%d / %d entries saved (%.2f %% done), time: %s" % (iEnt,nList,100*(float(iEnt)/nList),time.strftime('%X %x %Z')))
+
+
+def fillHit(brDict, iH, errorCode, *results):
+    """ Copy the PSA results (dicts keyed by branch name) for hit iH into the branch vectors,
+    and calculate the error code.
+    """
+    for res in results:
+        for key in res:
+            if key in brDict: brDict[key][0][iH] = res[key]
+        if "fitNFev" in res: xgFitter.count(res["fitErr"]==0, res["fitNFev"], res["fitNIt"])
+    if "fails" not in brDict: return
+    brDict["fails"][0][iH] = 0
+    for i,j in enumerate(errorCode):
+        if j==1: brDict["fails"][0][iH] += int(j)<<i
+
+
+# vectorPSA results that are the same for every hit in a block
+vpShared = ("eTrapTS", "sTrapTS", "aTrapTS", "pTrapTS", "msThresh")
+
+def vpRow(vp, j):
+    """ Get one hit's results out of a vectorPSA block. """
+    return {key:(val if key in vpShared else val[j]) for key,val in vp.items()}
+
+
+def vectorPSA(dataTS, data, data_blSub, dataENM, cache):
+    """ Waveform parameters that can be calculated w/ whole-array operations:
+    wavelet packet parameters, band/low-pass filters, the freq-domain matched filter (oppie),
+    the trap filter parameters, and the multisite tagger.
+    Takes a single hit (1-D arrays, float dataENM), or a block of equal-length waveforms
+    (2-D (nWF, nSamples) arrays, dataENM w/ shape (nWF,)).  Returns a dict of results
+    and intermediate arrays, w/ a leading nWF axis for blocks.
+    'cache' is a PSACache, holding the constants for this wf length.
+    """
+    single = np.ndim(data)==1
+    dataTS, data, data_blSub = np.atleast_2d(dataTS), np.atleast_2d(data), np.atleast_2d(data_blSub)
+    dataENM = np.atleast_1d(dataENM)
+    nWF, nSamp = data.shape
+    rows = np.arange(nWF)
+    timer.start()
+    c = cache.get(nSamp)
+    r = {}
+
+    # wavelet packet transform
+    nodes, wpCoeff = wl.wpDecompose(data_blSub, 4, 'db2', 'symmetric')
+    r["wpCoeff"] = wpCoeff
+
+    # wavelet parameters
+    # First get length of wavelet on the time axis, the scale axis will always be the same
+    # due to the number of levels in the wavelet
+    wpLength = wpCoeff.shape[2]
+    q1, q2, q3 = wpLength//4+1, wpLength//2+1, 3*wpLength//4+1
+    wpSum = lambda s: np.sum(wpCoeff[(slice(None),)+s], axis=(1,2))
+    r["waveS1"] = wpSum(np.s_[0:1,1:q1])
+    r["waveS2"] = wpSum(np.s_[0:1,q1:q2])
+    r["waveS3"] = wpSum(np.s_[0:1,q2:q3])
+    r["waveS4"] = wpSum(np.s_[0:1,q3:-1])
+    r["waveS5"] = wpSum(np.s_[2:-1,1:-1])
+    sumList = np.stack([
+        wpSum(np.s_[2:9,1:q1]), wpSum(np.s_[2:9,q1:q2]), wpSum(np.s_[2:9,q2:q3]), wpSum(np.s_[2:9,q3:-1]),
+        wpSum(np.s_[9:,1:q1]), wpSum(np.s_[9:,q1:q2]), wpSum(np.s_[9:,q2:q3]), wpSum(np.s_[9:,q3:-1])], axis=1)
+    r["bcMax"] = np.max(sumList, axis=1)
+    bcMin = np.min(sumList, axis=1)
+    r["bcMin"] = np.where(bcMin < 1, 1., bcMin)
+
+    # reconstruct waveform w/ only lowest frequency.
+    r["data_wlDenoised"] = wl.wpDenoise(nodes['aaa'], nSamp)
+    timer.lap("wavelet")
+
+    # waveform high/lowpass filters
+    data_bPass = lfilter(c["B1"], c["A1"], data_blSub)
+    r["data_bPass"] = data_bPass
+
+    # used in the multisite tagger
+    r["data_filt"] = filtfilt(c["B2"], c["A2"], data_blSub)
+    data_filtDeriv = wl.wfDerivative(r["data_filt"])
+    filtAmp = np.amax(data_filtDeriv, axis=1) # scale the max to match the amplitude
+    r["data_filtDeriv"] = data_filtDeriv * (dataENM / filtAmp)[:,np.newaxis]
+
+    r["data_lPass"] = lfilter(c["B3"], c["A3"], data_blSub)
+
+    win = (dataTS > dataTS[:,:1]+100) & (dataTS < dataTS[:,-1:]-100)
+    iWin = np.argmax(win, axis=1)
+    windowingOffset = dataTS[rows,iWin] - dataTS[:,0]
+    bPassWin = np.where(win, data_bPass, -np.inf)
+    r["bandMax"] = np.amax(bPassWin, axis=1)
+    r["bandTime"] = dataTS[rows, np.argmax(bPassWin, axis=1) - iWin] - windowingOffset
+    timer.lap("filters")
+
+    # optimal matched filter (freq. domain)
+    # we use the pysiggen fast template (not the fit result) to keep this independent of the wf fitter.
+    # the template spectrum depends on where the wf ends, since the template is cut to match.
+    data_fft = np.fft.fft(data_blSub) # can also try taking fft of the low-pass data
+    SNR = np.zeros(data.shape)
+    for tsLast in np.unique(dataTS[:,-1]):
+        temp_fftConj, sigma = cache.template(nSamp, tsLast)
+
+        # Apply the filter, and normalize the output
+        sel = dataTS[:,-1]==tsLast
+        optimal = data_fft[sel] * temp_fftConj / c["power_vec"]
+        optimal_time = 2 * np.fft.ifft(optimal)
+        SNR[sel] = abs(optimal_time) / (sigma)
+    r["SNR"] = SNR
+    r["oppie"] = np.amax(SNR, axis=1)
+    timer.lap("optimal")
+
+    # new trap filters.
+    # params: t0_SLE, t0_ALE, lat, latF, latAF, latFC, latAFC
+
+    # standard trapezoid - prone to walking, less sensitive to noise.  use to find energy
+    eTrap = wl.trapFilter(data_blSub, 400, 250, 7200.)
+    eTrapTS = np.arange(0, eTrap.shape[1]*10., 10)
+
+    # short trapezoid - triggers more quickly, sensitive to noise.  use to find t0
+    sTrap = wl.trapFilter(data_blSub, 100, 150, 7200.)
+    sTrapTS = np.arange(0, sTrap.shape[1]*10., 10)
+
+    # asymmetric trapezoid - used to find the t0 only
+    aTrap = wl.asymTrapFilter(data_blSub, 4, 10, 200, True) # (0.04us, 0.1us, 2.0us)
+    aTrapTS = np.arange(0, aTrap.shape[1]*10., 10)
+
+    # find leading edges (t0 times)
+    # limit the range from 0 to 10us, and use an ADC threshold of 1.0 as suggested by DCR
+    t0Max = eTrapTS[-1]+7000-4000-2000
+    t0_SLE,_ = wl.walkBackT0(sTrap, t0Max, 1., 0, 1000) # (in ns) finds leading edge from short trap
+    t0_ALE,_ = wl.walkBackT0(aTrap, t0Max, 1., 0, 1000) # (in ns) finds leading edge from asymmetric trap
+
+    # standard energy trapezoid w/ a baseline padded waveform
+    data_pad = np.pad(data_blSub,((0,0),(200,0)),'symmetric')
+    pTrap = wl.trapFilter(data_pad, 400, 250, 7200.)
+    pTrapTS = np.linspace(0, pTrap.shape[1]*10, pTrap.shape[1])
+
+    # calculate energy parameters
+    # standard amplitude.  basically trapEM, but w/o NL correction if the input WF doesn't have it.
+    lat = np.amax(eTrap, axis=1)
+
+    # Calculate DCR suggested amplitude, using the 50% to the left and right of the maximum point
+    t0_F50,t0fail1 = wl.walkBackT0(pTrap, thresh=lat*0.5, rmin=0, rmax=pTrap.shape[1]-1)
+    t0_B50,t0fail2 = wl.walkBackT0(pTrap, thresh=lat*0.5, rmin=0, rmax=pTrap.shape[1]-1, forward=True)
+    t0_E50 = (t0_F50 + t0_B50)/2.0
+
+    # Set amplitude to 0 if one of the evaluations failed
+    r["latE50"] = np.where(t0fail1 & t0fail2, wl.interpLinear(t0_E50, pTrapTS, pTrap), 0)
+    r["tE50"] = t0_B50 - t0_F50 # Save the difference between the middle points, can be used as a cut later
+
+    # standard amplitude with t0 from the shorter traps
+    # If either fixed pickoff time (t0) is < 0, use the first sample as the amplitude (energy).
+    r["latF"] = wl.interpLinear(np.maximum(t0_SLE-7000+4000+2000, 0.), eTrapTS, eTrap) # This should be ~trapEF
+    r["latAF"] = wl.interpLinear(np.maximum(t0_ALE-7000+4000+2000, 0.), eTrapTS, eTrap)
+
+    # amplitude from padded trapezoid, with t0 from short traps and a correction function
+    # function is under development.  currently: f() = exp(p0 + p1*E), p0 ~ 7.8, p1 ~ -0.45 and -0.66
+    # functional walk back distance is *either* the minimum of the function value, or 5500 (standard value)
+    t0_corr = -7000+6000+2000 - np.minimum(np.exp(7.8 - 0.45*lat), 1000.)
+    t0A_corr = -7000+6000+2000 - np.minimum(np.exp(7.8 - 0.66*lat), 1000.)
+    r["latFC"] = wl.interpLinear(np.maximum(t0_SLE + t0_corr, 0.), pTrapTS, pTrap)
+    r["latAFC"] = wl.interpLinear(np.maximum(t0_ALE + t0A_corr, 0.), pTrapTS, pTrap)
+
+    r["t0_SLE"], r["t0_ALE"], r["lat"] = t0_SLE, t0_ALE, lat
+    r["eTrap"], r["sTrap"], r["aTrap"], r["pTrap"] = eTrap, sTrap, aTrap, pTrap
+    timer.lap("trap+t0")
+
+    # the genius multisite event tagger - plot 8
+
+    # decide a threshold
+    data_filtDeriv = r["data_filtDeriv"]
+    dMax = np.amax(data_filtDeriv, axis=1)
+    dRMS,_,_ = wl.baselineParameters(data_filtDeriv)
+    # msThresh = np.amax([dMax * .2, dRMS * 5.])
+    # msThresh = dMax * .15
+    msThresh = 50.  # I don't know.  this seems like a good value
+
+    # run peak detect algorithm
+    maxtab,_ = wl.peakdet(data_filtDeriv, msThresh)
+
+    # profit
+    r["msList"] = [[dataTS[i,int(idx)] for idx,val in tab] for i,tab in enumerate(maxtab)]
+    r["nMS"] = np.array([len(tab) for tab in maxtab])
+    r["msThresh"] = msThresh
+    timer.lap("multisite")
+
+    # wfStd analysis
+    r["wfStd"] = np.std(data[:,5:-5], axis=1)
+    timer.lap("wfStd")
+
+    if single: r = vpRow(r, 0)
+    r["eTrapTS"], r["sTrapTS"], r["aTrapTS"], r["pTrapTS"] = eTrapTS, sTrapTS, aTrapTS, pTrapTS
+    return r
+
+
+class PSACache:
+    """ Constants for vectorPSA that only depend on the dataset and the wf length:
+    filter coefficients, the FFT frequency grid, the noise PSD interpolated onto it,
+    and the template spectrum w/ its normalization.
+    Keyed on (dsNum, nSamples, truncLo, truncHi).  Keeps count of the cache hit rate.
+    """
+    def __init__(self, dsNum, truncLo, truncHi, tOrig, tOrigTS, noise_xFreq, noise_asd):
+        self.dsNum, self.truncLo, self.truncHi = dsNum, truncLo, truncHi
+        self.tOrig, self.tOrigTS = tOrig, tOrigTS
+        self.noise_xFreq, self.noise_asd = noise_xFreq, noise_asd
+        self.consts, self.templates = {}, {}
+        self.nHit, self.nMiss = 0, 0
+
+    def get(self, nSamp):
+        """ Filter coefficients and noise PSD for wf's w/ nSamp samples. """
+        key = (self.dsNum, nSamp, self.truncLo, self.truncHi)
+        if key in self.consts:
+            self.nHit += 1
+            return self.consts[key]
+        self.nMiss += 1
+        c = {}
+
+        # waveform high/lowpass filters - parameters are a little arbitrary
+        c["B1"],c["A1"] = butter(2, [1e5/(1e8/2),1e6/(1e8/2)], btype='bandpass')
+        c["B2"],c["A2"] = butter(1, 0.08)
+        c["B3"],c["A3"] = butter(2,1e6/(1e8/2), btype='lowpass')
+
+        # optimal matched filter (freq. domain)
+        datafreq = np.fft.fftfreq(nSamp) * 1e8
+        c["datafreq"] = datafreq
+        c["power_vec"] = np.interp(datafreq, self.noise_xFreq, self.noise_asd) # load power spectra from file
+        c["df"] = np.abs(datafreq[1] - datafreq[0]) # freq. bin size
+        self.consts[key] = c
+        return c
+
+    def template(self, nSamp, tsLast):
+        """ Conjugate of the template spectrum, and its normalization, for wf's w/ nSamp samples ending at tsLast. """
+        key = (self.dsNum, nSamp, self.truncLo, self.truncHi, tsLast)
+        if key in self.templates:
+            self.nHit += 1
+            return self.templates[key]
+        self.nMiss += 1
+        c = self.consts.get(key[:4]) or self.get(nSamp)
+        guess = fastTemplate(self.tOrig, self.tOrigTS, tsLast, nSamp)
+        temp_fft = np.fft.fft(guess)
+        sigmasq = 2 * (temp_fft * temp_fft.conjugate() / c["power_vec"]).sum() * c["df"]
+        sigma = np.sqrt(np.abs(sigmasq))
+        self.templates[key] = (temp_fft.conjugate(), sigma)
+        return self.templates[key]
+
+    def stats(self):
+        """ Summary string of the cache hit rate. """
+        nTot = self.nHit + self.nMiss
+        if nTot == 0: return "PSA cache: no lookups"
+        return "PSA cache: %d lookups, %d hits (%.2f %%), %d wf lengths, %d templates" % (
+            nTot, self.nHit, 100.*self.nHit/nTot, len(self.consts), len(self.templates))
+
+
+def fastTemplate(tOrig, tOrigTS, tsLast, nSamp):
+    """ Pull in the fast signal template, shift it, and make sure it's the same length as the data. """
+    guessTS = tOrigTS - 15000.
+    idx = np.where((guessTS > -5) & (guessTS < tsLast))
+    guessTS, guess = guessTS[idx], tOrig[idx]
+    if len(guess)!=nSamp:
+        if len(guess)>nSamp:
+            guess = guess[0:nSamp]
+        else:
+            guess = np.pad(guess, (0,nSamp-len(guess)), 'edge')
+    return guess
+
+
+class StageTimer:
+    """ Wall and CPU time of each PSA stage, summed over all hits (-t).
+    Call start() at the beginning of a function, and lap(stage) at the end of each stage:
+    the time since the last start/lap goes to that stage.  Does nothing unless enabled.
+    """
+    stages = ("wfLoad", "wavelet", "filters", "optimal", "trap+t0", "multisite", "wfStd",
+              "timePoints", "xgFit", "matched", "tailFit")
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.wall, self.cpu, self.calls = {}, {}, {}
+        self.wallSum = 0.
+        self.w0, self.c0 = 0., 0.
+        self.runStart = time.perf_counter(), time.process_time()
+
+    def start(self):
+        if not self.enabled: return
+        self.w0, self.c0 = time.perf_counter(), time.process_time()
+
+    def lap(self, stage):
+        """ End a stage and start the next one.  Returns the stage's wall time. """
+        if not self.enabled: return 0.
+        w, c = time.perf_counter(), time.process_time()
+        dw = w - self.w0
+        self.wall[stage] = self.wall.get(stage,0.) + dw
+        self.cpu[stage] = self.cpu.get(stage,0.) + c - self.c0
+        self.calls[stage] = self.calls.get(stage,0) + 1
+        self.wallSum += dw
+        self.w0, self.c0 = w, c
+        return dw
+
+    def take(self):
+        """ Return the totals so far, and reset them.  Multicore mode (-j) workers send these back. """
+        t = (self.wall, self.cpu, self.calls)
+        self.wall, self.cpu, self.calls = {}, {}, {}
+        return t
+
+    def add(self, t):
+        """ Add totals from take(). """
+        for tot, new in zip((self.wall, self.cpu, self.calls), t):
+            for key in new: tot[key] = tot.get(key,0) + new[key]
+
+    def table(self):
+        """ Stage totals: list of (stage, wall, cpu, calls), in processing order. """
+        keys = [key for key in self.stages if key in self.wall] + sorted(set(self.wall) - set(self.stages))
+        return [(key, self.wall[key], self.cpu[key], self.calls[key]) for key in keys]
+
+    def summary(self):
+        """ Table of the stage times, for the log. """
+        nHit = max(self.calls.get("wfLoad",0), 1)
+        tot = max(sum(self.wall.values()), 1e-12)
+        lines = ["PSA stage times (%d hits):" % self.calls.get("wfLoad",0),
+                 "%-12s %10s %10s %8s %12s %7s" % ("stage", "wall (s)", "cpu (s)", "calls", "ms/hit", "frac")]
+        for key, wall, cpu, calls in self.table():
+            lines.append("%-12s %10.2f %10.2f %8d %12.3f %6.1f%%" % (key, wall, cpu, calls, 1000*wall/nHit, 100*wall/tot))
+        lines.append("%-12s %10.2f %10.2f" % ("total", sum(self.wall.values()), sum(self.cpu.values())))
+        lines.append("%-12s %10.2f %10.2f" % ("run", time.perf_counter()-self.runStart[0], time.process_time()-self.runStart[1]))
+        return "\n".join(lines)
+
+    def save(self, fileName, info):
+        """ Write the stage times (and 'info', a dict) to a JSON file. """
+        out = dict(info)
+        out["nHits"] = self.calls.get("wfLoad",0)
+        out["stages"] = {key:{"wall":wall, "cpu":cpu, "calls":calls} for key, wall, cpu, calls in self.table()}
+        out["run"] = {"wall":time.perf_counter()-self.runStart[0], "cpu":time.process_time()-self.runStart[1]}
+        with open(fileName, "w") as f:
+            json.dump(out, f, indent=2)
+
+
+def hitPSA(chan, dataTS, data, data_blSub, dataBL, dataNoise, dataENM, dataTSMax, vp, fitPars=None):
+    """ Waveform parameters that still need one hit at a time: low-pass time points,
+    the xGauss fit (and riseNoise), the time-domain matched filter, and the tail fit.
+    'vp' is this hit's vectorPSA output.
+    'fitPars' (update mode, see storedFit): skip the fit, and use these best-fit parameters instead.
+    Returns a dict of results and intermediate arrays.
+    """
+    timer.start()
+    r = {}
+
+    # timepoints of low-pass waveforms
+    tpc = MGWFTimePointCalculator();
+    tpc.AddPoint(.2)
+    tpc.AddPoint(.5)
+    tpc.AddPoint(.9)
+    mgtLowPass = wl.MGTWFFromNpArray(vp["data_lPass"])
+    tpc.FindTimePoints(mgtLowPass)
+    r["den10"] = tpc.GetFromStartRiseTime(0)*10
+    r["den50"] = tpc.GetFromStartRiseTime(1)*10
+    r["den90"] = tpc.GetFromStartRiseTime(2)*10
+    timer.lap("timePoints")
+
+    # ================ xgauss waveform fitting ================
+
+    if fitPars is None:
+        # initial guess from the trap filter.  fitSlo is the default, or the last hit on this channel w/ -warm
+        floats = xgFitter.guess(chan, dataENM, dataTSMax, dataBL)
+        r["temp"] = xgModelWF(dataTS, floats)
+        if not batMode: MakeTracesGlobal()
+
+        # get the noise of the denoised wf
+        data_wlDenoised = vp["data_wlDenoised"]
+        denoisedNoise,_,_ = wl.baselineParameters(data_wlDenoised)
+
+        # NOTE: fit is to wavelet-denoised data, BECAUSE there are no HF components in the model,
+        # AND we'll still calculate fitChi2 w/r/t the data, not the denoised data.
+        # datas = [dataTS, data, dataNoise] # fit data
+        datas = [dataTS, data_wlDenoised + dataBL, denoisedNoise] # fit wavelet-denoised data w/ Bl added back in
+
+        # L-BGFS-B with analytic gradient, tau fixed, and sig >= 2 (often gets caught at sig=0 otherwise)
+        start = time.process_time()
+        result = xgFitter.fit(datas[0], datas[1], datas[2], floats, chan, None if batMode else fillTraces)
+        r["fitSpeed"] = time.process_time() - start
+        r["fitNFev"], r["fitNIt"] = result["nfev"], result["nit"]
+
+        r["fitErr"] = 0
+        if not result["success"]:
+            # print("fit fail: ", result["message"])
+            r["fitErr"] = 1
+
+        # save parameters
+        amp, mu, sig, tau, bl = result["x"]
+        r["fitMu"], r["fitAmp"], r["fitSlo"], r["fitTau"], r["fitBL"] = mu, amp, sig, tau, bl
+
+        # log-likelihood of this fit
+        r["fitLL"] = result["fun"]
+    else:
+        # update mode: reuse the fit from the input file
+        amp, mu, sig, tau, bl = fitPars["fitAmp"], fitPars["fitMu"], fitPars["fitSlo"], fitPars["fitTau"], fitPars["fitBL"]
+        r["fitErr"] = fitPars["fitErr"]
+
+    floats = np.asarray([amp, mu, sig, tau, bl])
+    fit = xgModelWF(dataTS, floats)
+    r["fit"] = fit
+
+    # chi-square of this fit
+    # Textbook is (observed - expected)^2 / expected,
+    # but we'll follow MGWFCalculateChiSquare.cc and do (observed - expected)^2 / NDF.
+    # NOTE: we're doing the chi2 against the DATA, though the FIT is to the DENOISED DATA.
+    r["fitChi2"] = np.sum(np.square(data-fit)) / (len(data)-1)/dataNoise
+
+    # get wavelet coeff's for rising edge only.  normalize to bcMin
+    # view this w/ plot 1
+
+    # find the window of rising edge
+    fit_blSub = fit - bl
+    fitMaxTime = dataTS[np.argmax(fit_blSub)]
+    fitStartTime = dataTS[0]
+    idx = np.where(fit_blSub < 0.1)
+    if len(dataTS[idx] > 0): fitStartTime = dataTS[idx][-1]
+    fitRiseTime50 = (fitMaxTime + fitStartTime)/2.
+
+    # bcMin is 32 samples long in the x-direction.
+    # if we make the window half as wide, it'll have the same # of coeff's as bcMin.
+    # this is still 'cheating' since we're not summing over the same rows.
+    wpCoeff = vp["wpCoeff"]
+    numXRows = wpCoeff.shape[1]
+    wpCtrRise = int((fitRiseTime50 - dataTS[0]) / (dataTS[-1] - dataTS[0]) * numXRows)
+    wpLoRise = wpCtrRise - 8
+    if wpLoRise < 0: wpLoRise = 0
+    wpHiRise = wpCtrRise + 8
+    if wpHiRise > numXRows: wpHiRise = numXRows
+
+    # sum all HF wavelet components for this edge.
+    r["riseNoise"] = np.sum(wpCoeff[2:-1,wpLoRise:wpHiRise]) / vp["bcMin"]
+
+    r["fit_blSub"], r["fitMaxTime"], r["fitStartTime"], r["fitRiseTime50"] = fit_blSub, fitMaxTime, fitStartTime, fitRiseTime50
+    r["wpLoRise"], r["wpHiRise"] = wpLoRise, wpHiRise
+    timer.lap("xgFit")
+
+    # =========================================================
+
+    # time-domain matched filter.  use the baseline-subtracted wf as data, and fit_blSub too.
+
+    # make a longer best-fit waveform s/t it can be shifted L/R.
+    matchTS = np.append(dataTS, np.arange(dataTS[-1], dataTS[-1] + 20000, 10)) # add 2000 samples
+    match = xgModelWF(matchTS, [amp, mu+10000., sig, tau, bl]) # shift mu accordingly
+    match = match[::-1] - bl # time flip and subtract off bl
+
+    # line up the max of the 'match' (flipped wf) with the max of the best-fit wf
+    # this kills the 1-1 matching between matchTS and dataTS (each TS has some offset)
+    matchMaxTime = matchTS[np.argmax(match)]
+    matchTS = matchTS + (fitMaxTime - matchMaxTime)
+
+    # resize match, matchTS to have same # samples as data, dataTS.
+    # this is the only case we really care about
+    # ("too early" and "too late" also happen, but the shift is larger than the trigger walk, making it unphysical)
+    if matchTS[0] <= dataTS[0] and matchTS[-1] >= dataTS[-1]:
+        idx = np.where((matchTS >= dataTS[0]) & (matchTS <= dataTS[-1]))
+        match, matchTS = match[idx], matchTS[idx]
+        sizeDiff = len(dataTS)-len(matchTS)
+        if sizeDiff < 0:
+            match, matchTS = match[:sizeDiff], matchTS[:sizeDiff]
+        elif sizeDiff > 0:
+            match = np.hstack((match, np.zeros(sizeDiff)))
+            matchTS = np.hstack((matchTS, dataTS[-1*sizeDiff:]))
+        if len(match) != len(data):
+            print("FIXME: match filter array manip is still broken.")
+    r["match"], r["matchTS"] = match, matchTS
+
+    # compute match filter parameters
+    r["matchMax"], r["matchWidth"], r["matchTime"] = -888, -888, -888
+    if len(match)==len(data):
+        smoothMF = gaussian_filter(match * data_blSub, sigma=5.)
+        r["matchMax"] = np.amax(smoothMF)
+        r["matchTime"] = matchTS[ np.argmax(smoothMF) ]
+        idx = np.where(smoothMF > r["matchMax"]/2.)
+        if len(matchTS[idx]>1):
+            r["matchWidth"] = matchTS[idx][-1] - matchTS[idx][0]
+        r["smoothMF"] = smoothMF
+    timer.lap("matched")
+
+    # Fit tail slope to polynomial.  Guard against fit fails
+
+    idx = np.where(dataTS >= fitMaxTime)
+    tail, tailTS = data[idx], dataTS[idx]
+    popt1,popt2 = 0,0
+    r["tailErr"] = 0
+    try:
+        popt1,_ = op.curve_fit(wl.tailModelPol, tailTS, tail)
+        r["pol0"], r["pol1"], r["pol2"], r["pol3"] = popt1[0], popt1[1], popt1[2], popt1[3]
+    except:
+        # print("curve_fit tailModelPol failed, run %i  event %i  channel %i" % (run, iList, chan))
+        r["tailErr"] = 1
+        pass
+    r["tailTS"], r["popt1"] = tailTS, popt1
+    timer.lap("tailFit")
+
+    return r
 
 
 def evalGaus(x,mu,sig):
@@ -1019,35 +1547,25 @@ def xgModelWF(dataTS, floats):
 
 
 def MakeTracesGlobal():
-    """ This is so 'lnLike' can write to the trace arrays. Has to remain in this file to work. """
+    """ This is so 'fillTraces' can write to the trace arrays. Has to remain in this file to work. """
     tmp1, tmp2, tmp3, tmp4, tmp5 = [], [], [], [], []
     global ampTr, muTr, sigTr, tauTr, blTr
     ampTr, muTr, sigTr, tauTr, blTr = tmp1, tmp2, tmp3, tmp4, tmp5
 
 
-def lnLike(floats, *datas):
-    """ log-likelihood function: L(A,mu,sig,tau)
-    To make this work with op.minimize, 'datas' is passed in as a tuple (the asterisk),
-    where the original list is the 1st element.
-    """
-    amp, mu, sig, tau, bl = floats
-    tau = -72000. # manually fix tau
+def fillTraces(amp, mu, sig, tau, bl):
+    """ Fit callback: save the parameters at each step of the wf fit (interactive mode only). """
+    global ampTr, muTr, sigTr, tauTr, blTr
+    ampTr.append(amp)
+    muTr.append(mu)
+    sigTr.append(sig)
+    tauTr.append(tau)
+    blTr.append(bl)
 
-    # Only fill traces when we're not in batch mode
-    global batMode
-    if not batMode:
-        global ampTr, muTr, sigTr, tauTr, blTr
-        ampTr.append(amp)
-        muTr.append(mu)
-        sigTr.append(sig)
-        tauTr.append(tau)
-        blTr.append(bl)
-
-    dataTS, data, dataNoise = datas[0][0], datas[0][1], datas[0][2]
-
-    model = xgModelWF(dataTS, [amp, mu, sig, tau, bl])
-    lnLike = 0.5 * np.sum ( np.power((data-model)/dataNoise, 2) - np.log( 1 / np.power(dataNoise,2) ) )
-    return lnLike
+
+# wf fitter.  keeps the fit call counts, and w/ -warm, the last good fitSlo for each channel.
+xgFitter = xgFit.XGFitter()
+timer = StageTimer()
 
 
 if __name__ == "__main__":
@@ -10,24 +10,21 @@ PSA cuts applied.
 """
 import sys, os, time
 import numpy as np
-import tinydb as db
-from scipy.optimize import curve_fit
-
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-plt.style.use('pltReports.mplstyle')
-from matplotlib.colors import LogNorm, Normalize
+# matplotlib, scipy and ROOT are imported in the functions that use them
 
 import waveLibs as wl
 import dsi
-bkg = dsi.BkgInfo()
-cal = dsi.CalInfo()
-det = dsi.DetInfo()
+import treeOut
+import buildGraph as bg
+bkg = dsi.Lazy(dsi.BkgInfo)
+cal = dsi.Lazy(dsi.CalInfo)
+det = dsi.Lazy(dsi.DetInfo)
+writeDB, forceBuild, dryRun = False, False, False
 
 def main(argv):
 
-    global writeDB
-    writeDB = False
+    global writeDB, forceBuild, dryRun
+    writeDB, forceBuild, dryRun = False, False, False
     ds, cIdx, mod = None, None, None
 
     # a very important parameter, use 90 or 95
@@ -46,6 +43,10 @@ def main(argv):
             mod = int(argv[i+1])
         if opt=="-db":
             writeDB = True
+        if opt=="-force":
+            forceBuild = True
+        if opt=="-dry":
+            dryRun = True
 
         # wrapper function for scanRunsSlo
         if opt=="-load":
@@ -83,7 +84,7 @@ def main(argv):
             useWide = bool(argv[i+2])
             saveSloPanda(pctTot, useDBCut, useWide)
 
-        # generate cut files (specify cut type: (blank) fs rn fr, and pctTot: 90 or 95)
+        # generate cut files (specify cut type: th fs rn fr, or several e.g. fs,rn,fr, and pctTot: 90 or 95)
         if opt=="-cut":
             cutType = argv[i+1]
             pctTot = argv[i+2]
@@ -443,8 +444,7 @@ def saveSloPanda(pctTot, bUseDB=True, bWide=False):
     if bUseDB:
         dbFile = '%s/calDB-v2.json' % (dsi.latSWDir)
         print("Using DB values from:",dbFile)
-        calDB = db.TinyDB(dbFile)
-        pars = db.Query()
+        calDB, pars = dsi.getCalDB(dbFile), None
 
         # Group the total DF into smaller DFs by unique cpd1, key, and cIdx combinations
         dfg = df.groupby(['key', 'cIdx', 'cpd1', 'cpd2'])
@@ -527,12 +527,15 @@ def setSloCut(pctTot):
         and
     "fitSlo_cpd_eff[pctTot]" : {cpd:[fsShiftCut, nBin, amp, sig, mu, ampE, sigE, muE] for cpd in detList}
     """
+    import matplotlib.pyplot as plt
+    plt.style.use('pltReports.mplstyle')
+    from matplotlib.colors import LogNorm
+    from scipy.optimize import curve_fit
     from statsmodels.stats import proportion
     if writeDB:
         dbFile = '%s/calDB-v2.json' % (dsi.latSWDir)
         print("Writing results to DB :",dbFile)
-        calDB = db.TinyDB(dbFile)
-        pars = db.Query()
+        calDB, pars = dsi.getCalDB(dbFile), None
 
     print("Setting m2s238 slow cut with pctTot == %d" % pctTot)
 
@@ -1017,12 +1020,14 @@ def setRiseCut():
     riseNoise DB entries:
     {"key":"riseNoise_%s_ci%d_pol", "vals": {ch:[a,b,c99,c,fitPass] for ch in goodList} }
     """
+    import matplotlib.pyplot as plt
+    plt.style.use('pltReports.mplstyle')
+    from scipy.optimize import curve_fit
     makePlots = False
     if writeDB:
         dbFile = '%s/calDB-v2.json' % (dsi.latSWDir)
         print("Writing results to DB :",dbFile)
-        calDB = db.TinyDB(dbFile)
-        pars = db.Query()
+        calDB, pars = dsi.getCalDB(dbFile), None
 
     dsList = [0,1,2,3,4,5,6]
     # dsList = [0]
@@ -1153,6 +1158,9 @@ def riseStability():
     """ ./lat2.py -rs
     Track problem channels in riseNoise and return a (suggested)
     list of channels to cut, along w/ a diagnostic plot. """
+    import matplotlib.pyplot as plt
+    plt.style.use('pltReports.mplstyle')
+    from matplotlib.colors import LogNorm
 
     # dsList = [0,1,2,3,4,5]
     # dsList = [0]
@@ -1161,8 +1169,7 @@ def riseStability():
     makeStabilityPlot = False
     makeChannelPlots = True
 
-    calDB = db.TinyDB('%s/calDB-v2.json' % (dsi.latSWDir))
-    pars = db.Query()
+    calDB, pars = dsi.getCalDB(), None
 
     for ds in dsList:
         print("Scanning DS",ds)
@@ -1431,8 +1438,7 @@ def badRiseChans():
 
     # load DB vals : {calIdx: {ch:[a,b,c99,c,fitPass] for ch in goodList} }}
     dbFile = '%s/calDB-v2.json' % (dsi.latSWDir)
-    calDB = db.TinyDB(dbFile)
-    pars = db.Query()
+    calDB, pars = dsi.getCalDB(dbFile), None
     for calKey in removeList:
         for ch in removeList[calKey]:
             badIdx = removeList[calKey][ch]
@@ -1452,22 +1458,25 @@ def badRiseChans():
                     dsi.setDBRecord({"key":dbKey, "vals":dbVals}, True, dbFile, calDB, pars)
 
 
-def applyCuts(ds, cutType, pctTot):
-    """ ./lat2.py -ds [N] -cut [cutType] [pctTot]
+def applyCuts(ds, cutTypes, pctTot):
+    """ ./lat2.py [-dry] [-force] -ds [N] -cut [cutType] [pctTot]
     DS values:
         0, 1, 2, 3, 4, 5A, 5B, 5C
     Cut types:
-        -cut [blank]: threshold cut only
+        -cut th : threshold cut only
         -cut fs : threshold + fitSlo
         -cut rn : threshold + riseNoise
         -cut fr : threshold + fitSlo + riseNoise
+    Several types can be made together, e.g. -cut th,fs,rn,fr 95.  The latSkim files of each
+    bkgIdx are read once (see fanOut), for all the channels and cut types.
+    Only makes the files that are stale (see buildGraph.py): missing, or made from different
+    latSkim files, calDB records, cut strings, or code (applyCuts, fanOut, dsi.CutSet).
+        -dry   : list the files that would be made, and why
+        -force : make all of them
     """
-    from ROOT import gROOT, TFile, TChain, TTree, TNamed, MGTWaveform
+    from ROOT import gROOT, TFile, TChain, MGTWaveform
     gROOT.ProcessLine("gErrorIgnoreLevel = 3001;")
-
-    # if this is set, don't overwrite good files.
-    cleanupMode = False
-    print("CLEANUP MODE?",cleanupMode)
+    nStale, nGood = 0, 0
 
     # if this is set, check that we get all files we should. (instead of writing new ones)
     checkMode = False
@@ -1476,9 +1485,13 @@ def applyCuts(ds, cutType, pctTot):
     # NOTE: input for DS5 must be 5A, 5B, or 5C, not 5.
     dsNum = int(ds[0]) if isinstance(ds, str) else int(ds)
     print("Generating cut files for DS-%s (%d) ..." % (ds, dsNum))
+    cutTypes = cutTypes.split(",") if isinstance(cutTypes, str) else cutTypes
+    cutDirs = {"th":"th", "fs":"fs", "rn":"rn", "fr":"fr%s" % pctTot}
+    if any(cutType not in cutDirs for cutType in cutTypes):
+        print("Unknown cut type in:",",".join(cutTypes))
+        return
 
-    calDB = db.TinyDB('%s/calDB-v2.json' % (dsi.latSWDir))
-    pars = db.Query()
+    calDB, pars = dsi.getCalDB(), None
     dsMap = bkg.dsMap() # number of bIdx's
     bkgRanges = bkg.getRanges(ds)
     calKeys = cal.GetKeys(dsNum)
@@ -1491,68 +1504,50 @@ def applyCuts(ds, cutType, pctTot):
         chList = det.getGoodChanList(dsNum, mod)
 
         for bIdx in bkgRanges:
-            bkgDict, calDict, _,_ = dsi.GetDBCuts(ds,bIdx,mod,cutType,calDB,pars,pctTot)
-
-            # # debug block
-            # if bIdx!=32:continue
-            # if bIdx==32:
-            #     bkgDict, calDict = dsi.GetDBCuts(ds,bIdx,mod,cutType,calDB,pars,True)
-            #     for ch in sorted(bkgDict):
-            #         print(ch, bkgDict[ch])
-            #     for ch in calDict:
-            #         print(ch, calDict[ch])
-
-            # get the list of LAT files for this bkgIdx
-            latList = dsi.getSplitList("%s/latSkimDS%d_%d*" % (dsi.latDir, dsNum, bIdx), bIdx)
-            fileList = [f for idx, f in sorted(latList.items())]
-            skimTree = TChain("skimTree")
-            for f in fileList: skimTree.Add(f)
-            # f = TFile(fileList[0])
-            # theCut = f.Get("theCut").GetTitle() # don't need to reapply this
 
-            for ch in chList:
-                cpd = det.getChanCPD(dsNum,ch)
+            # the cut files for this bkgIdx, for each of the cut types
+            outList = []
+            for cutType in cutTypes:
+                dbKeys = []
+                cuts = dsi.CutSet(ds,bIdx,mod,cutType,calDB,pars,pctTot,dbKeys=dbKeys)
 
-                # check the TCut string
-                thData = True if ch in bkgDict.keys() else False
-                fsData = True if ch in calDict.keys() and "fitSlo" in calDict[ch] else False
-                rnData = True if ch in calDict.keys() and "riseNoise" in calDict[ch] else False
+                # # debug block
+                # if bIdx!=32:continue
+                # if bIdx==32:
+                #     for ch in sorted(cuts.thr):
+                #         print(ch, cuts.bkgCut(ch), cuts.calCut(ch))
 
-                # print("DS%d  bIdx %d  ch %d  cpd %s  th %d  fs %d  rn %d" % (dsNum,bIdx,ch,cpd,int(thData),int(fsData),int(rnData)))
+                for ch in chList:
+                    cpd = det.getChanCPD(dsNum,ch)
 
-                # ** thresholds are REQUIRED **
-                if not thData: continue
-                chanCut = "channel==%d && %s" % (ch, bkgDict[ch])
-                outFile = "%s/th/th_ds%d_%d_ch%d.root" % (dsi.cutDir,dsNum,bIdx,ch)
+                    # check the cut tables
+                    thData = True if ch in cuts.thr else False
+                    calData = True if ch in cuts.cal else False
 
-                if cutType=="fs" and fsData:
-                    outFile = "%s/fs/fs_ds%d_%d_ch%d.root" % (dsi.cutDir,dsNum,bIdx,ch)
-                    chanCut += "&& fitSlo>0 && %s" % calDict[ch]
+                    # print("DS%d  bIdx %d  ch %d  cpd %s  th %d  %s %d" % (dsNum,bIdx,ch,cpd,int(thData),cutType,int(calData)))
 
-                elif cutType=="rn" and rnData:
-                    outFile = "%s/rn/rn_ds%d_%d_ch%d.root" % (dsi.cutDir,dsNum,bIdx,ch)
-                    chanCut += "&& %s" % calDict[ch]
+                    # ** thresholds are REQUIRED ** (chanCut is None w/o them, or w/o this type's cal cuts)
+                    chanCut = cuts.chanCut(ch)
+                    if chanCut is None: continue
+                    outFile = "%s/%s/%s_ds%d_%d_ch%d.root" % (dsi.cutDir,cutDirs[cutType],cutType,dsNum,bIdx,ch)
 
-                elif cutType=="fr" and fsData and rnData:
-                    outFile = "%s/fr%s/fr_ds%d_%d_ch%d.root" % (dsi.cutDir,pctTot,dsNum,bIdx,ch)
-                    chanCut += "&& %s" % calDict[ch]
+                    # debug: just print cuts
+                    # print(ch, chanCut)
+                    # continue
 
-                else:
-                    continue
+                    outList.append((outFile, ch, chanCut, cuts, dbKeys, "DS%d  bIdx %d  ch %d  cpd %s  th %d  %s %d" % (dsNum,bIdx,ch,cpd,int(thData),cutType,int(calData))))
 
-                # debug: just print cuts
-                # if ch in bkgDict.keys():
-                #     print(ch, chanCut)
-                # else:
-                #     print(ch, None)
-                # continue
+            # get the list of LAT files for this bkgIdx
+            latList = dsi.getSplitList("%s/latSkimDS%d_%d*" % (dsi.latDir, dsNum, bIdx), bIdx)
+            fileList = [f for idx, f in sorted(latList.items())]
 
-                # do file integrity checks (instead of making new output)
-                if checkMode:
+            # do file integrity checks (instead of making new output)
+            if checkMode:
+                for outFile, ch, chanCut, cuts, dbKeys, info in outList:
 
                     if not os.path.isfile(outFile):
                         print("File not found:",outFile)
-                        print("DS%d  bIdx %d  ch %d  cpd %s  th %d  fs %d  rn %d" % (dsNum,bIdx,ch,cpd,int(thData),int(fsData),int(rnData)))
+                        print(info)
                         exit(1)
 
                     cutFile = TFile(outFile)
@@ -1575,41 +1570,90 @@ def applyCuts(ds, cutType, pctTot):
                     print("%s: nEnt %-8d nDraw %-8d" % (outFile.split("/")[-1], nEnt, n))
 
                     cutFile.Close()
-                    continue
+                continue
 
-                # if a file exists, only recreate it if it's bad.
-                makeNew = True
-                if cleanupMode:
-                    # let's try an idea from a Rene Brun forum post from 2002.  Ugggg
-                    if os.path.isfile(outFile):
-                        makeNew = False
-                        fTmp = TFile(outFile)
-                        if fTmp.IsZombie():
-                            print("zombie:",outFile)
-                            makeNew = True
-                        elif fTmp.TestBit(TFile.kRecovered):
-                            print("recovered:",outFile)
-                            makeNew = True
-                        elif fTmp.GetListOfKeys().GetSize()==0:
-                            print("no keys:",outFile)
-                            makeNew = True
-                        fTmp.Close()
+            # only remake the files where something they depend on has changed.
+            # (a file whose job was killed has no build record, so it's remade.)
+            staleList = []
+            for outName, ch, chanCut, cuts, dbKeys, info in outList:
+                prod = {"inputs":fileList, "dbKeys":dbKeys, "code":[applyCuts, fanOut, dsi.CutSet, dsi.readHits],
+                        "params":{"cut":chanCut, "out":treeOut.getSettings("cut")}}
+                reasons = bg.staleReasons(outName, force=forceBuild, **prod)
+                if len(reasons)==0:
+                    nGood += 1
+                    continue
+                nStale += 1
+                if dryRun:
+                    print("   Would make %s: %s" % (outName, ", ".join(reasons)))
+                    continue
 
                 # Wow, such a crazy amount of work to get to this block.
-                if makeNew:
-                    print("   Writing to:",outFile)
-                    print("   Chan",ch,"Cut:",chanCut,"\n")
-                    outFile = TFile(outFile,"RECREATE")
-                    outTree = TTree()
-                    outTree = skimTree.CopyTree(chanCut)
-                    outTree.Write()
-                    cutUsed = TNamed("chanCut",chanCut)
-                    cutUsed.Write()
-                    print("Wrote",outTree.GetEntries(),"entries.")
-                    outFile.Close()
+                print("   Writing to:",outName, "(%s)" % ", ".join(reasons))
+                print("   Chan",ch,"Cut:",chanCut,"\n")
+                staleList.append((outName, ch, cuts, prod))
+            if len(staleList)==0: continue
 
+            # read the bkgIdx's files once, and write all the stale cut files at the same time
+            skimTree = TChain("skimTree")
+            for f in fileList: skimTree.Add(f)
+            for outName, ch, cuts, prod in staleList: bg.forget(outName)
+            nEnt = fanOut(skimTree, [(outName, cuts, ch) for outName, ch, cuts, prod in staleList])
+            for outName, ch, cuts, prod in staleList:
+                print("Wrote",nEnt[outName],"entries to",outName)
+                bg.record(outName, **prod)
+
+    print("%d files %s, %d up to date." % (nStale, "to make" if dryRun else "made", nGood))
     print("All done!")
 
 
+def fanOut(tree, outList, maxOpen=60):
+    """ Copy the entries of a tree (or chain) passing each of several channel cuts to their
+    own cut files, like a CopyTree for each one, but reading the tree only once.
+    outList: [(outName, cuts, ch)], w/ cuts a dsi.CutSet.
+    The cut variables of every hit are read first (dsi.readHits) and the cuts are applied
+    to them w/ numpy.  Then each passing entry is read once, and filled into every output
+    it passed.  As w/ CopyTree, an entry is copied if any of its hits pass.
+    Each file also gets the cut string, as the TNamed 'chanCut'.
+    Every output keeps its own tree buffers in memory, so at most maxOpen files are
+    written at once (more than that takes another pass).
+    Returns {outName : number of entries written}.
+    """
+    from ROOT import TNamed
+    hits = dsi.readHits(tree)
+    passed = [np.unique(hits["entry"][cuts.passes(hits, ch)]) for outName, cuts, ch in outList]
+
+    nEnt = {}
+    for iGrp in range(0, len(outList), maxOpen):
+        group = range(iGrp, min(iGrp+maxOpen, len(outList)))
+
+        # open the outputs, w/ an empty clone of the tree
+        treeOut.setBuffers(tree, "cut")
+        outs = {}
+        for k in group:
+            outFile = treeOut.openOut(outList[k][0], "cut")
+            outs[k] = (outFile, tree.CloneTree(0))
+
+        # the outputs each passing entry goes to
+        dest = {}
+        for k in group:
+            for iEnt in passed[k].tolist(): dest.setdefault(iEnt, []).append(k)
+
+        # read each entry once, and fill it into each output it passed
+        for iEnt in sorted(dest):
+            tree.GetEntry(iEnt)
+            for k in dest[iEnt]: outs[k][1].Fill()
+
+        for k in group:
+            outName, cuts, ch = outList[k]
+            outFile, outTree = outs[k]
+            outFile.cd()
+            outTree.Write()
+            cutUsed = TNamed("chanCut",cuts.chanCut(ch))
+            cutUsed.Write()
+            nEnt[outName] = outTree.GetEntries()
+            outFile.Close()
+    return nEnt
+
+
 if __name__=="__main__":
     main(sys.argv[1:])
@@ -10,13 +10,14 @@ Generates "cut files" from LAT2 data.
 """
 import sys, os, math, glob
 import numpy as np
-import matplotlib.pyplot as plt
-plt.style.use('./pltReports.mplstyle')
+# matplotlib and ROOT are imported in the functions that use them
 
 import waveLibs as wl
 import dsi
-bkg = dsi.BkgInfo()
-det = dsi.DetInfo()
+import treeOut
+import buildGraph as bg
+bkg = dsi.Lazy(dsi.BkgInfo)
+det = dsi.Lazy(dsi.DetInfo)
 
 rateWin1 = [0, 5] # < -- use this one
 rateWin2 = [5, 20]
@@ -28,6 +29,7 @@ global pctTot
 # pctTot = 90
 pctTot = 95 # < -- use this one
 print("Using pctTot ==",pctTot)
+forceBuild = False
 
 def main(argv):
     """
@@ -35,7 +37,12 @@ def main(argv):
     2. Find outliers in specific cpd/bIdx combinations
     3. Recalculate typical rates after rejecting outliers
     4? Find runs causing the outliers
+    ./lat3.py [-force : remake all the burst cut files, not just the stale ones]
     """
+    global forceBuild
+    for opt in argv:
+        if opt=="-force": forceBuild = True
+
     # these can all be run sequentially
     getRates()
     getOutliers(True,usePass2=False)
@@ -343,6 +350,8 @@ def plotRates():
     rate objects: [:,0]=rate1, [:,1]=rate2, [:,2]=expo, [:,3]=bkgIdx, [:,4]=cpd, [:,5]=ds
     dumb DS5 trick: 5A==50, 5B==51, 5C==52
     """
+    import matplotlib.pyplot as plt
+    plt.style.use('./pltReports.mplstyle')
 
     # plotName = "./plots/lat3-rates-before-burst-withzeros-e%d.pdf" % (pctTot)
     # enrExc, natExc, enrRates, natRates = getOutliers(False, noSkip=True)
@@ -413,8 +422,12 @@ def getBadRuns():
 
 
 def makeCutFiles():
-
+    """ Copy the fr cut files to the burst cut (frb) files, except the outlier cpd/bIdx's and zombie detectors.
+    Only remakes the files that are stale (see buildGraph.py): missing, or made from a different fr cut file,
+    rates file, livetime file, fence values or code.  Files that aren't in the selection anymore are removed.
+    """
     from ROOT import TFile, TTree, MGTWaveform
+    nStale, nGood = 0, 0
 
     enrExc, natExc, enrRates, natRates = getOutliers(True)
     # enrExc, natExc: [:,0]=dsNum, [:,1]=cpd, [:,2]=bkgIdx
@@ -437,12 +450,11 @@ def makeCutFiles():
         runRanges = bkg.getRanges(dsNum)
         chList = det.getGoodChanList(dsNum)
 
-        # clear out any files from a previous attempt
+        # files from a previous attempt.  the ones not made again are removed at the end.
         fList = ["%s/bkg/cut/%s/%s_ds%d_%d_*.root" % (dsi.dataDir, outType, outType, dsNum, bIdx) for bIdx in range(bLo, bHi+1)]
-        for f in fList:
-            fTmp = glob.glob(f)
-            for f in fTmp:
-                os.remove(f)
+        oldFiles = set(f for fGlob in fList for f in glob.glob(fGlob))
+        ratesFile = "./data/lat3-rates-ds%s-e%d.npz" % (ds, pctTot)
+        ltFile = "./data/ds_%s_livetime.root" % str(ds)
 
         # build skip list
         dsTmp = ds
@@ -456,7 +468,7 @@ def makeCutFiles():
         print(skipList)
 
         # load ds_livetime output
-        tl = TFile("./data/ds_%s_livetime.root" % str(ds))
+        tl = TFile(ltFile)
         lt = tl.Get("dsTree")
 
         for bIdx in range(bLo, bHi+1):
@@ -498,9 +510,20 @@ def makeCutFiles():
                     continue
 
                 outName = "%s/bkg/cut/%s/%s_ds%d_%d_ch%d.root" % (dsi.dataDir, outType, outType, dsNum, bIdx, ch)
-                outFile = TFile(outName, "RECREATE")
+                oldFiles.discard(outName)
+                prod = {"inputs":[fName, ratesFile, ltFile], "code":[makeCutFiles, getOutliers, closeFence, outliersIQR],
+                        "params":{"kList":kList, "rateWin":rateWin1, "pass2":pass2, "out":treeOut.getSettings("cut")}}
+                reasons = bg.staleReasons(outName, force=forceBuild, **prod)
+                if len(reasons)==0:
+                    nGood += 1
+                    tf.Close()
+                    continue
+                nStale += 1
+                print("   Writing to:",outName,"(%s)" % ", ".join(reasons))
+                bg.forget(outName)
+                outFile = treeOut.openOut(outName, "cut")
                 outTree = TTree()
-                outTree = tt.CopyTree("")
+                outTree = treeOut.copyTree(tt, "", "cut")
                 # outTree = tt.CloneTree()
                 # print("Wrote %d entries." % outTree.GetEntries())
 
@@ -511,9 +534,20 @@ def makeCutFiles():
                 outTree.Write()
                 outFile.Close()
                 tf.Close()
+                bg.record(outName, **prod)
+
+        # outlier and zombie cpd/bIdx's don't get a file
+        for f in sorted(oldFiles):
+            print("   Removing:",f)
+            os.remove(f)
+            bg.forget(f)
+
+    print("%d burst cut files made, %d up to date." % (nStale, nGood))
 
 
 def plotSpecBeforeAfter():
+    import matplotlib.pyplot as plt
+    plt.style.use('./pltReports.mplstyle')
 
     from ROOT import TChain
 
@@ -597,6 +631,8 @@ def plotSpecBeforeAfter():
 
 
 def plotSpectraAfter():
+    import matplotlib.pyplot as plt
+    plt.style.use('./pltReports.mplstyle')
 
     from ROOT import TChain, TFile, TTree
     from matplotlib import colors
@@ -846,6 +882,8 @@ def plotSpectraAfter():
 
 
 def combineSpectra():
+    import matplotlib.pyplot as plt
+    plt.style.use('./pltReports.mplstyle')
 
     from ROOT import TChain, TFile, TTree
 
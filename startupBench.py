@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+""" 'startupBench.py': how long the LAT scripts take to start, and which imports the time goes to.
+    Runs each one under 'python -X importtime' and reports the wall time, the total
+    import time, and the slowest top-level imports.
+
+    Usage:
+        ./startupBench.py [-n nRep] [-top N]
+            Import each of the main scripts (w/o running main).  This is the startup
+            cost every subcommand pays before it does anything.
+        ./startupBench.py [-n nRep] [-top N] script.py [args ...]
+            Run one subcommand, e.g. ./startupBench.py lat-jobs.py -dry -lat -sub 1 5
+            (it really runs, so pick one that doesn't submit or write anything.)
+"""
+import sys, os, subprocess, time
+import numpy as np
+
+scripts = ["lat.py", "lat2.py", "lat3.py", "lat-expo.py", "lat-jobs.py", "lat-check.py"]
+
+# load a script as a module, w/o running main (scripts w/ '-' in the name can't just be imported)
+loadCode = ("import sys, importlib.util as u; sys.argv = sys.argv[1:]; "
+            "spec = u.spec_from_file_location('_bench', sys.argv[0]); spec.loader.exec_module(u.module_from_spec(spec))")
+
+
+def main(argv):
+    nRep, nTop, cmd = 3, 5, []
+    skip = False
+    for i, opt in enumerate(argv):
+        if skip:
+            skip = False
+            continue
+        if len(cmd) > 0: cmd.append(opt)
+        elif opt == "-n": nRep, skip = int(argv[i+1]), True
+        elif opt == "-top": nTop, skip = int(argv[i+1]), True
+        elif opt in ["-h","--help"]:
+            print(__doc__)
+            return
+        else: cmd.append(opt)
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    runs = [["-c", loadCode, s] for s in scripts] if len(cmd)==0 else [cmd]
+
+    print("%-40s %8s %8s  %s" % ("command", "wall s", "import s", "slowest imports (ms, incl. their own imports)"))
+    for run in runs:
+        name = " ".join(run[2:] if run[0]=="-c" else run)
+        wall, imports, rc = bench(run, nRep)
+        top = sorted(imports.items(), key=lambda kv: -kv[1])[:nTop]
+        print("%-40s %8.2f %8.2f  %s%s" % (name, wall, sum(imports.values())/1e6,
+            ", ".join("%s %.0f" % (mod, us/1e3) for mod, us in top), "" if rc==0 else "  (exit code %d)" % rc))
+
+
+def bench(args, nRep):
+    """ Median wall time (sec) of nRep runs of 'python -X importtime args', the cumulative
+    time (us) of each top-level import in the first run, and its exit code.
+    """
+    walls, imports, rc = [], None, 0
+    for i in range(nRep):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime"] + args,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        walls.append(time.perf_counter() - start)
+        if imports is None:
+            imports, rc = parseImportTime(proc.stderr), proc.returncode
+    return float(np.median(walls)), imports, rc
+
+
+def parseImportTime(text):
+    """ {module:cumulative us} for the top-level imports in '-X importtime' output. """
+    imports = {}
+    for line in text.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line: continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3: continue
+        mod = fields[2][1:] # one space after the '|', then two more per level of nesting
+        if mod.startswith(" "): continue
+        imports[mod.strip()] = imports.get(mod.strip(), 0) + int(fields[1])
+    return imports
+
+
+if __name__=="__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+""" 'treeOut.py': output file settings for LAT.
+    Compression, basket size and autoflush for each kind of file LAT writes, and
+    checkpointing of trees being filled by the number of bytes written or the time since
+    the last save, w/ a progress record s/t a killed job can be resumed (lat.py).
+
+    Stages:
+        split : splitSkim files (lat-jobs.py splitTree, splitFile).  Intermediate.
+        lat   : latSkim files (lat.py).  Intermediate.
+        cut   : cut files (lat2.py applyCuts, lat3.py makeCutFiles).  Final.
+
+    The compression of any stage can be overridden w/ the LATCOMPRESS environment variable, e.g.
+        export LATCOMPRESS="split:lz4:4,cut:lzma:8"
+
+    Benchmark (copies skimTree w/ each setting and reports write speed and file size):
+        ./treeOut.py [-o outDir] file.root [alg:level ...]
+    Check that a job killed partway through filling a tree can be resumed:
+        ./treeOut.py -test
+"""
+import sys, os, time, json
+
+# ROOT's compression algorithm codes (ROOT::RCompressionSetting::EAlgorithm)
+algCodes = {"zlib":1, "lzma":2, "lz4":4, "zstd":5}
+
+# alg, level, basket size (bytes), autoflush (bytes), checkpoint (bytes, and/or seconds since the last one).
+# lat.py fills ~0.5-1 kB per entry at a few entries/sec (the wf fit), so its checkpoints go by time.
+stageSettings = {
+    "split" : {"alg":"lz4",  "level":4, "basket":256000, "flush":30000000, "ckpt":None,    "ckptSec":None},
+    "lat"   : {"alg":"lz4",  "level":4, "basket":32000,  "flush":30000000, "ckpt":5000000, "ckptSec":300},
+    "cut"   : {"alg":"lzma", "level":6, "basket":256000, "flush":30000000, "ckpt":None,    "ckptSec":None},
+}
+
+
+def getSettings(stage):
+    """ The settings dict for a stage, w/ any LATCOMPRESS override applied. """
+    pars = dict(stageSettings[stage])
+    for item in os.environ.get("LATCOMPRESS","").split(","):
+        if item.count(":")!=2: continue
+        key, alg, level = item.split(":")
+        if key != stage: continue
+        if alg not in algCodes:
+            print("Unknown compression algorithm '%s' in LATCOMPRESS.  Using %s." % (alg, pars["alg"]))
+            continue
+        pars["alg"], pars["level"] = alg, int(level)
+    return pars
+
+
+def compSetting(alg, level):
+    """ ROOT compression setting (100*algorithm + level). """
+    return 100 * algCodes[alg] + level
+
+
+def openOut(fileName, stage, alg=None, level=None):
+    """ Open a new (RECREATE) output file w/ the stage's compression, or alg/level if given. """
+    from ROOT import TFile
+    pars = getSettings(stage)
+    if alg is not None: pars["alg"] = alg
+    if level is not None: pars["level"] = level
+    f = TFile(fileName, "RECREATE")
+    f.SetCompressionSettings(compSetting(pars["alg"], pars["level"]))
+    return f
+
+
+def setBuffers(tree, stage):
+    """ Set the stage's basket size and autoflush on a tree.
+    TTree::CopyTree/CloneTree copy these from the input tree, so setting them on the
+    input (which isn't written) sets them for the output tree.
+    For a TChain, the output is cloned from the first tree, so that's the one we set.
+    """
+    pars = getSettings(stage)
+    if tree.InheritsFrom("TChain"):
+        if tree.LoadTree(0) < 0: return tree
+        tree = tree.GetTree()
+    tree.SetBasketSize("*", pars["basket"])
+    tree.SetAutoFlush(-pars["flush"]) # negative: number of bytes
+    return tree
+
+
+def copyTree(tree, selection, stage, *args):
+    """ tree.CopyTree(selection, *args) into the current file, w/ the stage's basket size and autoflush.
+    args are CopyTree's option, nEntries, firstEntry (entry list positions if the tree has one).
+    """
+    setBuffers(tree, stage)
+    return tree.CopyTree(selection, *args)
+
+
+class Checkpoint:
+    """ Save a tree that's being filled (TTree::AutoSave) every time another 'nBytes'
+    of data have gone into it, or 'nSec' seconds after the last save, whichever is first,
+    instead of every N entries.  Each save rewrites the tree metadata, so this keeps the
+    number of saves independent of the entry size, and the time trigger bounds the work
+    a killed job loses when the entries are slow to make.
+    If 'info' (a dict) is given, each save also writes a 'progress' record to the file:
+    info, plus the number of entries done (nDone).  See readProgress.
+    """
+    def __init__(self, tree, stage="lat", nBytes=None, info=None, nSec=None):
+        self.tree = tree
+        pars = getSettings(stage)
+        self.nBytes = nBytes if nBytes is not None else pars["ckpt"]
+        self.nSec = nSec if nSec is not None else pars["ckptSec"]
+        self.info = info
+        self.last, self.tLast = tree.GetTotBytes(), time.time()
+        self.nSave = 0
+
+    def check(self, nDone=None):
+        """ Save if enough new data has been filled, or enough time has gone by.  Returns True if it saved. """
+        byBytes = self.nBytes is not None and self.tree.GetTotBytes() - self.last >= self.nBytes
+        byTime = self.nSec is not None and time.time() - self.tLast >= self.nSec
+        if not (byBytes or byTime):
+            return False
+        self.save(nDone)
+        return True
+
+    def save(self, nDone=None):
+        """ Flush the baskets and write the tree header and file keys, s/t the file
+        can be read (and recovered) up to here if the job is killed.
+        """
+        if self.info is not None:
+            from ROOT import TNamed
+            prog = TNamed("progress", json.dumps(dict(self.info, nDone=nDone)))
+            self.tree.GetDirectory().WriteTObject(prog, "progress", "Overwrite")
+        self.tree.AutoSave("SaveSelf;FlushBaskets")
+        self.last, self.tLast = self.tree.GetTotBytes(), time.time()
+        self.nSave += 1
+
+
+def readProgress(fileName, treeName="skimTree"):
+    """ The progress record saved by a Checkpoint, w/ the current entry count
+    of each branch in info["branches"] added (as "nFilled", None if a branch is missing).
+    Returns None if the file or the record don't exist.
+    """
+    from ROOT import TFile
+    if not os.path.isfile(fileName): return None
+    f = TFile(fileName)
+    if f.IsZombie(): return None
+    prog, tree = f.Get("progress"), f.Get(treeName)
+    if not prog or not tree:
+        f.Close()
+        return None
+    prog = json.loads(prog.GetTitle())
+    nFilled = {}
+    for key in prog.get("branches",[]):
+        br = tree.GetBranch(key)
+        nFilled[key] = br.GetEntries() if br else None
+    prog["nFilled"] = nFilled
+    f.Close()
+    return prog
+
+
+def main(argv):
+    """ Benchmark: copy the skimTree in a (split) file w/ each compression setting. """
+    if len(argv)==0:
+        print(__doc__)
+        return
+    if argv[0] == "-test":
+        test()
+        return
+    if argv[0] == "-testFill":
+        testFill(argv[1], int(argv[2]), int(argv[3]))
+        return
+    outDir, inFile, algList = "/tmp", None, []
+    skip = False
+    for i,opt in enumerate(argv):
+        if skip:
+            skip = False
+            continue
+        if opt == "-o":
+            outDir, skip = argv[i+1], True
+        elif ":" in opt:
+            alg, level = opt.split(":")
+            algList.append((alg, int(level)))
+        else:
+            inFile = opt
+    if len(algList)==0:
+        algList = [("zlib",1), ("lz4",4), ("zlib",6), ("lzma",6)]
+        if checkZSTD(): algList.append(("zstd",5))
+    bench(inFile, outDir, algList)
+
+
+def checkZSTD():
+    """ ZSTD needs ROOT 6.20+ """
+    from ROOT import gROOT
+    return gROOT.GetVersionInt() >= 62000
+
+
+def bench(inFile, outDir, algList, treeName="skimTree"):
+    """ Print the write speed (MB/s of uncompressed data) and size of the output file
+    for each (alg, level) in algList, and the time to read the output back.
+    """
+    from ROOT import TFile
+    f = TFile(inFile)
+    tree = f.Get(treeName)
+    inSize = os.path.getsize(inFile)/1e6
+    print("Input: %s  %d entries  %.1f MB on disk  %.1f MB uncompressed" % (inFile, tree.GetEntries(), inSize, tree.GetTotBytes()/1e6))
+    print("%-8s %-6s %10s %10s %10s %10s" % ("alg","level","write MB/s","size MB","ratio","read s"))
+
+    for stage in ["split","cut"]:
+        pars = getSettings(stage)
+        print("(%s default: %s:%d)" % (stage, pars["alg"], pars["level"]))
+
+    base = os.path.splitext(os.path.basename(inFile))[0]
+    for alg, level in algList:
+        outName = "%s/%s_%s%d.root" % (outDir, base, alg, level)
+
+        start = time.time()
+        outFile = openOut(outName, "split", alg, level)
+        outTree = copyTree(tree, "", "split")
+        outTree.Write()
+        totBytes = outTree.GetTotBytes()
+        outFile.Close()
+        wTime = time.time() - start
+
+        start = time.time()
+        rf = TFile(outName)
+        rt = rf.Get(treeName)
+        for i in range(rt.GetEntries()): rt.GetEntry(i)
+        rf.Close()
+        rTime = time.time() - start
+
+        size = os.path.getsize(outName)/1e6
+        print("%-8s %-6d %10.1f %10.1f %10.2f %10.1f" % (alg, level, totBytes/1e6/wTime, size, totBytes/1e6/size, rTime))
+        os.remove(outName)
+    f.Close()
+
+
+def testFill(fileName, nEnt, iStart=0):
+    """ Fill branch 'x' of a tree w/ x[i] = i, the way lat.py fills its new branches, w/ a Checkpoint
+    every 0.2 sec.  iStart > 0 resumes a killed fill, like lat.py does.  Prints a line after each save.
+    """
+    from ROOT import TFile, TTree, std
+    vec = std.vector("double")()
+    info = {"branches":["x"], "nList":nEnt}
+    if iStart > 0:
+        f = TFile(fileName, "UPDATE")
+        tree = f.Get("skimTree")
+        tree.SetBranchAddress("x", vec)
+        br = tree.GetBranch("x")
+    else:
+        f = openOut(fileName, "lat")
+        tree = TTree("skimTree", "")
+        br = tree.Branch("x", vec)
+    ckpt = Checkpoint(tree, "lat", info=info, nSec=0.2)
+    for i in range(iStart, nEnt):
+        vec.clear()
+        vec.push_back(i)
+        br.Fill()
+        if ckpt.check(i+1):
+            print("saved", i+1, flush=True)
+        time.sleep(0.001)
+    tree.SetEntries(br.GetEntries())
+    ckpt.save(nEnt)
+    f.Close()
+
+
+def test():
+    """ Kill a testFill job (SIGKILL) after its second checkpoint.  The partial file must have a
+    progress record w/ the branch filled up to nDone, and resuming from nDone must give every
+    entry once, in order.  Fails w/ an AssertionError.
+    """
+    import tempfile, shutil, signal, subprocess
+    from ROOT import TFile, std
+    tmp = tempfile.mkdtemp()
+    fileName, nEnt = tmp+"/ckpt.root", 20000
+    cmd = [sys.executable, os.path.abspath(__file__), "-testFill", fileName, str(nEnt)]
+    try:
+        job = subprocess.Popen(cmd + ["0"], stdout=subprocess.PIPE, universal_newlines=True)
+        nSaved = []
+        for line in job.stdout:
+            if line.startswith("saved"): nSaved.append(int(line.split()[1]))
+            if len(nSaved) == 2: break
+        job.send_signal(signal.SIGKILL)
+        job.wait()
+        assert len(nSaved) == 2, "the fill finished before its second checkpoint"
+
+        prog = readProgress(fileName)
+        assert prog is not None, "no progress record in the killed job's file"
+        nDone = prog["nDone"]
+        assert nSaved[1] <= nDone < nEnt and prog["nFilled"]["x"] == nDone, prog
+
+        assert subprocess.call(cmd + [str(nDone)], stdout=subprocess.DEVNULL) == 0, "resume failed"
+        f = TFile(fileName)
+        tree = f.Get("skimTree")
+        vec = std.vector("double")()
+        tree.SetBranchAddress("x", vec)
+        assert tree.GetBranch("x").GetEntries() == nEnt
+        vals = []
+        for i in range(nEnt):
+            tree.GetEntry(i)
+            vals.append(vec[0])
+        f.Close()
+        assert vals == list(range(nEnt)), "entries missing or out of order after the resume"
+        assert readProgress(fileName)["nDone"] == nEnt
+        print("Resumed at entry %d of %d after a kill.  treeOut test OK" % (nDone, nEnt))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__=="__main__":
+    main(sys.argv[1:])
@@ -217,10 +217,10 @@ void SkimWaveforms(string theCut, string inFile, string outFile, bool nlc, bool
 
    // Figure out which hits made it into the skim file (some are cut by data cleaning)
    // This preserves the 1-1 matching between the skim vectors and the new MGTWaveform vector
-   int numPass = cutTree->Draw("channel","","GOFF",1,i);
-   double *channelList = cutTree->GetV1();
+   // (read from the channel branch loaded by GetEntry above, instead of a TTree::Draw per entry)
    vector<int> chanVec;
-   for (int j = 0; j < numPass; j++) chanVec.push_back(int(channelList[j]));
+   if (useDoubles) for (double chan : *channelD) chanVec.push_back(int(chan));
+   else chanVec.assign(channel->begin(), channel->end());
 
    // Get channel list for event as vector<int>.
    // i hate you so much, doubles check
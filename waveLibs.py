@@ -2,14 +2,9 @@
 """ A collection of 'useful' LAT routines.
     C. Wiseman, B. Zhu
 """
-import sys, pywt, random, os, glob
+import sys, random, os, glob
 import numpy as np
-import tinydb as db
-from scipy.fftpack import fft
-from scipy.optimize import curve_fit
-from scipy.ndimage.filters import gaussian_filter
-from scipy import signal as sg
-import scipy.special as sp
+# scipy and pywt are imported in the functions that use them, s/t importing waveLibs is fast.
 
 limit = sys.float_info.max # equivalent to std::numeric_limits::max() in C++
 homePath = os.path.expanduser('~')
@@ -189,6 +184,32 @@ def H2D(tree,xbins,xlo,xhi,ybins,ylo,yhi,drawStr,cutStr,xTitle="",yTitle="",Titl
     return h2
 
 
+def bufferView(buf, n):
+    """ Numpy view of the first n doubles in a PyROOT buffer (a double*, e.g. TTree::GetV1 or vector::data).
+    Raises TypeError if the buffer can't be used this way.
+    """
+    if n == 0: return np.zeros(0)
+    try:
+        if hasattr(buf, "reshape"): buf.reshape((n,))  # cppyy low-level view: set its length
+        elif hasattr(buf, "SetSize"): buf.SetSize(n)   # older PyROOT buffers
+        return np.frombuffer(buf, dtype=np.double, count=n)
+    except (ValueError, AttributeError, BufferError) as e:
+        raise TypeError(str(e))
+
+
+def wfView(wave):
+    """ Numpy view of an MGTWaveform's samples, using the std::vector's data buffer (no copy).
+    Only valid as long as the waveform is: reading another tree entry can overwrite it,
+    so copy anything you want to keep.
+    """
+    vec = wave.GetVectorData()
+    n = wave.GetLength()
+    try:
+        return bufferView(vec.data(), n)
+    except (TypeError, AttributeError):
+        return np.fromiter(vec, dtype=np.double, count=n)
+
+
 class processWaveform:
     """ Auto-processes waveforms into python-friendly formats.
 
@@ -198,28 +219,33 @@ class processWaveform:
           4 samples to be set to zero with GetVectorData in PyROOT.  (They are actually nonzero.)
        -> This problem doesn't exist on the C++ side. There's got to be something wrong with the python wrapper.
        -> The easiest workaround is just to set remLo=4 for MS data.
+
+    blBuf: optional preallocated array (at least as long as the wf), for loops over many wf's.
+       The baseline-subtracted wf is written into it in place, and the raw wf is a view of the
+       MGTWaveform data (see wfView) instead of a copy.  Both are only good until the next
+       waveform is processed w/ the same buffer, or the next tree entry is read.
     """
-    def __init__(self, wave, remLo=0, remHi=2):
-        from ROOT import MGTWaveform
+    def __init__(self, wave, remLo=0, remHi=2, blBuf=None):
         # initialize
         # self.waveMGT = wave
         self.offset = wave.GetTOffset()
         self.period = wave.GetSamplingPeriod()
         self.length = wave.GetLength()
-        vec = wave.GetVectorData()
-        npArr = np.fromiter(vec, dtype=np.double, count=self.length)
+        npArr = wfView(wave)
         ts = np.arange(self.offset, self.offset + self.length * self.period, self.period) # superfast!
 
-        # resize the waveform
-        removeSamples = []
-        if remLo > 0: removeSamples += [i for i in range(0,remLo+1)]
-        if remHi > 0: removeSamples += [npArr.size - i for i in range(1,remHi+1)]
-        self.ts = np.delete(ts,removeSamples)
-        self.waveRaw = np.delete(npArr,removeSamples)   # force the size of the arrays to match
+        # resize the waveform: remove samples 0 to remLo (inclusive), and the last remHi
+        lo = remLo+1 if remLo > 0 else 0
+        hi = npArr.size - remHi if remHi > 0 else npArr.size
+        self.ts = ts[lo:hi]
+        self.waveRaw = npArr[lo:hi] if blBuf is not None else np.array(npArr[lo:hi])
 
         # compute baseline and noise
         self.noiseAvg,_,self.baseAvg = baselineParameters(self.waveRaw)
-        self.waveBLSub = np.copy(self.waveRaw) - self.baseAvg
+        if blBuf is not None and len(blBuf) >= len(self.waveRaw):
+            self.waveBLSub = np.subtract(self.waveRaw, self.baseAvg, out=blBuf[:len(self.waveRaw)])
+        else:
+            self.waveBLSub = self.waveRaw - self.baseAvg
 
     # constants
     def GetOffset(self): return self.offset
@@ -439,6 +465,7 @@ def evalXGaus(x,mu,sig,tau):
     Negative tau: Regular WF, high tail
     Positive tau: Backwards WF, low tail
     """
+    import scipy.special as sp
     tmp = (x-mu + sig**2./2./tau)/tau
 
     # np.exp of this is 1.7964120280206387e+308, the largest python float value: sys.float_info.max
@@ -496,23 +523,22 @@ def th2Array(hist,xbins,xlo,xhi,ybins,ylo,yhi):
 
 
 def baselineParameters(signalRaw):
-    """ Finds basic parameters of baselines using first 500 samples. """
+    """ Finds basic parameters of baselines using first 500 samples.
+    Also takes a 2-D (nWF, nSamples) block, returning arrays of rms and mean.
+    np.cumsum adds sample by sample, so the sums round the same way as a loop would.
+    """
     rms = 0
     slope = 0
-    baselineMean = 0
-    baselineAveSq = 0
-    for x in range(0,500):
-        wfX = signalRaw[x]
-        baselineMean += wfX
-        baselineAveSq += wfX*wfX
-    baselineMean /= 500.
-    baselineAveSq /= 500.
+    wfX = np.asarray(signalRaw)[...,:500]
+    baselineMean = np.cumsum(wfX, axis=-1)[...,-1] / 500.
+    baselineAveSq = np.cumsum(wfX*wfX, axis=-1)[...,-1] / 500.
     rms = np.sqrt( baselineAveSq - baselineMean*baselineMean);
     return rms, slope, baselineMean
 
 
 def findBaseline(signalRaw):
     """ Find the average starting baseline from an MJD waveform. """
+    from scipy.optimize import curve_fit
     (hist, bins) = np.histogram(signalRaw[:200], bins=np.arange(-8000, 8000, 1))
     fitfunc = lambda p, x: p[0] * np.exp(-0.5 * ((x - p[1]) / p[2])**2) + p[3]
     errfunc = lambda p, x, y: (y - fitfunc(p, x))
@@ -528,6 +554,7 @@ def findBaseline(signalRaw):
 
 def fourierTransform(signalRaw):
     """ Simple FFT for a waveform """
+    from scipy.fftpack import fft
     yf = fft(signalRaw)
     T = 1e-8 # Period
     N = len(yf)
@@ -539,6 +566,7 @@ def fourierTransform(signalRaw):
 
 def waveletTransform(signalRaw, level=4, wavelet='db2', order='freq'):
     """ Use PyWavelets to do a wavelet transform. """
+    import pywt
     wp = pywt.WaveletPacket(signalRaw, wavelet, 'symmetric', maxlevel=level)
     nodes = wp.get_level(level, order=order)
     yWT = np.array([n.data for n in nodes], 'd')
@@ -546,8 +574,43 @@ def waveletTransform(signalRaw, level=4, wavelet='db2', order='freq'):
     return wp.data, yWT
 
 
+def wpDecompose(signalRaw, level=4, wavelet='db2', mode='symmetric'):
+    """ Wavelet packet decomposition along the last axis, so it also takes a 2-D
+    (nWF, nSamples) block.  Same coefficients as pywt.WaveletPacket + get_level(order='freq').
+    Returns a dict of all the nodes {path:coeffs}, and the abs value of the
+    last level in freq order, w/ shape (..., 2**level, nCoeffs).
+    """
+    import pywt
+    nodes = {'':np.asarray(signalRaw)}
+    for lev in range(level):
+        for path in [p for p in nodes if len(p)==lev]:
+            nodes[path+'a'], nodes[path+'d'] = pywt.dwt(nodes[path], wavelet, mode, axis=-1)
+    order = ['a','d']
+    for lev in range(level-1): # graycode ordering
+        order = ['a'+p for p in order] + ['d'+p for p in order[::-1]]
+    wpCoeff = abs(np.stack([nodes[p] for p in order], axis=-2))
+    return nodes, wpCoeff
+
+
+def wpDenoise(approx, nSamp, level=3, wavelet='db2', mode='symmetric'):
+    """ Reconstruct waveform(s) from a single approximation node (like 'aaa'),
+    w/ all the detail coefficients set to zero.  Works along the last axis.
+    Trims the front s/t the output has nSamp samples, like the per-wf
+    WaveletPacket(data=None) + reconstruct(update=False) method.
+    """
+    import pywt
+    rec = approx
+    for lev in range(level):
+        rec = pywt.idwt(rec, None, wavelet, mode, axis=-1)
+    diff = rec.shape[-1] - nSamp
+    if diff > 0: rec = rec[...,diff:]
+    return rec
+
+
 def trapFilter(signalRaw, rampTime=400, flatTime=200, decayTime=0.):
-    """ Apply a trap filter to a waveform. """
+    """ Apply a trap filter to a waveform.
+    Also takes a 2-D (nWF, nSamples) block, filtering each row along the last axis.
+    """
     baseline = 0.
     decayConstant = 0.
     norm = rampTime
@@ -555,58 +618,65 @@ def trapFilter(signalRaw, rampTime=400, flatTime=200, decayTime=0.):
         decayConstant = 1./(np.exp(1./decayTime) - 1)
         norm *= decayConstant
 
+    nSamp = signalRaw.shape[-1]
     trapOutput = np.zeros_like(signalRaw)
     fVector = np.zeros_like(signalRaw)
-    scratch = np.zeros_like(signalRaw)
 
-    fVector[0] = signalRaw[0] - baseline
-    trapOutput[0] = (decayConstant+1.)*(signalRaw[0] - baseline)
+    fVector[...,0] = signalRaw[...,0] - baseline
+    trapOutput[...,0] = (decayConstant+1.)*(signalRaw[...,0] - baseline)
 
     wf_minus_ramp = np.zeros_like(signalRaw)
-    wf_minus_ramp[:rampTime] = baseline
-    wf_minus_ramp[rampTime:] = signalRaw[:len(signalRaw)-rampTime]
+    wf_minus_ramp[...,:rampTime] = baseline
+    wf_minus_ramp[...,rampTime:] = signalRaw[...,:nSamp-rampTime]
 
     wf_minus_ft_and_ramp = np.zeros_like(signalRaw)
-    wf_minus_ft_and_ramp[:(flatTime+rampTime)] = baseline
-    wf_minus_ft_and_ramp[(flatTime+rampTime):] = signalRaw[:len(signalRaw)-flatTime-rampTime]
+    wf_minus_ft_and_ramp[...,:(flatTime+rampTime)] = baseline
+    wf_minus_ft_and_ramp[...,(flatTime+rampTime):] = signalRaw[...,:nSamp-flatTime-rampTime]
 
     wf_minus_ft_and_2ramp = np.zeros_like(signalRaw)
-    wf_minus_ft_and_2ramp[:(flatTime+2*rampTime)] = baseline
-    wf_minus_ft_and_2ramp[(flatTime+2*rampTime):] = signalRaw[:len(signalRaw)-flatTime-2*rampTime]
+    wf_minus_ft_and_2ramp[...,:(flatTime+2*rampTime)] = baseline
+    wf_minus_ft_and_2ramp[...,(flatTime+2*rampTime):] = signalRaw[...,:nSamp-flatTime-2*rampTime]
 
     scratch = signalRaw - (wf_minus_ramp + wf_minus_ft_and_ramp + wf_minus_ft_and_2ramp )
 
     if decayConstant != 0:
-        fVector = np.cumsum(fVector + scratch)
-        trapOutput = np.cumsum(trapOutput +fVector+ decayConstant*scratch)
+        fVector = np.cumsum(fVector + scratch, axis=-1)
+        trapOutput = np.cumsum(trapOutput +fVector+ decayConstant*scratch, axis=-1)
     else:
-        trapOutput = np.cumsum(trapOutput + scratch)
+        trapOutput = np.cumsum(trapOutput + scratch, axis=-1)
 
     # Normalize and resize output
-    trapOutput[:len(signalRaw) - (2*rampTime+flatTime)] = trapOutput[2*rampTime+flatTime:]/norm
-    trapOutput.resize( (len(signalRaw) - (2*rampTime+flatTime)))
-    return trapOutput
+    return trapOutput[...,2*rampTime+flatTime:]/norm
 
 
 def wfDerivative(signalRaw,sp=10.):
-    """ Take a derivative of a waveform numpy array.
+    """ Take a derivative of a waveform numpy array (or a 2-D block, along the last axis).
     Adapted from $MGDODIR/Transforms/MGWFBySampleDerivative
     y[n] = ( x[n+1] - x[n] )/sp
     where sp is the sampling period of the waveform.
     """
-    signalDeriv = np.zeros(len(signalRaw))
-    for i in range(len(signalRaw)-1):
-        signalDeriv[i] = (signalRaw[i+1] - signalRaw[i])/sp
+    signalDeriv = np.zeros(np.shape(signalRaw))
+    signalDeriv[...,:-1] = (signalRaw[...,1:] - signalRaw[...,:-1])/sp
     return signalDeriv
 
 
 def MGTWFFromNpArray(npArr):
-    """ Convert a numpy array back into an MGTWaveform. """
+    """ Convert a numpy array back into an MGTWaveform.
+    A 2-D (nWF, nSamples) block returns a list of MGTWaveforms.
+    """
     from ROOT import MGTWaveform, std
-    vec = std.vector("double")()
-    for adc in npArr: vec.push_back(adc)
+    npArr = np.ascontiguousarray(npArr, dtype=np.double)
+    if npArr.ndim > 1:
+        return [MGTWFFromNpArray(arr) for arr in npArr]
     mgtwf = MGTWaveform()
-    mgtwf.SetData(vec)
+    try:
+        # SetData(const double*, size_t): PyROOT passes the numpy buffer, no per-sample loop
+        mgtwf.SetData(npArr, len(npArr))
+    except TypeError:
+        vec = std.vector("double")()
+        vec.reserve(len(npArr))
+        for adc in npArr: vec.push_back(adc)
+        mgtwf.SetData(vec)
     return mgtwf
 
 
@@ -654,43 +724,54 @@ def peakdet(v, delta, x = None):
     #        DELTA.
     # Eli Billauer, 3.4.05 (Explicitly not copyrighted).
     # This function is released to the public domain; Any use is allowed.
-    """
-    maxtab, mintab = [], []
 
+    Also takes a 2-D (nWF, nSamples) block, returning lists of maxtab and mintab arrays (one per row).
+    Instead of stepping through every sample, each search (for a max, then a min, ...) jumps
+    straight to the sample that ends it, w/ a running max (or min) taken along the row.
+    """
+    single = np.ndim(v)==1
+    v = np.atleast_2d(np.asarray(v))
+    nWF, nSamp = v.shape
     if x is None:
-        x = np.arange(len(v))
-    v = np.asarray(v)
-    if len(v) != len(x):
+        x = np.arange(nSamp)
+    if nSamp != len(x):
         sys.exit('Peak Finder Error: Input vectors v and x must have same length')
     if not np.isscalar(delta):
         sys.exit('Peak Finder Error: Input argument delta must be a scalar')
     if delta <= 0:
         sys.exit('Peak Finder Error: Input argument delta must be positive')
 
-    mn, mx, mnpos, mxpos = np.Inf, -np.Inf, np.NaN, np.NaN
-    lookformax = True
-
-    for i in np.arange(len(v)):
-        this = v[i]
-        if this > mx:
-            mx = this
-            mxpos = x[i]
-        if this < mn:
-            mn = this
-            mnpos = x[i]
-        if lookformax:
-            if this < mx-delta:
-                maxtab.append((mxpos, mx))
-                mn = this
-                mnpos = x[i]
-                lookformax = False
-        else:
-            if this > mn+delta:
-                mintab.append((mnpos, mn))
-                mx = this
-                mxpos = x[i]
-                lookformax = True
-    return np.array(maxtab), np.array(mintab)
+    maxtab, mintab = [[] for i in range(nWF)], [[] for i in range(nWF)]
+    start = np.zeros(nWF, dtype=int)   # sample where each row's current search began
+    lookformax = np.ones(nWF, dtype=bool)
+    active = np.ones(nWF, dtype=bool) if nSamp > 0 else np.zeros(nWF, dtype=bool)
+    cols = np.arange(nSamp)
+
+    while active.any():
+        rows = np.nonzero(active)[0]
+        ar = np.arange(len(rows))
+        # look for a min by looking for a max of -v
+        u = np.where(lookformax[rows,None], v[rows], -v[rows])
+        s = start[rows]
+        before = cols < s[:,None]
+        runMax = np.maximum.accumulate(np.where(before, u[ar,s][:,None], u), axis=1)
+
+        # first sample that's fallen 'delta' below the running max ends the search
+        drop = ~before & (u < runMax - delta)
+        found = drop.any(axis=1)
+        i = np.argmax(drop, axis=1)
+        pos = np.argmax(~before & (runMax == runMax[ar,i][:,None]), axis=1)  # first sample at the max
+        for k in np.nonzero(found)[0]:
+            tab = maxtab if lookformax[rows[k]] else mintab
+            tab[rows[k]].append((x[pos[k]], v[rows[k],pos[k]]))
+
+        start[rows] = i
+        lookformax[rows[found]] = ~lookformax[rows[found]]
+        active[rows[~found]] = False
+
+    maxtab, mintab = [np.array(tab) for tab in maxtab], [np.array(tab) for tab in mintab]
+    if single: return maxtab[0], mintab[0]
+    return maxtab, mintab
 
 
 def GetPeaks(hist, xvals, thresh):
@@ -727,6 +808,7 @@ def peakModel238240(x,a1,c0,mu,sig,c1,tau,c2,a2,b):
         # m  -0.001  slope
         b  5.      offset
     """
+    import scipy.special as sp
     f0 = gauss_function(x,c0,mu,sig)
     f1 = evalXGaus(x,mu,sig,tau)
     f2 = sp.erfc((x-mu)/sig/np.sqrt(2.))
@@ -737,42 +819,70 @@ def peakModel238240(x,a1,c0,mu,sig,c1,tau,c2,a2,b):
 
 def peakModel238_2(x,a1,c0,mu,sig,c1,tau,c2,b):
     """ See above. """
+    import scipy.special as sp
     f0 = gauss_function(x,c0,mu,sig)
     f1 = evalXGaus(x,mu,sig,tau)
     f2 = sp.erfc((x-mu)/sig/np.sqrt(2.))
     return a1 * (f0 + c1*f1 + c2*f2) + b
 
 
+def interpLinear(xNew, x, y):
+    """ Linear interpolation of each row of y at one point per row, xNew.
+    Same numbers as np.interp(xNew[i], x, y[i]) (and interp1d), for a block of waveforms.
+    x must be increasing.  Out-of-range points return the edge values.
+    """
+    y = np.atleast_2d(y)
+    xNew = np.broadcast_to(np.asarray(xNew, dtype=float), y.shape[:1])
+    rows = np.arange(len(y))
+    j = np.clip(np.searchsorted(x, xNew, side='right') - 1, 0, len(x)-2)
+    xLo, xHi, yLo, yHi = x[j], x[j+1], y[rows,j], y[rows,j+1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (yHi - yLo) / (xHi - xLo)
+        yNew = slope*(xNew - xLo) + yLo
+    yNew = np.where(xNew == xLo, yLo, yNew)
+    yNew = np.where(xNew >= x[-1], y[:,-1], yNew)
+    yNew = np.where(xNew < x[0], y[:,0], yNew)
+    return yNew
+
+
 def walkBackT0(trap, timemax=10000., thresh=2., rmin=0, rmax=1000, forward=False):
     """
         Leading Edge start time -- walk back or forward from a maximum to threshold
         Times are returned in ns
+        Also takes a 2-D (nWF, nSamples) block (w/ one thresh per row, or a single value),
+        returning arrays of t0's and found flags.
     """
+    trap2 = np.atleast_2d(trap)
+    nWF, nSamp = trap2.shape
+    thresh = np.broadcast_to(thresh, (nWF,))
+    rows, cols = np.arange(nWF), np.arange(nSamp)
     minsample = np.amax([0,rmin])
-    maxsample = np.amin([len(trap),rmax])
-    trapMax = np.argmax(trap[minsample:maxsample])
-    foundFirst, triggerTS = False, 0
-    sampleArr = []
+    maxsample = np.amin([nSamp,rmax])
+    trapMax = np.argmax(trap2[:,minsample:maxsample], axis=1)
+
+    # Find the first sample past threshold (walking away from the max), and the previous one.
+    # If the max itself is past threshold, the "previous" sample is the last one in the walk.
     if forward:
-        sampleArr = range(trapMax,maxsample)
+        cross = (cols >= trapMax[:,None]) & (cols < maxsample) & (trap2 <= thresh[:,None])
+        i = np.argmax(cross, axis=1)
+        prev = np.where(i==trapMax, maxsample-1, i-1)
     else:
-        sampleArr = range(trapMax,minsample,-1)
-    for idx, i in enumerate(sampleArr):
-        # If passed threshold, means we walked past the sample that crossed
-        if trap[i] <= thresh:
-            foundFirst = True
-            # Interpolate between the current and previous sample if the difference isn't zero
-            if (trap[sampleArr[idx]]-trap[sampleArr[idx-1]]) != 0:
-                triggerTS = ((thresh-trap[sampleArr[idx]]) * (sampleArr[idx]-sampleArr[idx-1])/(trap[sampleArr[idx]]-trap[sampleArr[idx-1]]) + i)*10
-            else: triggerTS = (i+1)*10
-            break
+        cross = (cols > minsample) & (cols <= trapMax[:,None]) & (trap2 <= thresh[:,None])
+        i = nSamp - 1 - np.argmax(cross[:,::-1], axis=1)
+        prev = np.where(i==trapMax, minsample+1, i+1)
+    foundFirst = cross.any(axis=1)
+
+    # Interpolate between the current and previous sample if the difference isn't zero
+    tCur, tPrev = trap2[rows,i], trap2[rows,np.clip(prev,0,nSamp-1)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        triggerTS = np.where(tCur-tPrev != 0, ((thresh-tCur) * (i-prev)/(tCur-tPrev) + i)*10, (i+1)*10.)
+    triggerTS = np.where(foundFirst, triggerTS, 0.)
+
     # Save-guards if the t0 goes out of range for picking off on the large trapezoid
-    if triggerTS >= timemax:
-        return timemax, foundFirst
-    elif triggerTS <= 0:
-        return 0., foundFirst
-    else:
-        return triggerTS, foundFirst
+    triggerTS = np.where(triggerTS >= timemax, timemax, np.where(triggerTS <= 0, 0., triggerTS))
+    if np.ndim(trap)==1:
+        return triggerTS[0], bool(foundFirst[0])
+    return triggerTS, foundFirst
 
 
 def constFractiont0(trap, frac=0.1, delay=200, thresh=0., rmin=0, rmax=1000):
@@ -782,36 +892,55 @@ def constFractiont0(trap, frac=0.1, delay=200, thresh=0., rmin=0, rmax=1000):
         2) Delay and sum the original + inverted
         3) Walk back from maximum to a threshold (usually zero crossing)
         Times are returned in ns
+        Also takes a 2-D (nWF, nSamples) block, returning arrays of t0's and found flags.
     """
-    minsample = np.amax([0,rmin])
-    maxsample = np.amin([len(trap)-delay,rmax])
-    invertTrap = np.multiply(trap, -1.*frac)
-    summedTrap = np.add(invertTrap[delay:], trap[:-delay])
-    trapMax = np.argmax(summedTrap[0:1000])
-    foundFirst, triggerTS = False, 0
-    for i in range(trapMax,0,-1):
-        if summedTrap[i] <= thresh:
-            foundFirst = True
-            if (summedTrap[i+1]-summedTrap[i]) != 0:
-                triggerTS = ((thresh-summedTrap[i])*((i+1)-i)/(summedTrap[i+1]-summedTrap[i]) + i)*10
-            else: triggerTS = (i+1)*10
-            break
+    trap2 = np.atleast_2d(trap)
+    nWF = len(trap2)
+    rows = np.arange(nWF)
+    invertTrap = np.multiply(trap2, -1.*frac)
+    summedTrap = np.add(invertTrap[:,delay:], trap2[:,:-delay])
+    nSum = summedTrap.shape[1]
+    cols = np.arange(nSum)
+    trapMax = np.argmax(summedTrap[:,0:1000], axis=1)
+
+    # last sample under threshold between the first sample and the max
+    cross = (cols > 0) & (cols <= trapMax[:,None]) & (summedTrap <= thresh)
+    i = nSum - 1 - np.argmax(cross[:,::-1], axis=1)
+    foundFirst = cross.any(axis=1)
+
+    sCur, sNext = summedTrap[rows,i], summedTrap[rows,np.minimum(i+1,nSum-1)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        triggerTS = np.where(sNext-sCur != 0, ((thresh-sCur)/(sNext-sCur) + i)*10, (i+1)*10.)
+    triggerTS = np.where(foundFirst, triggerTS, 0)
+    if np.ndim(trap)==1:
+        return triggerTS[0], bool(foundFirst[0])
     return triggerTS, foundFirst
 
 
 def asymTrapFilter(data,ramp=200,flat=100,fall=40,padAfter=False):
-    """ Computes an asymmetric trapezoidal filter """
-    trap = np.zeros(len(data))
-    for i in range(len(data)-1000):
-        w1 = ramp
-        w2 = ramp+flat
-        w3 = ramp+flat+fall
-        r1 = np.sum(data[i:w1+i])/(ramp)
-        r2 = np.sum(data[w2+i:w3+i])/(fall)
-        if not padAfter:
-            trap[i+1000] = r2 - r1
-        else:
-            trap[i] = r2 - r1
+    """ Computes an asymmetric trapezoidal filter.
+    Also takes a 2-D (nWF, nSamples) block, filtering each row along the last axis.
+    The window sums come from a running sum (O(N) instead of O(N*window)), so they match summing
+    each window separately up to floating point rounding: within 1e-12 of the largest |output|.
+    """
+    data = np.asarray(data, dtype=float)
+    nSamp = data.shape[-1]
+    trap = np.zeros(data.shape)
+    nOut = nSamp-1000
+    if nOut <= 0: return trap
+    w1 = ramp
+    w2 = ramp+flat
+    w3 = ramp+flat+fall
+    cSum = np.zeros(data.shape[:-1] + (nSamp+1,))
+    cSum[...,1:] = np.cumsum(data, axis=-1)
+    i = np.arange(nOut)
+    win = lambda lo, hi: cSum[...,np.minimum(hi,nSamp)] - cSum[...,np.minimum(lo,nSamp)]
+    r1 = win(i, w1+i)/(ramp)
+    r2 = win(w2+i, w3+i)/(fall)
+    if not padAfter:
+        trap[...,1000:] = r2 - r1
+    else:
+        trap[...,:nOut] = r2 - r1
     return trap
 
 
@@ -876,3 +1005,72 @@ def MakeSiggenWaveform(samp,r,z,ene,t0,smooth=1,phi=np.pi/8):
     #     print("amplitude diff: %f" % ( (np.amax(wf_notrap) - np.amax(wf)) /  np.amax(wf_notrap) ))
 
     return wf_notrap, timesteps
+
+
+def test():
+    """ Regression check of the vectorized asymTrapFilter, wfDerivative and baselineParameters
+    against the original sample-by-sample loops, on the example wf's in ./data, for single wf's and
+    2-D blocks.  Outputs must be identical, except asymTrapFilter's running sums (see asymTrapFilter).
+    Usage: ./waveLibs.py (fails w/ an AssertionError)
+    """
+    def asymLoop(data,ramp=200,flat=100,fall=40,padAfter=False):
+        trap = np.zeros(len(data))
+        for i in range(len(data)-1000):
+            w1 = ramp
+            w2 = ramp+flat
+            w3 = ramp+flat+fall
+            r1 = np.sum(data[i:w1+i])/(ramp)
+            r2 = np.sum(data[w2+i:w3+i])/(fall)
+            if not padAfter: trap[i+1000] = r2 - r1
+            else: trap[i] = r2 - r1
+        return trap
+
+    def derivLoop(signalRaw,sp=10.):
+        signalDeriv = np.zeros(len(signalRaw))
+        for i in range(len(signalRaw)-1):
+            signalDeriv[i] = (signalRaw[i+1] - signalRaw[i])/sp
+        return signalDeriv
+
+    def blLoop(signalRaw):
+        baselineMean, baselineAveSq = 0, 0
+        for x in range(0,500):
+            baselineMean += signalRaw[x]
+            baselineAveSq += signalRaw[x]*signalRaw[x]
+        baselineMean /= 500.
+        baselineAveSq /= 500.
+        return np.sqrt(baselineAveSq - baselineMean*baselineMean), baselineMean
+
+    dataDir = os.environ['LATDIR']+"/data" if 'LATDIR' in os.environ else os.path.dirname(os.path.abspath(__file__))+"/data"
+    wfs = [np.load(dataDir+"/pysig_test.npz")['arr_0'][:2014]]
+    for f in ["ds5exampleWaveform5","ds5exampleWaveform238"]:
+        wfs.append(np.load("%s/%s.npz" % (dataDir,f))['arr_1'][:2014])
+    wfBlock = np.asarray(wfs, dtype=float)
+    noise = np.random.RandomState(1).normal(0, 3.7, (5, 1537))  # non-integer samples
+
+    def asymClose(out, ref):
+        return np.allclose(out, ref, rtol=1e-12, atol=1e-12*np.amax(np.fabs(ref)))
+
+    for block in (noise, noise[::2,::-1]):
+        for pars in [(200,100,40,False),(100,50,900,True)]:
+            ref = np.asarray([asymLoop(wf,*pars) for wf in block])
+            assert asymClose(asymTrapFilter(block,*pars), ref), ("asymTrapFilter", pars, "noise")
+
+    for pars in [(4,10,200,True),(200,100,40,False),(100,50,900,True)]:
+        ref = np.asarray([asymLoop(wf,*pars) for wf in wfBlock])
+        assert asymClose(asymTrapFilter(wfBlock,*pars), ref), ("asymTrapFilter", pars, "block")
+        for i,wf in enumerate(wfBlock):
+            assert asymClose(asymTrapFilter(wf,*pars), ref[i]), ("asymTrapFilter", pars, i)
+
+    ref = np.asarray([derivLoop(wf) for wf in wfBlock])
+    assert np.array_equal(wfDerivative(wfBlock), ref), "wfDerivative block"
+    assert all(np.array_equal(wfDerivative(wf), ref[i]) for i,wf in enumerate(wfBlock)), "wfDerivative"
+
+    ref = np.asarray([blLoop(wf) for wf in wfBlock])
+    rms, slope, mean = baselineParameters(wfBlock)
+    assert np.array_equal(rms, ref[:,0]) and np.array_equal(mean, ref[:,1]), "baselineParameters block"
+    assert all(baselineParameters(wf)[0]==ref[i,0] and baselineParameters(wf)[2]==ref[i,1] for i,wf in enumerate(wfBlock)), "baselineParameters"
+    print("waveLibs test OK")
+
+
+if __name__=="__main__":
+    test()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+""" 'wfStore.py': columnar waveform store for LAT.
+    Converts the MGTWaveforms in a waveSkim/splitSkim/latSkim file into a fixed-stride 2-D
+    array, saved as a .npy file that's memory-mapped when read, plus an index table w/ one
+    row per waveform.  Reading a store doesn't need ROOT.
+
+    Usage:
+        ./wfStore.py [-o outDir] [-d int16] file1.root [file2.root ...]
+
+    For 'file.root', the store is 'file.wf.npy' and 'file.idx.npy' (in outDir if given).
+    Waveforms are saved w/ all their samples (no truncation).  Rows are zero-padded to the
+    length of the longest waveform.  The index has one row per waveform:
+        entry, run, iEvent, iHit, channel, offset (ns), period (ns), length (samples)
+"""
+import sys, os
+import numpy as np
+import waveLibs as wl
+
+idxType = np.dtype([("entry","i8"), ("run","i4"), ("iEvent","i8"), ("iHit","i4"), ("channel","i4"),
+                    ("offset","f8"), ("period","f8"), ("length","i4")])
+
+
+def main(argv):
+
+    if len(argv)==0:
+        print(__doc__)
+        return
+
+    outDir, dType, inFiles = None, "float32", []
+    skip = False
+    for i,opt in enumerate(argv):
+        if skip:
+            skip = False
+            continue
+        if opt == "-o":
+            outDir, skip = argv[i+1], True
+        elif opt == "-d":
+            dType, skip = argv[i+1], True
+        else:
+            inFiles.append(opt)
+
+    for inFile in inFiles:
+        convert(inFile, outDir, dType)
+
+
+def storeName(fileName, outDir=None):
+    """ Base name of the store files for a ROOT file (or a store file). """
+    base = fileName
+    for ext in [".root", ".wf.npy", ".idx.npy"]:
+        if base.endswith(ext): base = base[:-len(ext)]
+    if outDir is not None:
+        base = "%s/%s" % (outDir, os.path.basename(base))
+    return base
+
+
+def convert(inFile, outDir=None, dType="float32", treeName="skimTree"):
+    """ Write the store for one file.  dType is float32 (default) or int16.
+    Both hold the (integer) ADC values exactly.  Samples that don't fit are counted and reported.
+    """
+    from ROOT import TFile
+    base = storeName(inFile, outDir)
+    dType = np.dtype(dType)
+
+    f = TFile(inFile)
+    tree = f.Get(treeName)
+    tree.SetBranchStatus('*',0)
+    for name in ["run","iEvent","channel","MGTWaveforms"]:
+        tree.SetBranchStatus(name,1)
+
+    # pass 1: append each wf to a flat file, w/o knowing the longest wf yet
+    rows, nInexact = [], 0
+    with open(base+".wf.tmp","wb") as tmp:
+        for iEnt in range(tree.GetEntries()):
+            tree.GetEntry(iEnt)
+            for iH in range(tree.channel.size()):
+                wf = tree.MGTWaveforms.at(iH)
+                data = wl.wfView(wf)
+                samples = data.astype(dType)
+                if not np.array_equal(samples, data): nInexact += 1
+                samples.tofile(tmp)
+                rows.append((iEnt, tree.run, tree.iEvent, iH, tree.channel.at(iH),
+                             wf.GetTOffset(), wf.GetSamplingPeriod(), len(data)))
+    f.Close()
+    idx = np.array(rows, dtype=idxType)
+
+    # pass 2: copy into the fixed-stride array
+    stride = int(np.amax(idx["length"])) if len(idx) > 0 else 0
+    nTot = int(np.sum(idx["length"]))
+    wfArr = np.lib.format.open_memmap(base+".wf.npy", mode="w+", dtype=dType, shape=(len(idx),stride))
+    if nTot > 0:
+        flat = np.memmap(base+".wf.tmp", dtype=dType, mode="r", shape=(nTot,))
+        if np.all(idx["length"]==stride):
+            wfArr[:] = flat.reshape(len(idx),stride)
+        else:
+            start = 0
+            for i, n in enumerate(idx["length"]):
+                wfArr[i,:n] = flat[start:start+n]
+                wfArr[i,n:] = 0
+                start += n
+        del flat
+    wfArr.flush()
+    del wfArr
+    os.remove(base+".wf.tmp")
+    np.save(base+".idx.npy", idx)
+
+    print("%s: %d wf's, stride %d (%s) -> %s.wf.npy" % (inFile, len(idx), stride, dType.name, base))
+    if nInexact > 0:
+        print("Warning: %d wf's have samples that aren't exact as %s.  Use -d float32?" % (nInexact, dType.name))
+
+
+class WFStore:
+    """ Read a waveform store made by convert.  The waveform array is memory-mapped,
+    so only the rows that are used get read from disk.
+    Rows are numbered as in the index, self.idx (a numpy structured array).
+    """
+    def __init__(self, fileName):
+        base = storeName(fileName)
+        self.wf = np.load(base+".wf.npy", mmap_mode="r")
+        self.idx = np.load(base+".idx.npy")
+
+    def __len__(self): return len(self.idx)
+
+    def Select(self, **kw):
+        """ Row numbers w/ index fields equal to the given values, e.g. Select(run=9422, channel=594). """
+        mask = np.ones(len(self.idx), dtype=bool)
+        for key, val in kw.items():
+            mask &= self.idx[key] == val
+        return np.nonzero(mask)[0]
+
+    def GetWave(self, i):
+        """ All samples of the wf in row i, as doubles. """
+        return np.asarray(self.wf[i,:self.idx["length"][i]], dtype=np.double)
+
+    def GetTS(self, i):
+        """ Time stamps (ns) of the wf in row i. """
+        offset, period, length = self.idx["offset"][i], self.idx["period"][i], self.idx["length"][i]
+        return np.arange(offset, offset + length * period, period)
+
+    def GetBlock(self, rows, remLo=0, remHi=2):
+        """ Process a block of wf's the same way as wl.processWaveform.  All rows must have
+        the same length.  Returns 2-D (nWF, nSamples) arrays ts, waveRaw, waveBLSub,
+        and the arrays baseAvg, noiseAvg.
+        """
+        rows = np.asarray(rows)
+        lengths = self.idx["length"][rows]
+        if len(rows)==0 or np.any(lengths!=lengths[0]):
+            raise ValueError("GetBlock needs a nonempty set of rows w/ the same wf length")
+        nSamp = lengths[0]
+        lo = remLo+1 if remLo > 0 else 0
+        hi = nSamp - remHi if remHi > 0 else nSamp
+
+        ts = np.stack([self.GetTS(i)[lo:hi] for i in rows])
+        waveRaw = np.asarray(self.wf[rows,lo:hi], dtype=np.double)
+        noiseAvg,_,baseAvg = wl.baselineParameters(waveRaw)
+        waveBLSub = waveRaw - baseAvg[:,np.newaxis]
+        return ts, waveRaw, waveBLSub, baseAvg, noiseAvg
+
+    def Iterate(self, nBlock=100, remLo=0, remHi=2):
+        """ Stream the store in blocks of up to nBlock consecutive rows w/ the same wf length.
+        Yields (rows, ts, waveRaw, waveBLSub, baseAvg, noiseAvg), see GetBlock.
+        """
+        lengths = self.idx["length"]
+        start = 0
+        while start < len(self.idx):
+            stop = min(start + nBlock, len(self.idx))
+            diff = np.nonzero(lengths[start:stop] != lengths[start])[0]
+            if len(diff) > 0: stop = start + diff[0]
+            rows = np.arange(start, stop)
+            yield (rows,) + self.GetBlock(rows, remLo, remHi)
+            start = stop
+
+
+if __name__=="__main__":
+    main(sys.argv[1:])
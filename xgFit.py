@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+""" 'xgFit.py': xGauss waveform fitter for LAT.
+    Same model and likelihood as the original lat.py wf fit (xgModelWF + lnLike), w/ tau pinned,
+    but L-BFGS-B gets the closed-form gradient in (amp, mu, sig, bl) instead of
+    finite differences, so each iteration costs one model evaluation instead of six.
+    Fits are seeded from trapENM / trapENMSample and the default fitSlo.  W/ warmStart
+    (lat.py -warm), fitSlo starts from the last good fit on the same channel instead, which is
+    faster but makes the result depend on the order hits are fit in.
+
+    ./xgFit.py runs test(), which fails (AssertionError) on a gradient or determinism regression.
+"""
+import numpy as np
+import scipy.optimize as op
+import scipy.special as sp
+
+tauFix = -72000.  # fixed tau (ns) for the wf fit
+sigInit = 600.    # default initial fitSlo
+fLimit = 709.782  # np.exp of this is sys.float_info.max
+
+
+def xgShape(x, mu, sig, tau):
+    """ xGauss shape (evalXGaus in lat.py) and its derivatives w/r/t mu and sig.
+    The derivatives are None when we're in the asymptotic-expansion region.
+    """
+    tmp = (x-mu + sig**2./2./tau)/tau
+    if not all(tmp < fLimit):
+        den = 1./(sig + tau*(x-mu)/sig)
+        g = sig * np.exp(-((x-mu)**2./2./sig**2.)) * den * (1.-tau**2. * den**2.)
+        return g, None, None
+
+    aTau = np.fabs(tau)
+    z = (tau*(x-mu)/sig + sig)/np.sqrt(2.)/aTau
+    g = np.exp(tmp)/2./aTau * sp.erfc(z)
+
+    # d/dz erfc(z) = -2/sqrt(pi) exp(-z^2). combine the exponentials to avoid overflow.
+    dErfc = -np.exp(tmp - z**2.)/aTau/np.sqrt(np.pi)
+    dgdmu = g * (-1./tau) + dErfc * (-tau/sig/np.sqrt(2.)/aTau)
+    dgdsig = g * (sig/tau**2.) + dErfc * (1. - tau*(x-mu)/sig**2.)/np.sqrt(2.)/aTau
+    return g, dgdmu, dgdsig
+
+
+def xgModel(x, amp, mu, sig, bl, tau=tauFix):
+    """ Model wf: xGauss shape w/ its max pinned to amp, plus a baseline.
+    Returns the model and its gradient (rows: amp, mu, sig, bl), or None for the gradient
+    if the model is in the asymptotic region.  Like lat.xgModelWF, a bad shape returns zeros.
+    """
+    g, dgdmu, dgdsig = xgShape(x, mu, sig, tau)
+    if np.isnan(g).any() or np.sum(g)==0:
+        return np.zeros(len(x)), np.zeros((4,len(x)))
+
+    k = np.argmax(g)
+    h = g / g[k]
+    model = amp * h + bl
+    if dgdmu is None:
+        return model, None
+
+    grad = np.empty((4,len(x)))
+    grad[0] = h
+    grad[1] = amp * (dgdmu - h * dgdmu[k]) / g[k]
+    grad[2] = amp * (dgdsig - h * dgdsig[k]) / g[k]
+    grad[3] = 1.
+    return model, grad
+
+
+def nll(model, data, noise):
+    """ Negative log-likelihood of a model wf (same as the original lat.py lnLike). """
+    return 0.5 * np.sum( np.power((data-model)/noise, 2) - np.log( 1 / np.power(noise,2) ) )
+
+
+def lnLike(pars, x, data, noise, tau=tauFix):
+    """ Negative log-likelihood of the xGauss model, and its gradient in (amp, mu, sig, bl).
+    Falls back to a numerical gradient in the asymptotic region.
+    """
+    amp, mu, sig, bl = pars
+    model, grad = xgModel(x, amp, mu, sig, bl, tau)
+    if grad is None:
+        fOnly = lambda p: nll(xgModel(x, p[0], p[1], p[2], p[3], tau)[0], data, noise)
+        return nll(model, data, noise), op.approx_fprime(pars, fOnly, np.sqrt(np.finfo(float).eps))
+    return nll(model, data, noise), -np.dot(grad, (data-model)/noise**2)
+
+
+class XGFitter:
+    """ Fits wf's to the xGauss model.  Keeps running totals of the fitter call counts, and
+    w/ warmStart, the last good fitSlo for each channel (to start the next hit from).
+    Off by default, s/t the fit of each hit doesn't depend on the hits before it.
+    """
+    def __init__(self, warmStart=False):
+        self.warmStart = warmStart
+        self.lastSig = {}
+        self.nFit, self.nFail, self.nFev, self.nIt = 0, 0, 0, 0
+
+    def guess(self, chan, amp, mu, bl):
+        """ Initial parameters [amp, mu, sig, tau, bl].  amp and mu come from the trap filter
+        (trapENM, trapENMSample*10 - 4000), and sig is the default fitSlo,
+        or this channel's last good fitSlo w/ warmStart.
+        """
+        sig = self.lastSig.get(chan, sigInit) if self.warmStart else sigInit
+        return np.asarray([amp, mu, sig, tauFix, bl])
+
+    def fit(self, x, data, noise, floats, chan=None, callback=None):
+        """ Fit data (w/ baseline noise 'noise') starting from floats = [amp, mu, sig, tau, bl].
+        Returns a dict like op.minimize: x (all 5 params), fun, success, message, nfev, nit.
+        'callback' is called w/ the parameters at each evaluation (lat.py uses it for the fit traces).
+        """
+        amp, mu, sig, tau, bl = floats
+        p0 = np.asarray([amp, mu, sig, bl])
+        bnd = ((None,None),(None,None),(2.,None),(None,None))
+
+        # only use a warm start if it's a better starting point than the default fitSlo,
+        # otherwise it can pull the fit into a local minimum.
+        if sig != sigInit:
+            pInit = np.asarray([amp, mu, sigInit, bl])
+            if nll(xgModel(x, *pInit, tau=tau)[0], data, noise) <= nll(xgModel(x, *p0, tau=tau)[0], data, noise):
+                p0 = pInit
+
+        def func(p):
+            if callback is not None: callback(p[0], p[1], p[2], tau, p[3])
+            return lnLike(p, x, data, noise, tau)
+
+        result = op.minimize(func, p0, jac=True, method="L-BFGS-B", bounds=bnd)
+
+        # if a warm start didn't converge, try again from the default fitSlo
+        if not result.success and p0[2] != sigInit:
+            p0[2] = sigInit
+            retry = op.minimize(func, p0, jac=True, method="L-BFGS-B", bounds=bnd)
+            retry.nfev, retry.nit = retry.nfev + result.nfev, retry.nit + result.nit
+            result = retry
+
+        amp, mu, sig, bl = result.x
+        if result.success and chan is not None:
+            self.lastSig[chan] = sig
+
+        return {"x":np.asarray([amp, mu, sig, tau, bl]), "fun":result.fun, "success":result.success,
+                "message":result.message, "nfev":result.nfev, "nit":result.nit}
+
+    def count(self, success, nfev, nit):
+        """ Add one fit to the running totals.  Done by the caller, s/t fits from worker processes can be counted too. """
+        self.nFit += 1
+        self.nFev += nfev
+        self.nIt += nit
+        if not success: self.nFail += 1
+
+    def stats(self):
+        """ Summary string of the fitter call counts. """
+        if self.nFit == 0: return "xGauss fits: 0"
+        return "xGauss fits: %d  fails: %d  avg. evaluations: %.1f  avg. iterations: %.1f" % (
+            self.nFit, self.nFail, self.nFev/self.nFit, self.nIt/self.nFit)
+
+
+def test():
+    """ Check the analytic gradient against finite differences, and that fits w/o the warm start
+    don't depend on the hit order: one fitter over all hits (like lat.py -j 1) must give the same
+    results as 4 fitters over 4 chunks (-j 4), and as a fitter going through the hits backwards.
+    """
+    x = np.arange(-10000., 10140., 10)
+    data = 100*np.exp(-((x-1000.)/3000.)**2) + 5.
+    for pars in [(100., 1000., 600., 5.), (20., -3000., 50., -2.), (300., 8000., 2000., 10.)]:
+        pars = np.asarray(pars)
+        val, grad = lnLike(pars, x, data, 2.)
+        num = op.approx_fprime(pars, lambda p: lnLike(p, x, data, 2.)[0], 1e-4)
+        assert np.allclose(grad, num, rtol=1e-3, atol=1e-3*np.abs(num).max()), (pars, grad, num)
+
+    # simulated hits on 3 channels: xGauss pulses w/ random amp, t0 and fitSlo, plus noise
+    rng = np.random.RandomState(1234)
+    x = np.arange(0., 20000., 10)
+    hits = []
+    for i in range(24):
+        amp, mu, sig, bl, noise = rng.uniform(20,200), rng.uniform(9000,11000), rng.uniform(200,1500), rng.uniform(-5,5), 2.
+        data = xgModel(x, amp, mu, sig, bl)[0] + rng.normal(0, noise, len(x))
+        hits.append((i % 3, data, noise, amp, mu, bl))
+
+    def fitAll(fitter, hitList):
+        res = {}
+        for chan, data, noise, amp, mu, bl in hitList:
+            r = fitter.fit(x, data, noise, fitter.guess(chan, amp, mu, bl), chan)
+            res[id(data)] = (r["x"], r["fun"], r["success"])
+        return res
+
+    one = fitAll(XGFitter(), hits)
+    four = {}
+    for j in range(4):
+        four.update(fitAll(XGFitter(), hits[j*6:(j+1)*6]))
+    back = fitAll(XGFitter(), hits[::-1])
+    for key in one:
+        for other in (four, back):
+            assert np.array_equal(one[key][0], other[key][0]) and one[key][1:] == other[key][1:], (one[key], other[key])
+    assert sum(r[2] for r in one.values()) == len(hits), "%d of %d fits failed" % (len(hits)-sum(r[2] for r in one.values()), len(hits))
+
+    # the warm start does carry state between hits
+    warm = XGFitter(warmStart=True)
+    fitAll(warm, hits[:1])
+    assert warm.guess(0, 1., 0., 0.)[2] == one[id(hits[0][1])][0][2]
+    assert XGFitter().guess(0, 1., 0., 0.)[2] == sigInit
+    print("xgFit test OK")
+
+
+if __name__=="__main__":
+    test()